@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from dataclasses import dataclass
+from os import environ
+from pathlib import Path
+from sqlite3 import connect as sqlite_connect
+
+from .hash_cache import StatKey
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Default location of the audio fingerprint database.
+'''
+_default_path = Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'tjtools' / 'audio.sqlite'
+
+'''
+Timeout (in seconds) when waiting for the database lock held by another process.
+'''
+_lock_timeout = 30.0
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS fingerprints (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    md5 BLOB NOT NULL,
+    sha512 BLOB NOT NULL,
+    bits_per_sample INTEGER NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    channels INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino)
+)
+'''
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class AudioFingerprint:
+    '''
+    Dataclass encoding the decoded audio content of a file.
+
+    md5             - MD5 of the raw PCM samples (same as the FLAC MD5 signature)
+    sha512          - SHA-512 of the raw PCM samples
+    bits_per_sample - bits-per-sample of the samples
+    sample_rate     - sample rate in Hz
+    channels        - number of channels
+    '''
+
+    md5: bytes
+    sha512: bytes
+    bits_per_sample: int
+    sample_rate: int
+    channels: int
+
+
+class AudioCache:
+    '''
+    Persistent on-disk cache of audio fingerprints.
+
+    Entries are looked up by device and inode, and are only considered valid as
+    long as size, mtime and ctime of the file are unchanged.
+
+    The cache is backed by a SQLite database. Objects of this class must only be
+    used from the thread that created them.
+    '''
+
+    def __init__(self, path: Path = None):
+        if path is None:
+            path = _default_path
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite_connect(path.as_posix(), timeout=_lock_timeout)
+        self._db.execute(_schema)
+
+    def __enter__(self) -> AudioCache:
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def lookup(self, key: StatKey) -> AudioFingerprint:
+        '''
+        Lookup the fingerprint of a file.
+
+        Arguments:
+            key - stat key of the file
+
+        Returns the cached fingerprint, or None if no valid entry exists.
+        '''
+
+        query = 'SELECT size, mtime_ns, ctime_ns, md5, sha512, bits_per_sample, sample_rate, channels ' \
+            'FROM fingerprints WHERE dev = ? AND ino = ?'
+
+        row = self._db.execute(query, (key.dev, key.ino)).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, ctime_ns, *values = row
+        if (size, mtime_ns, ctime_ns) != (key.size, key.mtime_ns, key.ctime_ns):
+            return None
+
+        return AudioFingerprint(*values)
+
+    def store(self, key: StatKey, fingerprint: AudioFingerprint) -> None:
+        '''
+        Store the fingerprint of a file.
+
+        Arguments:
+            key         - stat key of the file
+            fingerprint - the fingerprint to store
+        '''
+
+        query = 'INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+        fp = fingerprint
+
+        self._db.execute(query, (
+            key.dev, key.ino, key.size, key.mtime_ns, key.ctime_ns,
+            fp.md5, fp.sha512, fp.bits_per_sample, fp.sample_rate, fp.channels,
+        ))
+
+    def close(self) -> None:
+        '''
+        Commit pending changes and close the cache.
+        '''
+
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
@@ -7,12 +7,18 @@
 ##########################################################################################
 
 from argparse import ArgumentParser
+from fcntl import F_SETPIPE_SZ, fcntl
+from hashlib import md5, sha512
 from pathlib import Path
-from subprocess import DEVNULL, run as prun
+from subprocess import DEVNULL, PIPE, Popen
 from sys import exit, stderr, argv as sys_argv
+from typing import Generator
 
 from mutagen import File as AudioFile
 
+from .audio_cache import AudioCache, AudioFingerprint
+from .hash_cache import StatKey
+
 
 ##########################################################################################
 # Constants
@@ -20,42 +26,275 @@ from mutagen import File as AudioFile
 
 _args_template = ('ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'quiet')
 
+'''
+Raw PCM formats used for streaming samples, keyed by bits-per-sample.
+'''
+_pcm_formats = {
+    16: 's16le',
+    24: 's24le',
+    32: 's32le',
+}
+
+'''
+Size (in bytes) of the PCM chunks that are compared.
+'''
+_chunk_size = 1 << 20
+
+'''
+Requested capacity (in bytes) of the pipes between the decoders and us.
+'''
+_pipe_size = 1 << 20
+
 
 ##########################################################################################
 # Internal functions
 ##########################################################################################
 
-def _hash(path: Path, hash_func: str) -> bytes:
+def _get_stream_info(path: Path) -> tuple[int, int, int]:
+    '''
+    Get the stream parameters of an audio file.
+
+    Arguments:
+        path - path to the audio file
+
+    Returns a tuple of bits-per-sample, sample rate and number of channels.
+    '''
+
     audio_file = AudioFile(path.as_posix())
+    if audio_file is None:
+        raise RuntimeError(f'unknown audio format: {path}')
 
-    bps = audio_file.info.bits_per_sample
+    info = audio_file.info
 
-    if bps in (16, 32):
-        codec_args = tuple()
-    elif bps == 24:
-        codec_args = ('-acodec', 'pcm_s24le')
-    else:
+    if not info.bits_per_sample in _pcm_formats:
         raise RuntimeError('invalid bits-per-sample')
 
-    p_args = _args_template + ('-i', path.as_posix()) + codec_args + ('-f', 'hash', '-hash', hash_func, '-')
+    return (info.bits_per_sample, info.sample_rate, info.channels)
+
+def _get_bps(path: Path) -> int:
+    return _get_stream_info(path)[0]
 
-    p = prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+def _lookup_fingerprints(paths: list[Path]) -> list[tuple[StatKey, AudioFingerprint]]:
+    '''
+    Lookup the cached fingerprints of audio files.
+
+    Arguments:
+        paths - list of paths to the audio files
 
-    output_lines = p.stdout.splitlines()
-    if len(output_lines) != 1:
-        raise RuntimeError('unexpected ffmpeg output')
+    Returns a list of tuples of stat key and fingerprint (None if not cached).
 
-    key, value = p.stdout.rstrip().split('=')
-    if key != hash_func:
-        raise RuntimeError('malformed ffmpeg output')
+    The stat keys need to be taken before decoding, so that a file that is
+    modified while being decoded is never stored in the cache.
+    '''
 
-    return bytes.fromhex(value)
+    keys = [StatKey.from_stat(p.stat()) for p in paths]
+
+    try:
+        with AudioCache() as cache:
+            return [(k, cache.lookup(k)) for k in keys]
+
+    except Exception as exc:
+        print(f'warn: failed to read audio cache: {exc}', file=stderr)
+
+    return [(k, None) for k in keys]
+
+def _store_fingerprints(entries: list[tuple[Path, StatKey, AudioFingerprint]]) -> None:
+    '''
+    Store the fingerprints of audio files in the cache.
+
+    Arguments:
+        entries - list of tuples of path, stat key (from before decoding) and fingerprint
+
+    Files that changed since the stat key was taken are skipped.
+    '''
+
+    try:
+        with AudioCache() as cache:
+            for path, key, fingerprint in entries:
+                if StatKey.from_stat(path.stat()) == key:
+                    cache.store(key, fingerprint)
+
+    except Exception as exc:
+        print(f'warn: failed to update audio cache: {exc}', file=stderr)
+
+def _ffmpeg_decoder(path: Path, bps: int) -> Popen:
+    '''
+    Start a ffmpeg decoder for an audio file.
+
+    Arguments:
+        path - path to the audio file
+        bps  - bits-per-sample of the raw PCM output
+    '''
+
+    pcm_format = _pcm_formats[bps]
+
+    p_args = _args_template + ('-i', path.as_posix(), '-f', pcm_format, '-acodec', f'pcm_{pcm_format}', '-')
+
+    return spawn_decoder(p_args)
 
 
 ##########################################################################################
 # Functions
 ##########################################################################################
 
+def spawn_decoder(p_args: tuple) -> Popen:
+    '''
+    Start a decoder process that writes raw PCM samples to a pipe.
+
+    Arguments:
+        p_args - the process arguments
+    '''
+
+    p = Popen(p_args, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+
+    try:
+        fcntl(p.stdout.fileno(), F_SETPIPE_SZ, _pipe_size)
+
+    except OSError:
+        pass
+
+    return p
+
+def decoder_chunks(decoder: Popen) -> Generator[bytes, None, None]:
+    '''
+    Read the raw PCM output of a running decoder process in chunks.
+
+    Arguments:
+        decoder - the decoder process (see spawn_decoder)
+    '''
+
+    while chunk := decoder.stdout.read(_chunk_size):
+        yield chunk
+
+def compare_decoders(decoders: list[Popen], hashes: list = None) -> bool:
+    '''
+    Compare the raw PCM output of two running decoder processes.
+
+    Arguments:
+        decoders - list of the two decoder processes
+        hashes   - list of hash objects that are fed with the matching output (optional)
+
+    Returns True if both outputs match, and False otherwise.
+
+    The outputs are compared chunk by chunk while the decoders are running. On the
+    first mismatch the decoders are killed. Raises RuntimeError if a decoder fails.
+    '''
+
+    if hashes is None:
+        hashes = []
+
+    decoder_a, decoder_b = decoders
+
+    finished = False
+    killed = []
+
+    try:
+        while True:
+            chunk_a = decoder_a.stdout.read(_chunk_size)
+            chunk_b = decoder_b.stdout.read(_chunk_size)
+
+            if chunk_a != chunk_b:
+                break
+
+            if not chunk_a:
+                finished = True
+
+                break
+
+            for h in hashes:
+                h.update(chunk_a)
+
+    finally:
+        for p in decoders:
+            if not finished and p.poll() is None:
+                p.kill()
+                killed.append(p)
+
+            p.stdout.close()
+            p.wait()
+
+    for p in decoders:
+        if not p in killed and p.returncode != 0:
+            raise RuntimeError(f'decoder {p.args[0]} failed with error: {p.returncode}')
+
+    return finished
+
+def audio_fingerprint(path: Path, use_cache: bool = True) -> AudioFingerprint:
+    '''
+    Compute the fingerprint of an audio file.
+
+    Arguments:
+        path      - path to the audio file
+        use_cache - take the fingerprint from the audio cache if possible?
+
+    The fingerprint is taken from the audio cache if the file is unchanged
+    since it was last decoded. Otherwise the file is decoded and the digests
+    are computed over the raw samples, i.e. without considering any file header,
+    tags, etc. The result is then stored in the cache.
+
+    Verification (e.g. of MD5 signatures) must not use the cache, since bit rot
+    does not change the stat key of a file.
+    '''
+
+    if use_cache:
+        (key, fingerprint), = _lookup_fingerprints([path])
+        if fingerprint is not None:
+            return fingerprint
+    else:
+        key = StatKey.from_stat(path.stat())
+
+    bps, sample_rate, channels = _get_stream_info(path)
+
+    md5_hash = md5()
+    sha512_hash = sha512()
+
+    decoder = _ffmpeg_decoder(path, bps)
+
+    finished = False
+
+    try:
+        while chunk := decoder.stdout.read(_chunk_size):
+            md5_hash.update(chunk)
+            sha512_hash.update(chunk)
+
+        finished = True
+
+    finally:
+        if not finished and decoder.poll() is None:
+            decoder.kill()
+
+        decoder.stdout.close()
+        decoder.wait()
+
+    if decoder.returncode != 0:
+        raise RuntimeError(f'decoder {decoder.args[0]} failed with error: {decoder.returncode}')
+
+    fingerprint = AudioFingerprint(md5_hash.digest(), sha512_hash.digest(), bps, sample_rate, channels)
+
+    _store_fingerprints([(path, key, fingerprint)])
+
+    return fingerprint
+
+def carry_fingerprint(key: StatKey, path: Path) -> None:
+    '''
+    Carry a cached fingerprint over to a new file with the same audio content.
+
+    Arguments:
+        key  - stat key of the original file (taken before it was replaced)
+        path - path to the new file
+
+    This is a no-op if no fingerprint is cached for the original file.
+    '''
+
+    try:
+        with AudioCache() as cache:
+            fingerprint = cache.lookup(key)
+            if fingerprint is not None:
+                cache.store(StatKey.from_stat(path.stat()), fingerprint)
+
+    except Exception as exc:
+        print(f'warn: failed to update audio cache: {exc}', file=stderr)
+
 def audio_compare(path_a: Path, path_b: Path) -> bool:
     '''
     Compare two audio files.
@@ -65,9 +304,98 @@ def audio_compare(path_a: Path, path_b: Path) -> bool:
         second_path - path to audio file B
 
     Returns True if A and B match, and False otherwise.
+
+    Cached fingerprints are compared without decoding. If only one of the files
+    has a cached fingerprint, just the other file is decoded. Otherwise both files
+    are decoded at the same time, and the samples are compared as they arrive,
+    stopping at the first mismatch.
+    '''
+
+    info_a = _get_stream_info(path_a)
+    info_b = _get_stream_info(path_b)
+
+    bps = info_a[0]
+    if info_b[0] != bps:
+        return False
+
+    (key_a, fp_a), (key_b, fp_b) = _lookup_fingerprints([path_a, path_b])
+
+    if fp_a is not None or fp_b is not None:
+        if fp_a is None:
+            fp_a = audio_fingerprint(path_a)
+        elif fp_b is None:
+            fp_b = audio_fingerprint(path_b)
+
+        return fp_a.sha512 == fp_b.sha512
+
+    md5_hash = md5()
+    sha512_hash = sha512()
+
+    decoders = [_ffmpeg_decoder(path_a, bps)]
+
+    try:
+        decoders.append(_ffmpeg_decoder(path_b, bps))
+
+    except Exception:
+        decoders[0].kill()
+        decoders[0].wait()
+
+        raise
+
+    if not compare_decoders(decoders, [md5_hash, sha512_hash]):
+        return False
+
+    entries = []
+
+    for path, key, info in ((path_a, key_a, info_a), (path_b, key_b, info_b)):
+        fingerprint = AudioFingerprint(md5_hash.digest(), sha512_hash.digest(), *info)
+        entries.append((path, key, fingerprint))
+
+    _store_fingerprints(entries)
+
+    return True
+
+def reference_compare(path: Path, flac_path: Path) -> bool:
+    '''
+    Compare an audio file against a FLAC file decoded with the reference decoder.
+
+    Arguments:
+        path      - path to the audio file
+        flac_path - path to the FLAC file
+
+    Returns True if both match, and False otherwise.
+
+    The reference decoder writes raw samples at the native width of the FLAC file
+    to a pipe, so the decoded output never touches the disk.
     '''
 
-    return _hash(path_a, hash_func='SHA512') == _hash(path_b, hash_func='SHA512')
+    bps = _get_bps(path)
+    if _get_bps(flac_path) != bps:
+        return False
+
+    flac_args = (
+        'flac',
+        '--decode',
+        '--silent',
+        '--stdout',
+        '--force-raw-format',
+        '--endian=little',
+        '--sign=signed',
+        flac_path.as_posix(),
+    )
+
+    decoders = [spawn_decoder(flac_args)]
+
+    try:
+        decoders.append(_ffmpeg_decoder(path, bps))
+
+    except Exception:
+        decoders[0].kill()
+        decoders[0].wait()
+
+        raise
+
+    return compare_decoders(decoders)
 
 def audio_md5(path: Path) -> bytes:
     '''
@@ -80,7 +408,7 @@ def audio_md5(path: Path) -> bytes:
     without considering any file header, etc.
     '''
 
-    return _hash(path, hash_func='MD5')
+    return audio_fingerprint(path).md5
 
 
 ##########################################################################################
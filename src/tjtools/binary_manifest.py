@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+'''
+NOTES:
+
+Layout of a binary manifest (all integers are little-endian):
+
+    header     - see _header below
+    sizes      - one uint64 filesize per entry
+    digests    - one digest (of digest_size bytes) per entry
+    name table - (num_entries + 1) uint64 offsets into the name data
+    index      - num_slots uint32 slots (entry index + 1, or 0 if the slot is empty)
+    name data  - the UTF-8 encoded filenames, sorted bytewise
+
+The index is an open addressing hash table with linear probing, keyed by
+the filename. It is filled to at most half of its slots.
+'''
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from dataclasses import dataclass
+from hashlib import blake2b
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+from struct import Struct
+from typing import Generator
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+_magic = b'TJSHB\x00\r\n'
+
+_version = 1
+
+'''
+Header: magic, version, digest size, number of entries, number of index slots.
+'''
+_header = Struct('<8sIIQQ')
+
+_uint64 = Struct('<Q')
+_name_range = Struct('<QQ')
+_uint32 = Struct('<I')
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class _Layout:
+    '''
+    Offsets of the sections of a binary manifest.
+    '''
+
+    num_entries: int
+    num_slots: int
+    digest_size: int
+    sizes: int
+    digests: int
+    names: int
+    index: int
+    data: int
+
+    @staticmethod
+    def compute(num_entries: int, num_slots: int, digest_size: int) -> _Layout:
+        sizes = _header.size
+        digests = sizes + num_entries * _uint64.size
+        names = digests + num_entries * digest_size
+        index = names + (num_entries + 1) * _uint64.size
+        data = index + num_slots * _uint32.size
+
+        return _Layout(num_entries, num_slots, digest_size, sizes, digests, names, index, data)
+
+
+class BinaryManifest:
+    '''
+    Read-only view of a binary manifest.
+
+    The manifest is memory-mapped, so opening it takes constant time and memory,
+    independent of the number of entries. Lookups by filename use the hash index.
+    '''
+
+    def __init__(self, path: Path):
+        with open(path, mode='rb') as f:
+            self._map = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+        try:
+            self._layout = self._parse_header()
+
+        except Exception:
+            self._map.close()
+
+            raise
+
+    def __enter__(self) -> BinaryManifest:
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._layout.num_entries
+
+    def __contains__(self, filename: str) -> bool:
+        return self._find(filename) >= 0
+
+    def __getitem__(self, i: int) -> tuple[int, bytes, str]:
+        if not 0 <= i < self._layout.num_entries:
+            raise IndexError(f'entry index out of range: {i}')
+
+        return self._entry(i)
+
+    def __iter__(self) -> Generator[tuple[int, bytes, str], None, None]:
+        for i in range(self._layout.num_entries):
+            yield self._entry(i)
+
+    def _parse_header(self) -> _Layout:
+        if len(self._map) < _header.size:
+            raise RuntimeError('truncated binary manifest')
+
+        magic, version, digest_size, num_entries, num_slots = _header.unpack_from(self._map, 0)
+
+        if magic != _magic:
+            raise RuntimeError('not a binary manifest')
+
+        if version != _version:
+            raise RuntimeError(f'unsupported binary manifest version: {version}')
+
+        if num_slots <= num_entries or num_slots & (num_slots - 1) != 0:
+            raise RuntimeError(f'invalid index size: {num_slots}')
+
+        layout = _Layout.compute(num_entries, num_slots, digest_size)
+
+        data_size = _uint64.unpack_from(self._map, layout.names + num_entries * _uint64.size)[0]
+        if layout.data + data_size != len(self._map):
+            raise RuntimeError('truncated binary manifest')
+
+        return layout
+
+    def _name(self, i: int) -> bytes:
+        start, end = _name_range.unpack_from(self._map, self._layout.names + i * _uint64.size)
+
+        return self._map[self._layout.data + start:self._layout.data + end]
+
+    def _entry(self, i: int) -> tuple[int, bytes, str]:
+        layout = self._layout
+
+        filesize = _uint64.unpack_from(self._map, layout.sizes + i * _uint64.size)[0]
+
+        offset = layout.digests + i * layout.digest_size
+        digest = self._map[offset:offset + layout.digest_size]
+
+        return (filesize, digest, self._name(i).decode('utf-8'))
+
+    def _find(self, filename: str) -> int:
+        '''
+        Find the index of an entry.
+
+        Arguments:
+            filename - the filename of the entry
+
+        Returns -1 if the manifest has no entry for the filename.
+        '''
+
+        name = filename.encode('utf-8')
+        mask = self._layout.num_slots - 1
+
+        slot = _name_hash(name) & mask
+
+        while True:
+            value = _uint32.unpack_from(self._map, self._layout.index + slot * _uint32.size)[0]
+            if value == 0:
+                return -1
+
+            if self._name(value - 1) == name:
+                return value - 1
+
+            slot = (slot + 1) & mask
+
+    def lookup(self, filename: str) -> tuple[int, bytes]:
+        '''
+        Lookup an entry by filename.
+
+        Arguments:
+            filename - the filename
+
+        Returns a tuple of filesize and digest, or None if there is no entry.
+        '''
+
+        i = self._find(filename)
+        if i < 0:
+            return None
+
+        filesize, digest, _ = self._entry(i)
+
+        return (filesize, digest)
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _name_hash(name: bytes) -> int:
+    return int.from_bytes(blake2b(name, digest_size=8).digest(), 'little')
+
+
+##########################################################################################
+# Functions
+##########################################################################################
+
+def is_binary_data(data: bytes) -> bool:
+    '''
+    Check if data (e.g. read from an archive) is a binary manifest.
+
+    Arguments:
+        data - the data, or at least its beginning
+    '''
+
+    return data[:len(_magic)] == _magic
+
+def is_binary_manifest(path: Path) -> bool:
+    '''
+    Check if a file is a binary manifest.
+
+    Arguments:
+        path - path of the file
+    '''
+
+    try:
+        with open(path, mode='rb') as f:
+            return is_binary_data(f.read(len(_magic)))
+
+    except OSError:
+        return False
+
+def write_binary_manifest(path: Path, entries: list[tuple[int, bytes, str]]) -> None:
+    '''
+    Write a binary manifest.
+
+    Arguments:
+        path    - path of the manifest
+        entries - list of tuples of filesize, digest and filename
+
+    All digests need to have the same size, and filenames need to be unique.
+    The manifest is replaced atomically. The temporary file is hidden, so that
+    it is never mistaken as a file of the directory.
+    '''
+
+    entries = sorted(((e[2].encode('utf-8'), e[0], e[1]) for e in entries), key=lambda e: e[0])
+
+    digest_size = len(entries[0][2]) if entries else 0
+
+    for i, (name, _, digest) in enumerate(entries):
+        if len(digest) != digest_size:
+            raise RuntimeError(f'digest size mismatch for: {name.decode("utf-8")}')
+
+        if i != 0 and entries[i - 1][0] == name:
+            raise RuntimeError(f'duplicate entry: {name.decode("utf-8")}')
+
+    num_slots = 2
+    while num_slots < 2 * len(entries):
+        num_slots *= 2
+
+    index = [0] * num_slots
+
+    for i, (name, _, _) in enumerate(entries):
+        slot = _name_hash(name) & (num_slots - 1)
+
+        while index[slot] != 0:
+            slot = (slot + 1) & (num_slots - 1)
+
+        index[slot] = i + 1
+
+    offsets = [0]
+    for name, _, _ in entries:
+        offsets.append(offsets[-1] + len(name))
+
+    num_entries = len(entries)
+
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+
+    with open(tmp_path, mode='wb') as f:
+        f.write(_header.pack(_magic, _version, digest_size, num_entries, num_slots))
+        f.write(Struct(f'<{num_entries}Q').pack(*(e[1] for e in entries)))
+        f.write(b''.join(e[2] for e in entries))
+        f.write(Struct(f'<{num_entries + 1}Q').pack(*offsets))
+        f.write(Struct(f'<{num_slots}I').pack(*index))
+        f.write(b''.join(e[0] for e in entries))
+
+    tmp_path.replace(path)
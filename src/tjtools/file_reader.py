@@ -0,0 +1,755 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from ctypes import CDLL, POINTER, c_int, c_long, c_size_t, c_ubyte, c_void_p
+from dataclasses import asdict, dataclass, field
+from enum import Enum, auto
+from errno import EINVAL
+from hashlib import sha256
+from json import dump as jdump, load as jload
+from mmap import ACCESS_READ, MADV_DONTNEED, MADV_SEQUENTIAL, MAP_SHARED, PAGESIZE, PROT_READ, mmap
+from os import (
+    O_DIRECT,
+    O_RDONLY,
+    POSIX_FADV_DONTNEED,
+    POSIX_FADV_SEQUENTIAL,
+    POSIX_FADV_WILLNEED,
+    SEEK_SET,
+    close,
+    environ,
+    fstat,
+    lseek,
+    open as os_open,
+    posix_fadvise,
+    readv,
+    stat,
+    statvfs,
+)
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Generator
+
+from .sysfs_helper import get_backing_devices, get_block_device, read_sysfs
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+C library functions used to query the page cache residency of a file.
+'''
+_libc = CDLL(None, use_errno=True)
+_libc.mmap.restype = c_void_p
+_libc.mmap.argtypes = (c_void_p, c_size_t, c_int, c_int, c_int, c_long)
+_libc.munmap.argtypes = (c_void_p, c_size_t)
+_libc.mincore.argtypes = (c_void_p, c_size_t, POINTER(c_ubyte))
+
+_map_failed = c_void_p(-1).value
+
+'''
+Size (in bytes) of the file windows used when querying page cache residency.
+'''
+_residency_window = 1 << 30
+
+'''
+Translation table that maps a mincore() result byte to its residency bit.
+'''
+_residency_table = bytes(i & 1 for i in range(256))
+
+'''
+Default size (in bytes) of the read buffer.
+'''
+_default_block_size = 1 << 20
+
+'''
+Maximum size (in bytes) of the read buffer.
+'''
+_max_block_size = 1 << 24
+
+'''
+Read buffer and readahead sizes (in bytes) for filesystems without a local block
+device (e.g. NFS). Large requests help to keep the network pipe filled.
+'''
+_network_block_size = 1 << 22
+_network_readahead = 1 << 24
+
+'''
+Location of the calibrated I/O profiles.
+'''
+_profiles_path = Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'tjtools' / 'io_profiles.json'
+
+'''
+Candidates tried when calibrating the I/O profile of a filesystem. The readahead
+factors are multiples of the block size, no readahead is covered by the block size trials.
+'''
+_calibrate_block_sizes = (1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24)
+_calibrate_readahead_factors = (4, 16)
+
+'''
+Maximum number of bytes of the sample file read per calibration trial.
+'''
+_calibrate_bytes = 1 << 28
+
+
+##########################################################################################
+# Enumerator definitions
+##########################################################################################
+
+class IOMode(Enum):
+    '''
+    Modes for reading files.
+
+    Buffered - plain reads through the page cache
+    NoCache  - sequential reads that evict the pages they brought into the page cache
+               behind the read cursor, leaving the rest of the page cache untouched
+    Direct   - reads that bypass the page cache (O_DIRECT), if the filesystem supports
+               it (otherwise NoCache is used)
+    '''
+
+    Buffered = auto()
+    NoCache  = auto()
+    Direct   = auto()
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class IOProfile:
+    '''
+    Dataclass encoding the I/O tuning for a filesystem.
+
+    block_size - size (in bytes) of the read buffer
+    readahead  - size (in bytes) of the window ahead of the read cursor that is
+                 prefetched into the page cache (zero leaves it to the kernel)
+    use_mmap   - read the file through a memory mapping
+    '''
+
+    block_size: int = _default_block_size
+    readahead: int = 0
+    use_mmap: bool = False
+
+    def __str__(self) -> str:
+        method = 'mmap' if self.use_mmap else 'read'
+
+        return f'block size {self.block_size}, readahead {self.readahead}, method {method}'
+
+
+@dataclass
+class ReadStats:
+    '''
+    Dataclass encoding read statistics.
+
+    bytes_disk  - number of bytes read from disk
+    bytes_cache - number of bytes served from the page cache
+    '''
+
+    bytes_disk: int = 0
+    bytes_cache: int = 0
+
+    _lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    def add(self, other: ReadStats) -> None:
+        '''
+        Add the statistics of another object (thread-safe).
+
+        Arguments:
+            other - the other statistics object
+        '''
+
+        with self._lock:
+            self.bytes_disk += other.bytes_disk
+            self.bytes_cache += other.bytes_cache
+
+
+class FileReader:
+    '''
+    Sequential block reader for hashing files.
+
+    Optionally, only a range of the file is read. The offset of the range
+    has to be a multiple of the page size.
+
+    Depending on the I/O mode, the reader tries to keep the page cache in the
+    state it was before the file was read. To this end, the page cache residency
+    of the file is recorded when opening it. This is also used to account which
+    bytes were read from disk, and which were served from the cache.
+    '''
+
+    def __init__(self, path: str, mode: IOMode = IOMode.Buffered, profile: IOProfile = None, offset: int = 0, length: int = None):
+        self.stats = ReadStats()
+
+        self._path = path
+        self._mode = mode
+        self._profile = IOProfile() if profile is None else profile
+
+        self._start = offset
+        self._length = length
+
+        self._fd = None
+        self._size = 0
+        self._end = 0
+        self._residency = None
+        self._first_page = offset // PAGESIZE
+        self._offset = offset
+        self._dropped_page = self._first_page
+        self._readahead_offset = offset
+
+        self._open()
+
+    def __enter__(self) -> FileReader:
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _open(self) -> None:
+        if self._mode == IOMode.Direct:
+            try:
+                self._fd = os_open(self._path, O_RDONLY | O_DIRECT)
+
+            except OSError as err:
+                if err.errno != EINVAL:
+                    raise
+
+                self._mode = IOMode.NoCache
+
+        if self._fd is None:
+            self._fd = os_open(self._path, O_RDONLY)
+
+        try:
+            self._size = fstat(self._fd).st_size
+
+            if self._length is None:
+                self._end = self._size
+            else:
+                self._end = min(self._start + self._length, self._size)
+
+            if self._mode != IOMode.Direct:
+                self._residency = _get_residency(self._fd, self._start, self._end)
+
+            if self._mode != IOMode.Buffered:
+                posix_fadvise(self._fd, self._start, self._end - self._start, POSIX_FADV_SEQUENTIAL)
+
+            if self._start != 0:
+                lseek(self._fd, self._start, SEEK_SET)
+
+        except Exception:
+            close(self._fd)
+            self._fd = None
+
+            raise
+
+    def _fallback(self) -> None:
+        '''
+        Fall back from direct to cache-neutral I/O.
+        '''
+
+        close(self._fd)
+
+        self._fd = None
+        self._mode = IOMode.NoCache
+
+        self._open()
+
+    def _read(self, buf) -> int:
+        try:
+            return readv(self._fd, [buf])
+
+        except OSError as err:
+            if err.errno != EINVAL or self._mode != IOMode.Direct or self._offset != self._start:
+                raise
+
+        '''
+        Some filesystems accept O_DIRECT when opening, but fail the reads.
+        '''
+        self._fallback()
+
+        return readv(self._fd, [buf])
+
+    def _account(self, num_read: int) -> None:
+        if self._mode == IOMode.Direct or self._residency is None:
+            self.stats.bytes_disk += num_read
+
+            return
+
+        first_page = self._offset // PAGESIZE - self._first_page
+        last_page = (self._offset + num_read - 1) // PAGESIZE - self._first_page
+
+        bytes_cache = min(self._residency.count(1, first_page, last_page + 1) * PAGESIZE, num_read)
+
+        self.stats.bytes_cache += bytes_cache
+        self.stats.bytes_disk += num_read - bytes_cache
+
+    def _advise_ahead(self) -> None:
+        '''
+        Prefetch the readahead window of the profile into the page cache.
+
+        To keep the number of syscalls low, the window is only extended once
+        half of it has been consumed.
+        '''
+
+        readahead = self._profile.readahead
+
+        if readahead == 0 or self._mode == IOMode.Direct:
+            return
+
+        target = min(self._offset + readahead, self._end)
+        if target - self._readahead_offset < readahead // 2:
+            return
+
+        start = max(self._readahead_offset, self._offset)
+        if target > start:
+            posix_fadvise(self._fd, start, target - start, POSIX_FADV_WILLNEED)
+
+        self._readahead_offset = target
+
+    def _drop(self, last_page: int) -> None:
+        '''
+        Evict the pages that were not cached before, up to a given page.
+
+        Arguments:
+            last_page - the (exclusive) last page to consider
+        '''
+
+        if self._mode != IOMode.NoCache or last_page <= self._dropped_page:
+            return
+
+        if self._residency is None:
+            offset = self._dropped_page * PAGESIZE
+            posix_fadvise(self._fd, offset, (last_page - self._dropped_page) * PAGESIZE, POSIX_FADV_DONTNEED)
+        else:
+            page = self._dropped_page - self._first_page
+            end_page = last_page - self._first_page
+
+            while page < end_page:
+                start = self._residency.find(0, page, end_page)
+                if start < 0:
+                    break
+
+                end = self._residency.find(1, start, end_page)
+                if end < 0:
+                    end = end_page
+
+                offset = (self._first_page + start) * PAGESIZE
+                posix_fadvise(self._fd, offset, (end - start) * PAGESIZE, POSIX_FADV_DONTNEED)
+
+                page = end
+
+        self._dropped_page = last_page
+
+    def fileno(self) -> int:
+        '''
+        Get the file descriptor of the reader.
+        '''
+
+        return self._fd
+
+    def _mmap_blocks(self) -> Generator[memoryview, None, None]:
+        '''
+        Read the file block by block through a memory mapping.
+        '''
+
+        block_size = self._profile.block_size
+
+        '''
+        The mapping is not closed explicitly, since the consumer might still
+        hold a view of the last block. It is unmapped once unreferenced.
+        '''
+        base = self._first_page * PAGESIZE
+
+        m = mmap(self._fd, self._end - base, access=ACCESS_READ, offset=base)
+        m.madvise(MADV_SEQUENTIAL)
+
+        view = memoryview(m)
+
+        while self._offset < self._end:
+            '''
+            MADV_SEQUENTIAL only doubles the kernel readahead, the window of the profile is explicit.
+            '''
+            self._advise_ahead()
+
+            num_read = min(block_size, self._end - self._offset)
+
+            self._account(num_read)
+
+            yield view[self._offset - base:self._offset - base + num_read]
+
+            if self._mode == IOMode.NoCache:
+                '''
+                Pages that are mapped can not be evicted from the page cache.
+                '''
+                m.madvise(MADV_DONTNEED, self._offset - base, num_read)
+
+            self._offset += num_read
+            self._drop(self._offset // PAGESIZE)
+
+    def blocks(self) -> Generator[memoryview, None, None]:
+        '''
+        Read the file block by block.
+
+        Yields a memoryview for each block. The view is only valid until
+        the next block is requested.
+        '''
+
+        if self._profile.use_mmap and self._mode != IOMode.Direct and self._end > self._start:
+            yield from self._mmap_blocks()
+
+            return
+
+        if self._mode == IOMode.Direct:
+            '''
+            Anonymous mappings are page aligned, as required for O_DIRECT.
+            '''
+            buf = mmap(-1, self._profile.block_size)
+        else:
+            buf = bytearray(self._profile.block_size)
+
+        view = memoryview(buf)
+
+        while self._length is None or self._offset < self._end:
+            self._advise_ahead()
+
+            if self._length is None:
+                num_read = self._read(buf)
+            else:
+                remaining = self._end - self._offset
+
+                '''
+                Direct reads need an aligned length, so read full blocks
+                and discard whatever exceeds the range.
+                '''
+                if self._mode == IOMode.Direct or remaining >= len(buf):
+                    num_read = min(self._read(buf), remaining)
+                else:
+                    num_read = self._read(view[:remaining])
+
+            if num_read == 0:
+                break
+
+            self._account(num_read)
+
+            yield view[:num_read]
+
+            self._offset += num_read
+            self._drop(self._offset // PAGESIZE)
+
+    def close(self) -> None:
+        '''
+        Close the reader.
+
+        Pages that were brought into the page cache by readahead, but
+        not consumed, are evicted as well.
+        '''
+
+        if self._fd is None:
+            return
+
+        try:
+            self._drop((self._end + PAGESIZE - 1) // PAGESIZE)
+
+        finally:
+            close(self._fd)
+            self._fd = None
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _round_block_size(size: int) -> int:
+    '''
+    Round a size up to a multiple of the page size, within the block size limits.
+
+    Arguments:
+        size - the size to round
+    '''
+
+    size = min(max(size, PAGESIZE), _max_block_size)
+
+    return (size + PAGESIZE - 1) // PAGESIZE * PAGESIZE
+
+def _get_fs_key(path: str) -> str:
+    '''
+    Get a key identifying the filesystem holding a path.
+
+    Arguments:
+        path - the path to use
+
+    The filesystem ID is stable across reboots for most filesystems (e.g. it is
+    derived from the UUID on ext4 and btrfs), unlike the device ID.
+    '''
+
+    return f'{statvfs(path).f_fsid:016x}'
+
+def _read_queue_attr(path: Path, name: str) -> int:
+    '''
+    Read a queue attribute of a block device.
+
+    Arguments:
+        path - sysfs path of the block device
+        name - name of the queue attribute
+
+    Partitions have no queue of their own, so the parent queue is used.
+    Returns zero if the attribute could not be read.
+    '''
+
+    queue_path = path / 'queue'
+    if not queue_path.is_dir():
+        queue_path = path.parent / 'queue'
+
+    value = read_sysfs(queue_path / name)
+
+    if value is None or not value.isdigit():
+        return 0
+
+    return int(value)
+
+def _default_profile(dev: int) -> IOProfile:
+    '''
+    Derive an I/O profile from the properties of a device.
+
+    Arguments:
+        dev - the device ID of the filesystem
+    '''
+
+    block_device = get_block_device(dev)
+    if block_device is None:
+        return IOProfile(_network_block_size, _network_readahead)
+
+    '''
+    Stacked devices (e.g. MD RAID) report their full stripe width as optimal I/O
+    size. Read whole stripes, so that all member disks are kept busy.
+    '''
+    optimal_io_size = _read_queue_attr(block_device, 'optimal_io_size')
+    if optimal_io_size == 0:
+        return IOProfile()
+
+    num_stripes = max(1, _default_block_size // optimal_io_size)
+    block_size = _round_block_size(num_stripes * optimal_io_size)
+
+    disks = get_backing_devices(block_device)
+    if len(disks) > 1:
+        readahead = 2 * block_size
+    else:
+        readahead = 0
+
+    return IOProfile(block_size, readahead)
+
+def _load_profiles() -> dict[str, IOProfile]:
+    '''
+    Load the calibrated I/O profiles.
+
+    Returns an empty dictionary if no profiles could be loaded.
+    '''
+
+    try:
+        with open(_profiles_path, mode='r', encoding='utf-8') as f:
+            raw_profiles = jload(f)
+
+        return {k: IOProfile(**v) for k, v in raw_profiles.items()}
+
+    except Exception:
+        return dict()
+
+def _store_profiles(profiles: dict[str, IOProfile]) -> None:
+    '''
+    Store the calibrated I/O profiles.
+
+    Arguments:
+        profiles - dictionary of profiles, keyed by filesystem
+    '''
+
+    _profiles_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = _profiles_path.with_suffix('.tmp')
+
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        jdump({k: asdict(v) for k, v in profiles.items()}, fp=f, indent=4)
+
+    tmp_path.replace(_profiles_path)
+
+def _measure(path: str, profile: IOProfile) -> float:
+    '''
+    Measure the hashing throughput for a given I/O profile.
+
+    Arguments:
+        path    - path of the sample file
+        profile - the I/O profile to measure
+
+    Returns the throughput in bytes per second.
+    '''
+
+    fd = os_open(path, O_RDONLY)
+
+    try:
+        '''
+        Make sure that the sample is read from disk.
+        '''
+        posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+
+    finally:
+        close(fd)
+
+    h = sha256()
+    num_bytes = 0
+    block = None
+
+    start = monotonic()
+
+    with FileReader(path, IOMode.NoCache, profile) as reader:
+        for block in reader.blocks():
+            h.update(block)
+
+            num_bytes += len(block)
+            if num_bytes >= _calibrate_bytes:
+                break
+
+        del block
+
+    return num_bytes / max(monotonic() - start, 1e-6)
+
+def _get_residency(fd: int, start: int, end: int) -> bytearray:
+    '''
+    Get the page cache residency of a range of a file.
+
+    Arguments:
+        fd    - file descriptor of the file
+        start - start offset of the range (page aligned)
+        end   - end offset of the range
+
+    Returns a bytearray with one entry per page of the range (1 if resident,
+    0 otherwise), or None if the residency could not be determined.
+    '''
+
+    num_pages = (end - start + PAGESIZE - 1) // PAGESIZE
+    residency = bytearray(num_pages)
+
+    offset = start
+
+    while offset < end:
+        length = min(_residency_window, end - offset)
+
+        addr = _libc.mmap(None, length, PROT_READ, MAP_SHARED, fd, offset)
+        if addr is None or addr == _map_failed:
+            return None
+
+        try:
+            vec = (c_ubyte * ((length + PAGESIZE - 1) // PAGESIZE)).from_buffer(residency, (offset - start) // PAGESIZE)
+            ret = _libc.mincore(addr, length, vec)
+
+        finally:
+            _libc.munmap(addr, length)
+
+        if ret != 0:
+            return None
+
+        offset += length
+
+    return bytearray(residency.translate(_residency_table))
+
+
+##########################################################################################
+# Functions
+##########################################################################################
+
+'''
+Cache of the I/O profiles, keyed by device ID.
+'''
+_device_profiles = dict()
+_device_profiles_lock = Lock()
+
+def get_io_profile(path: str) -> IOProfile:
+    '''
+    Get the I/O profile for reading a file.
+
+    Arguments:
+        path - path of the file
+
+    A calibrated profile of the filesystem holding the file is preferred.
+    Otherwise the profile is derived from the block device properties.
+    '''
+
+    try:
+        dev = stat(path).st_dev
+
+    except OSError:
+        return IOProfile()
+
+    with _device_profiles_lock:
+        profile = _device_profiles.get(dev)
+
+    if profile is not None:
+        return profile
+
+    try:
+        profile = _load_profiles().get(_get_fs_key(path))
+
+    except OSError:
+        profile = None
+
+    if profile is None:
+        profile = _default_profile(dev)
+
+    with _device_profiles_lock:
+        _device_profiles[dev] = profile
+
+    return profile
+
+def calibrate(path: str) -> list[tuple[IOProfile, float]]:
+    '''
+    Calibrate the I/O profile of a filesystem.
+
+    Arguments:
+        path - path of a sample file on the filesystem
+
+    Benchmarks different block sizes, readahead windows and the mmap read
+    path on the sample file, and stores the best profile for the filesystem.
+
+    Returns the list of measured profiles and their throughput, best first.
+
+    Note that the pages of the sample file are evicted from the page cache
+    before each trial.
+    '''
+
+    results = []
+
+    for block_size in _calibrate_block_sizes:
+        profile = IOProfile(block_size)
+        results.append((profile, _measure(path, profile)))
+
+    best_block_size = max(results, key=lambda r: r[1])[0].block_size
+
+    for factor in _calibrate_readahead_factors:
+        profile = IOProfile(best_block_size, factor * best_block_size)
+        results.append((profile, _measure(path, profile)))
+
+    '''
+    The mmap read path is only tried once, with the best block size and readahead so far.
+    '''
+    best = max(results, key=lambda r: r[1])[0]
+
+    profile = IOProfile(best.block_size, best.readahead, True)
+    results.append((profile, _measure(path, profile)))
+
+    results.sort(key=lambda r: r[1], reverse=True)
+
+    profiles = _load_profiles()
+    profiles[_get_fs_key(path)] = results[0][0]
+
+    _store_profiles(profiles)
+
+    with _device_profiles_lock:
+        _device_profiles.clear()
+
+    return results
@@ -2,67 +2,276 @@
 # SPDX-License-Identifier: GPL-2.0
 
 
+from __future__ import annotations
+
+
 ##########################################################################################
 # Imports
 ##########################################################################################
 
 from argparse import ArgumentParser
+from collections import Counter
+from dataclasses import asdict, dataclass
+from enum import Enum
+from json import dumps as jdumps, loads as jloads
+from multiprocessing import Pool
+from os import cpu_count, environ
 from pathlib import Path
-from subprocess import DEVNULL, run as prun
-from sys import exit, stderr, argv as sys_argv
+from signal import SIGINT, SIGTERM, SIG_DFL, SIG_IGN, signal
+from sys import exit, stderr, stdout, argv as sys_argv
 
 from mutagen.flac import FLAC
 
+from .audio_compare import audio_fingerprint
+from .common_util import path_walk
+
 
 ##########################################################################################
 # Constants
 ##########################################################################################
 
-_args_template = ('ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'quiet')
+'''
+Default location of the batch scan state.
+'''
+_default_state_path = Path(environ.get('XDG_STATE_HOME', Path.home() / '.local' / 'state')) / 'tjtools' / 'flac_md5.jsonl'
+
+
+##########################################################################################
+# Enumerator definitions
+##########################################################################################
+
+class ScanStatus(Enum):
+    '''
+    Result of checking a single FLAC file.
+
+    Ok           - the MD5 signature matches the decoded audio
+    Corrupt      - the MD5 signature does not match, or the file could not be decoded
+    Unverifiable - the file has no MD5 signature (all zeros)
+    '''
+
+    Ok = 'ok'
+    Corrupt = 'corrupt'
+    Unverifiable = 'unverifiable'
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class _ScanResult:
+    '''
+    Result of checking a single FLAC file, as recorded in the state file.
+
+    path     - path to the FLAC file
+    size     - filesize in bytes (when checked)
+    mtime_ns - modification time in nanoseconds (when checked)
+    status   - the status value
+    message  - error message (optional)
+    '''
+
+    path: str
+    size: int
+    mtime_ns: int
+    status: str
+    message: str = None
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _signal_handler(signal_no, stack_frame):
+    raise KeyboardInterrupt
+
+def _init_worker() -> None:
+    '''
+    Initialize a worker of the scan pool.
+
+    Interrupts are only handled by the main process, which tears down the pool.
+    '''
+
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, SIG_DFL)
+
+def _check_file(path: Path) -> _ScanResult:
+    '''
+    Check a single FLAC file for the batch scan.
+
+    Arguments:
+        path - path to the FLAC file
+    '''
+
+    try:
+        st = path.stat()
+
+    except OSError as err:
+        return _ScanResult(path.as_posix(), 0, 0, ScanStatus.Corrupt.value, str(err))
+
+    message = None
+
+    try:
+        if FLAC(path.as_posix()).info.md5_signature == 0:
+            status = ScanStatus.Unverifiable
+        elif flac_md5(path, use_cache=False):
+            status = ScanStatus.Ok
+        else:
+            status = ScanStatus.Corrupt
+            message = 'MD5 signature invalid'
+
+    except Exception as exc:
+        status = ScanStatus.Corrupt
+        message = str(exc)
+
+    return _ScanResult(path.as_posix(), st.st_size, st.st_mtime_ns, status.value, message)
+
+def _load_state(path: Path) -> dict[str, _ScanResult]:
+    '''
+    Load the state of an interrupted batch scan.
+
+    Arguments:
+        path - path of the state file
+
+    Returns a dictionary of the recorded results, keyed by path.
+
+    A truncated last line (from a process that was killed while writing) is ignored.
+    '''
+
+    results = {}
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = _ScanResult(**jloads(line))
+
+                except Exception:
+                    continue
+
+                results[result.path] = result
+
+    except FileNotFoundError:
+        pass
+
+    return results
+
+def _is_done(path: Path, results: dict[str, _ScanResult]) -> bool:
+    '''
+    Check if a file was already checked by an interrupted batch scan.
+
+    Arguments:
+        path    - path to the FLAC file
+        results - the recorded results
+
+    Files that were modified since they were checked need to be checked again.
+    '''
+
+    result = results.get(path.as_posix())
+    if result is None:
+        return False
+
+    try:
+        st = path.stat()
+
+    except OSError:
+        return False
+
+    return (st.st_size, st.st_mtime_ns) == (result.size, result.mtime_ns)
+
+def _store_state(path: Path, results: list[_ScanResult]) -> None:
+    '''
+    Store the state of a batch scan.
+
+    Arguments:
+        path    - path of the state file
+        results - list of the results to store
+
+    The state file is replaced atomically.
+    '''
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = path.with_suffix('.tmp')
+
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        for result in results:
+            print(jdumps(asdict(result)), file=f)
+
+    tmp_path.replace(path)
 
 
 ##########################################################################################
 # Functions
 ##########################################################################################
 
-def flac_md5(path: Path) -> bool:
+def flac_md5(path: Path, use_cache: bool = False) -> bool:
     '''
     Check the MD5 signature of a FLAC file.
 
     Arguments:
-        path - path to the FLAC file
+        path      - path to the FLAC file
+        use_cache - take the fingerprint from the audio cache if possible?
 
     Returns True if the signature matches, and False otherwise.
+
+    By default the file is always decoded, since the check is about finding
+    corrupted files. The fresh fingerprint is still stored in the audio cache.
     '''
 
     flac = FLAC(path.as_posix())
 
     ref_md5 = flac.info.md5_signature.to_bytes(length=16, byteorder='big')
 
-    bps = flac.info.bits_per_sample
+    return ref_md5 == audio_fingerprint(path, use_cache).md5
 
-    if bps in (16, 32):
-        codec_args = tuple()
-    elif bps == 24:
-        codec_args = ('-acodec', 'pcm_s24le')
-    else:
-        raise RuntimeError('invalid bits-per-sample')
+def flac_md5_scan(roots: list[Path], jobs: int, state_path: Path) -> Counter:
+    '''
+    Check the MD5 signatures of all FLAC files below a list of roots.
 
-    p_args = _args_template + ('-i', path.as_posix()) + codec_args + ('-f', 'hash', '-hash', 'MD5', '-')
+    Arguments:
+        roots      - list of root directories
+        jobs       - number of files that are checked in parallel
+        state_path - path of the state file
 
-    p = prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+    Returns a counter of the status values of all files.
+
+    Each result is appended to the state file as soon as it is available. When the
+    scan is interrupted, a later scan with the same state file continues where the
+    interrupted one stopped. The state file is removed when the scan completes.
+
+    Every file is decoded, the audio cache is never used to skip a file. Only the
+    state file decides which files are already checked.
+    '''
 
-    output_lines = p.stdout.splitlines()
-    if len(output_lines) != 1:
-        raise RuntimeError('unexpected ffmpeg output')
+    results = _load_state(state_path)
 
-    key, value = output_lines[0].rstrip().split('=')
-    if key != 'MD5':
-        raise RuntimeError('malformed ffmpeg output')
+    paths = [p for r in roots for p in path_walk(r) if p.suffix == '.flac']
 
-    current_md5 = bytes.fromhex(value)
+    checked = {p.as_posix() for p in paths if _is_done(p, results)}
+    if checked:
+        print(f'info: resuming scan, {len(checked)} of {len(paths)} files already checked', file=stdout)
 
-    return ref_md5 == current_md5
+    results = {k: v for k, v in results.items() if k in checked}
+    pending = [p for p in paths if not p.as_posix() in checked]
+
+    _store_state(state_path, list(results.values()))
+
+    with open(state_path, mode='a', encoding='utf-8') as f:
+        with Pool(processes=jobs, initializer=_init_worker) as pool:
+            for result in pool.imap_unordered(_check_file, pending):
+                print(jdumps(asdict(result)), file=f, flush=True)
+
+                results[result.path] = result
+
+    state_path.unlink()
+
+    for result in sorted(results.values(), key=lambda r: r.path):
+        if result.status == ScanStatus.Corrupt.value:
+            print(f'warn: corrupt file: {result.path}: {result.message}', file=stderr)
+        elif result.status == ScanStatus.Unverifiable.value:
+            print(f'info: no MD5 signature: {result.path}', file=stdout)
+
+    return Counter(r.status for r in results.values())
 
 
 ##########################################################################################
@@ -79,7 +288,13 @@ def main(args: list[str]) -> int:
 
     parser = ArgumentParser(description='Helper to check MD5 signature of FLAC files.')
 
-    parser.add_argument('-f', '--file', help='FLAC file to check', required=True)
+    mode_group = parser.add_mutually_exclusive_group(required=True)
+
+    mode_group.add_argument('-f', '--file', help='FLAC file to check')
+    mode_group.add_argument('-r', '--root', action='append', help='Root directory to scan (can be repeated)')
+
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(), help='Number of files checked in parallel')
+    parser.add_argument('-s', '--state', type=Path, default=_default_state_path, help='Path of the scan state file')
 
     parsed_args = parser.parse_args(args[1:])
 
@@ -104,6 +319,42 @@ def main(args: list[str]) -> int:
 
             return 3
 
+    elif parsed_args.root is not None:
+        roots = [Path(r) for r in parsed_args.root]
+
+        for root in roots:
+            if not root.is_dir():
+                print(f'error: invalid root directory: {root}', file=stderr)
+
+                return 1
+
+        if parsed_args.jobs < 1:
+            print(f'error: invalid number of jobs: {parsed_args.jobs}', file=stderr)
+
+            return 1
+
+        signal(SIGTERM, _signal_handler)
+
+        try:
+            summary = flac_md5_scan(roots, parsed_args.jobs, parsed_args.state)
+
+        except KeyboardInterrupt:
+            print(f'info: scan interrupted, state kept in: {parsed_args.state}', file=stderr)
+
+            return 4
+
+        except Exception as exc:
+            print(f'error: error scanning FLAC files: {exc}', file=stderr)
+
+            return 2
+
+        num_ok, num_corrupt, num_unverifiable = (summary[s.value] for s in ScanStatus)
+
+        print(f'info: {num_ok} ok, {num_corrupt} corrupt, {num_unverifiable} unverifiable', file=stdout)
+
+        if num_corrupt != 0:
+            return 3
+
     return 0
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from dataclasses import dataclass
+from os import environ, stat_result
+from pathlib import Path
+from sqlite3 import connect as sqlite_connect
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Default location of the hash cache database.
+'''
+_default_path = Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'tjtools' / 'hashes.sqlite'
+
+'''
+Timeout (in seconds) when waiting for the database lock held by another process.
+'''
+_lock_timeout = 30.0
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (dev, ino, algorithm)
+)
+'''
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class StatKey:
+    '''
+    Dataclass encoding the identity and state of a file.
+
+    dev      - device ID of the filesystem
+    ino      - inode number
+    size     - filesize in bytes
+    mtime_ns - modification time in nanoseconds
+    ctime_ns - status change time in nanoseconds
+    '''
+
+    dev: int
+    ino: int
+    size: int
+    mtime_ns: int
+    ctime_ns: int
+
+    @staticmethod
+    def from_stat(st: stat_result) -> StatKey:
+        '''
+        Create a stat key from a stat result.
+
+        Arguments:
+            st - the stat result to use
+        '''
+
+        return StatKey(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class HashCache:
+    '''
+    Persistent on-disk cache of file digests.
+
+    Entries are looked up by device and inode, and are only considered valid as
+    long as size, mtime and ctime of the file are unchanged.
+
+    The cache is backed by a SQLite database. Objects of this class must only be
+    used from the thread that created them.
+    '''
+
+    def __init__(self, path: Path = None):
+        if path is None:
+            path = _default_path
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite_connect(path.as_posix(), timeout=_lock_timeout)
+        self._db.execute(_schema)
+
+    def __enter__(self) -> HashCache:
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def lookup(self, key: StatKey, algorithm: str) -> bytes:
+        '''
+        Lookup the digest of a file.
+
+        Arguments:
+            key       - stat key of the file
+            algorithm - name of the hash algorithm
+
+        Returns the cached digest, or None if no valid entry exists.
+        '''
+
+        query = 'SELECT size, mtime_ns, ctime_ns, digest FROM hashes WHERE dev = ? AND ino = ? AND algorithm = ?'
+
+        row = self._db.execute(query, (key.dev, key.ino, algorithm)).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, ctime_ns, digest = row
+        if (size, mtime_ns, ctime_ns) != (key.size, key.mtime_ns, key.ctime_ns):
+            return None
+
+        return digest
+
+    def store(self, key: StatKey, algorithm: str, digest: bytes) -> None:
+        '''
+        Store the digest of a file.
+
+        Arguments:
+            key       - stat key of the file
+            algorithm - name of the hash algorithm
+            digest    - the digest to store
+        '''
+
+        query = 'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+        self._db.execute(query, (key.dev, key.ino, key.size, key.mtime_ns, key.ctime_ns, algorithm, digest))
+
+    def commit(self) -> None:
+        '''
+        Commit pending changes to disk.
+        '''
+
+        self._db.commit()
+
+    def close(self) -> None:
+        '''
+        Commit pending changes and close the cache.
+        '''
+
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
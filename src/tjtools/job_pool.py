@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from dataclasses import dataclass
+from multiprocessing import Pool
+from os import cpu_count
+from threading import Condition
+from typing import Any, Callable
+
+from .jobserver import Jobserver, get_jobserver
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class PoolJob:
+    '''
+    Dataclass encoding a job of the pool.
+
+    args - arguments of the job function (the number of threads is appended)
+    cost - estimated cost of the job (e.g. the duration of an audio file)
+    '''
+
+    args: tuple
+    cost: float
+
+
+class JobPool:
+    '''
+    Process pool that runs jobs with a variable number of threads each.
+
+    The pool has a fixed budget of slots (usually one per core). Each running job
+    occupies as many slots as it uses threads, so the total number of threads never
+    exceeds the budget.
+
+    Jobs are started in order of decreasing cost. When a job is started, it gets a
+    share of the free slots that is proportional to its share of the remaining cost.
+    Many small jobs therefore run in parallel with a single thread each, while a few
+    large jobs run with several threads each. Mixed batches get a mix of both.
+
+    In addition, each thread needs a token from the jobserver, which limits the
+    total number of threads across all processes sharing the jobserver.
+    '''
+
+    def __init__(self, slots: int = None, max_threads: int = 1, jobserver: Jobserver = None):
+        if slots is None:
+            slots = cpu_count()
+
+        if jobserver is None:
+            jobserver = get_jobserver()
+
+        self._slots = max(slots, 1)
+        self._max_threads = min(max(max_threads, 1), self._slots)
+        self._jobserver = jobserver
+
+    def _get_threads(self, cost: float, remaining_cost: float, free_slots: int) -> int:
+        '''
+        Get the number of threads for a job that is started.
+
+        Arguments:
+            cost           - cost of the job
+            remaining_cost - cost of all jobs that are not yet started (including this one)
+            free_slots     - number of free slots
+        '''
+
+        if remaining_cost > 0.0:
+            threads = round(free_slots * cost / remaining_cost)
+        else:
+            threads = 1
+
+        return max(min(threads, self._max_threads, free_slots), 1)
+
+    def run(self, func: Callable, jobs: list[PoolJob], return_exceptions: bool = False) -> list[Any]:
+        '''
+        Run jobs in the pool.
+
+        Arguments:
+            func              - the job function
+            jobs              - list of the jobs
+            return_exceptions - return the exceptions of failed jobs as their results?
+
+        The job function is called with the job arguments, followed by the number
+        of threads the job should use.
+
+        Returns the list of job results, in the order of the jobs. If a job fails, the
+        remaining jobs are still run. Unless the exceptions are returned, the first
+        exception is raised afterwards.
+
+        If running the jobs is interrupted, the tokens of the running jobs are returned
+        to the jobserver before the pool is terminated.
+        '''
+
+        results = [None] * len(jobs)
+        errors = []
+
+        state = {'free': self._slots}
+        running = {}
+        condition = Condition()
+
+        def _release(index: int):
+            with condition:
+                tokens = running.pop(index, [])
+
+                self._jobserver.release(tokens)
+
+                state['free'] += len(tokens)
+                condition.notify_all()
+
+        def _on_result(index: int, result: Any):
+            results[index] = result
+            _release(index)
+
+        def _on_error(index: int, exc: BaseException):
+            results[index] = exc
+            errors.append(exc)
+            _release(index)
+
+        order = sorted(range(len(jobs)), key=lambda i: jobs[i].cost, reverse=True)
+        remaining_cost = sum(max(j.cost, 0.0) for j in jobs)
+
+        with Pool(processes=self._slots) as pool:
+            try:
+                for index in order:
+                    job = jobs[index]
+
+                    with condition:
+                        condition.wait_for(lambda: state['free'] > 0)
+
+                        threads = self._get_threads(max(job.cost, 0.0), remaining_cost, state['free'])
+
+                    remaining_cost -= max(job.cost, 0.0)
+
+                    '''
+                    Only wait for the first token, and run with fewer threads if the other
+                    processes sharing the jobserver hold the rest.
+                    '''
+                    tokens = self._jobserver.acquire(threads)
+
+                    with condition:
+                        running[index] = tokens
+                        state['free'] -= len(tokens)
+
+                    pool.apply_async(
+                        func,
+                        job.args + (len(tokens),),
+                        callback=lambda result, i=index: _on_result(i, result),
+                        error_callback=lambda exc, i=index: _on_error(i, exc),
+                    )
+
+                with condition:
+                    condition.wait_for(lambda: state['free'] == self._slots)
+
+            except BaseException:
+                pool.terminate()
+
+                with condition:
+                    for tokens in running.values():
+                        self._jobserver.release(tokens)
+
+                    running.clear()
+
+                raise
+
+            pool.close()
+            pool.join()
+
+        if errors and not return_exceptions:
+            raise errors[0]
+
+        return results
+
+    def run_groups(self, func: Callable, groups: list[list[PoolJob]]) -> list[list[BaseException]]:
+        '''
+        Run groups of jobs in the pool.
+
+        Arguments:
+            func   - the job function
+            groups - list of the job groups
+
+        Returns the list of exceptions of the failed jobs, for each group.
+
+        All jobs are run as a single batch, so the pool does not drain between
+        groups (e.g. the albums given on the command line).
+        '''
+
+        jobs = [j for g in groups for j in g]
+
+        results = iter(self.run(func, jobs, return_exceptions=True))
+
+        return [[r for r in (next(results) for _ in g) if isinstance(r, BaseException)] for g in groups]
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+'''
+NOTES:
+
+A jobserver limits the number of jobs that run concurrently across processes.
+A job needs a token to run, and returns the token when it is done.
+
+Two kinds of jobservers are supported:
+
+GNU make - when running below make (with the jobserver enabled), the tokens are
+           bytes in a pipe or a named FIFO, announced via --jobserver-auth in
+           MAKEFLAGS. Each process also owns one implicit token.
+token pool - otherwise, a tjtools-native pool of lock files in the runtime
+             directory is used. A token is a lock on one of the files, so the
+             tokens of a crashed process are released by the kernel.
+'''
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from contextlib import contextmanager
+from errno import EAGAIN, EWOULDBLOCK
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from functools import cache
+from os import (
+    O_CLOEXEC,
+    O_CREAT,
+    O_NONBLOCK,
+    O_RDONLY,
+    O_RDWR,
+    close,
+    cpu_count,
+    environ,
+    fstat,
+    getuid,
+    open as os_open,
+    pipe2,
+    read,
+    write,
+)
+from pathlib import Path
+from select import select
+from sys import stderr
+from threading import Lock
+from time import sleep
+from typing import Any, Generator
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Directory of the native token pool.
+'''
+_pool_path = Path(environ.get('XDG_RUNTIME_DIR', f'/run/user/{getuid()}')) / 'tjtools' / 'jobserver'
+
+'''
+Environment variable that overrides the size of the native token pool.
+'''
+_pool_size_variable = 'TJTOOLS_JOBS'
+
+'''
+Interval (in seconds) for polling the native token pool when all tokens are taken.
+'''
+_poll_interval = 0.05
+
+_implicit_token = object()
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+class Jobserver:
+    '''
+    Jobserver that hands out an unlimited number of tokens.
+
+    This is the base class of the actual jobservers, and is used if no jobserver
+    is available.
+    '''
+
+    def _acquire(self, block: bool) -> Any:
+        return _implicit_token
+
+    def _release(self, token: Any) -> None:
+        pass
+
+    def acquire(self, count: int) -> list[Any]:
+        '''
+        Acquire tokens.
+
+        Arguments:
+            count - the number of tokens wanted
+
+        Blocks until at least one token is available, and then takes as many
+        of the available tokens as wanted (up to count). Never waiting for more
+        than one token avoids deadlocks between processes.
+        '''
+
+        tokens = [self._acquire(block=True)]
+
+        while len(tokens) < count:
+            token = self._acquire(block=False)
+            if token is None:
+                break
+
+            tokens.append(token)
+
+        return tokens
+
+    def release(self, tokens: list[Any]) -> None:
+        '''
+        Release tokens.
+
+        Arguments:
+            tokens - list of the tokens
+        '''
+
+        for token in tokens:
+            self._release(token)
+
+    @contextmanager
+    def tokens(self, count: int) -> Generator[list[Any], None, None]:
+        '''
+        Context manager that holds tokens.
+
+        Arguments:
+            count - the number of tokens wanted
+
+        The tokens are released when leaving the context.
+        '''
+
+        tokens = self.acquire(count)
+
+        try:
+            yield tokens
+
+        finally:
+            self.release(tokens)
+
+
+class _MakeJobserver(Jobserver):
+    '''
+    Client of the GNU make jobserver.
+    '''
+
+    def __init__(self, read_fd: int, write_fd: int):
+        '''
+        Constructor.
+
+        Arguments:
+            read_fd  - file descriptor for reading tokens (non-blocking)
+            write_fd - file descriptor for writing tokens
+        '''
+
+        self._read_fd = read_fd
+        self._write_fd = write_fd
+        self._implicit_free = True
+        self._lock = Lock()
+
+        '''
+        Self-pipe that wakes up blocked acquires when the implicit token is released.
+        '''
+        self._wakeup_read_fd, self._wakeup_write_fd = pipe2(O_NONBLOCK | O_CLOEXEC)
+
+    def _acquire(self, block: bool) -> Any:
+        while True:
+            with self._lock:
+                if self._implicit_free:
+                    self._implicit_free = False
+
+                    return _implicit_token
+
+            try:
+                token = read(self._read_fd, 1)
+
+            except OSError as err:
+                if err.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+
+            else:
+                if not token:
+                    raise RuntimeError('jobserver closed by make')
+
+                return token
+
+            if not block:
+                return None
+
+            '''
+            Other clients might take the token between select() and read(), so retry.
+            '''
+            readable, _, _ = select([self._read_fd, self._wakeup_read_fd], [], [])
+
+            if self._wakeup_read_fd in readable:
+                try:
+                    read(self._wakeup_read_fd, 64)
+
+                except OSError as err:
+                    if err.errno not in (EAGAIN, EWOULDBLOCK):
+                        raise
+
+    def _release(self, token: Any) -> None:
+        if token is _implicit_token:
+            with self._lock:
+                self._implicit_free = True
+
+            try:
+                write(self._wakeup_write_fd, b'+')
+
+            except BlockingIOError:
+                '''
+                The pipe is full, so a wakeup is pending anyway.
+                '''
+                pass
+        else:
+            write(self._write_fd, token)
+
+
+class _TokenPool(Jobserver):
+    '''
+    Native token pool, shared by all tjtools processes of the user.
+    '''
+
+    def __init__(self, path: Path, size: int):
+        '''
+        Constructor.
+
+        Arguments:
+            path - directory of the lock files
+            size - the number of tokens
+        '''
+
+        path.mkdir(parents=True, exist_ok=True)
+
+        self._slots = [path / f'slot-{i}' for i in range(size)]
+        self._next = 0
+        self._lock = Lock()
+
+    def _try_slot(self, slot: Path) -> int:
+        fd = os_open(slot, O_RDWR | O_CREAT | O_CLOEXEC, 0o600)
+
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+
+        except OSError:
+            close(fd)
+
+            return None
+
+        return fd
+
+    def _acquire(self, block: bool) -> Any:
+        while True:
+            with self._lock:
+                '''
+                Start the search at different slots, to spread the lock files being probed.
+                '''
+                start = self._next
+                self._next = (self._next + 1) % len(self._slots)
+
+            for i in range(len(self._slots)):
+                fd = self._try_slot(self._slots[(start + i) % len(self._slots)])
+                if fd is not None:
+                    return fd
+
+            if not block:
+                return None
+
+            sleep(_poll_interval)
+
+    def _release(self, token: Any) -> None:
+        flock(token, LOCK_UN)
+        close(token)
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _parse_makeflags(makeflags: str) -> str:
+    '''
+    Get the jobserver authentication from MAKEFLAGS.
+
+    Arguments:
+        makeflags - value of MAKEFLAGS
+
+    Returns None if make does not announce a jobserver.
+    '''
+
+    auth = None
+
+    for arg in makeflags.split():
+        for prefix in ('--jobserver-auth=', '--jobserver-fds='):
+            if arg.startswith(prefix):
+                auth = arg[len(prefix):]
+
+    return auth
+
+def _open_make_jobserver(auth: str) -> Jobserver:
+    '''
+    Open the GNU make jobserver.
+
+    Arguments:
+        auth - the jobserver authentication (fifo:<path>, or <read fd>,<write fd>)
+
+    The read side is opened with its own (non-blocking) file description,
+    so that the file status flags of make and other clients are unchanged.
+    '''
+
+    if auth.startswith('fifo:'):
+        fifo = auth[len('fifo:'):]
+
+        read_fd = os_open(fifo, O_RDONLY | O_NONBLOCK | O_CLOEXEC)
+        write_fd = os_open(fifo, O_RDWR | O_CLOEXEC)
+
+        return _MakeJobserver(read_fd, write_fd)
+
+    read_fd, write_fd = (int(x) for x in auth.split(','))
+
+    if read_fd < 0 or write_fd < 0:
+        raise RuntimeError('jobserver disabled by make')
+
+    '''
+    The descriptors are only passed if make considers us as sub-make (e.g. by a '+' prefix).
+    '''
+    fstat(read_fd)
+    fstat(write_fd)
+
+    read_fd = os_open(f'/proc/self/fd/{read_fd}', O_RDONLY | O_NONBLOCK | O_CLOEXEC)
+
+    return _MakeJobserver(read_fd, write_fd)
+
+
+##########################################################################################
+# Functions
+##########################################################################################
+
+@cache
+def get_jobserver() -> Jobserver:
+    '''
+    Get the jobserver of this process.
+
+    The GNU make jobserver is used if make announces one. Otherwise the native token
+    pool is used, with one token per core (or as set by TJTOOLS_JOBS). If neither is
+    available, the tokens are unlimited.
+    '''
+
+    auth = _parse_makeflags(environ.get('MAKEFLAGS', ''))
+
+    if auth is not None:
+        try:
+            return _open_make_jobserver(auth)
+
+        except Exception as exc:
+            print(f'warn: failed to join make jobserver: {auth}: {exc}', file=stderr)
+
+    try:
+        size = int(environ.get(_pool_size_variable, cpu_count()))
+        if size < 1:
+            raise RuntimeError(f'invalid pool size: {size}')
+
+        return _TokenPool(_pool_path, size)
+
+    except Exception as exc:
+        print(f'warn: failed to open token pool: {exc}', file=stderr)
+
+    return Jobserver()
@@ -16,6 +16,10 @@ def checksum_cli() -> int:
     from .checksum import main as cli_main
     return cli_main(sys_argv)
 
+def checksum_scrub_cli() -> int:
+    from .checksum_scrub import main as cli_main
+    return cli_main(sys_argv)
+
 def clean_bashhistory_cli() -> int:
     from .clean_bashhistory import main as cli_main
     return cli_main(sys_argv)
@@ -2,18 +2,28 @@
 # SPDX-License-Identifier: GPL-2.0
 
 
+from __future__ import annotations
+
+
 ##########################################################################################
 # Imports
 ##########################################################################################
 
-from multiprocessing import Pool
+from dataclasses import asdict, dataclass
+from functools import cache
+from json import dump as jdump, load as jload
 from pathlib import Path
-from subprocess import DEVNULL, CalledProcessError, run as prun
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, run as prun
 from sys import stderr, stdout
 
 from magic import Magic
+from mutagen import File as AudioFile
+from mutagen.flac import FLAC
 
+from ...audio_compare import audio_fingerprint, decoder_chunks, spawn_decoder
 from ...common_util import StandardOutputProtector, path_walk
+from ...job_pool import JobPool, PoolJob
+from ...transcode_cache import TranscodeCache, transcode_key
 from ..rename_vfat import sanitize_vfat
 from .flac_encode import is_flac
 
@@ -23,6 +33,7 @@ from .flac_encode import is_flac
 ##########################################################################################
 
 _default_output = Path('/mnt/storage/transfer/fiio')
+_default_opus_output = Path('/mnt/storage/transfer/phone')
 
 
 ##########################################################################################
@@ -30,7 +41,11 @@ _default_output = Path('/mnt/storage/transfer/fiio')
 ##########################################################################################
 
 def _usage(app: str) -> None:
-    print(f'Usage: {app} [--tmpfs] <album directory> [<more album dirs>...]', file=stdout)
+    print(f'Usage: {app} [--tmpfs] [--mirror] [--targets=<target>,...] [--no-cache] [--cache-size=<GiB>] <album directory> [<more album dirs>...]', file=stdout)
+    print('\t--mirror: keep the output in sync with library roots (each subdirectory is an album)', file=stdout)
+    print(f'\t--targets: decode once and transcode to several targets ({", ".join(_targets)})', file=stdout)
+    print('\t--no-cache: do not use the transcode cache', file=stdout)
+    print(f'\t--cache-size: size limit of the transcode cache (default: {_cache_max_size >> 30} GiB)', file=stdout)
 
 
 ##########################################################################################
@@ -42,96 +57,809 @@ Ogg Vorbis encoding quality.
 '''
 _quality = 5.0
 
+'''
+Opus encoding bitrate (in kbit/s).
+'''
+_opus_bitrate = 128
+
+'''
+Identification of the encoder settings. Mirrored files transcoded with other
+settings are transcoded again.
+'''
+_encoder_settings = f'oggenc --quality={_quality}'
+
+'''
+Name of the mirror state file, which is placed in the output directory.
+'''
+_mirror_state_name = '.album_transcode.json'
+
+'''
+Default size limit (in bytes) of the transcode cache, which is pruned after each run.
+'''
+_cache_max_size = 16 << 30
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass(frozen=True)
+class _MirrorEntry:
+    '''
+    Dataclass encoding the source of a mirrored file.
+
+    source   - path of the source FLAC file
+    size     - filesize of the source in bytes
+    mtime_ns - modification time of the source in nanoseconds
+    md5      - MD5 signature (of the PCM samples) of the source as hex string
+    '''
+
+    source: str
+    size: int
+    mtime_ns: int
+    md5: str
+
+    def rename_key(self) -> tuple[int, int, str]:
+        '''
+        Get the key for recognizing a renamed source.
+
+        Renaming a file keeps its size and mtime, and the MD5 signature identifies
+        the audio content. Returns None if the source has no MD5 signature.
+        '''
+
+        if int(self.md5, 16) == 0:
+            return None
+
+        return (self.size, self.mtime_ns, self.md5)
+
+
+@dataclass(frozen=True)
+class _Target:
+    '''
+    Dataclass encoding a transcoding target.
+
+    label    - replaces "(FLAC)" in the name of the album directory
+    suffix   - suffix of the output files
+    output   - base path where album directories are created
+    encoder  - encoder arguments (reading WAV from stdin), '{output}' is replaced by the output path
+    settings - identification of the encoder settings (for the transcode cache)
+    '''
+
+    label: str
+    suffix: str
+    output: Path
+    encoder: tuple[str, ...]
+    settings: str
+
+    def encoder_args(self, output_path: Path) -> tuple[str, ...]:
+        return tuple(a.format(output=output_path.as_posix()) for a in self.encoder)
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Targets of the multi-target mode.
+'''
+_targets = {
+    'vorbis': _Target(
+        '(Vorbis)', '.ogg', _default_output,
+        ('oggenc', '--quiet', f'--quality={_quality}', '--output={output}', '-'),
+        _encoder_settings,
+    ),
+    'opus': _Target(
+        '(Opus)', '.opus', _default_opus_output,
+        ('opusenc', '--quiet', f'--bitrate={_opus_bitrate}', '-', '{output}'),
+        f'opusenc --bitrate={_opus_bitrate}',
+    ),
+}
+
 
 ##########################################################################################
 # Internal functions
 ##########################################################################################
 
-def _transcode(input_path: Path, output_path: Path) -> None:
+@cache
+def _get_encoder_version(encoder: str) -> str:
     '''
-    Internal transcode helper.
+    Get the version of an encoder.
+
+    Arguments:
+        encoder - name of the encoder executable
+    '''
+
+    p_args = (encoder, '--version')
+
+    p = prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+
+    return p.stdout.strip().splitlines()[0]
+
+def _get_cache_key(input_path: Path, settings: str, use_cache: bool) -> str:
+    '''
+    Get the transcode cache key of an input file.
+
+    Arguments:
+        input_path - path of the input file
+        settings   - identification of the encoder settings
+        use_cache  - use the transcode cache?
+
+    The MD5 signature of the FLAC file is used as hash of the PCM samples, so
+    that the file does not need to be decoded. Files without signature are
+    fingerprinted instead.
+
+    Returns None if the cache is not used, or (with a warning) if the key can
+    not be determined.
+    '''
+
+    if not use_cache:
+        return None
+
+    try:
+        info = FLAC(input_path.as_posix()).info
+
+        if info.md5_signature != 0:
+            md5 = info.md5_signature.to_bytes(length=16, byteorder='big')
+        else:
+            md5 = audio_fingerprint(input_path).md5
+
+        encoder = f'{settings} ({_get_encoder_version(settings.split()[0])})'
+
+        return transcode_key(md5, info.bits_per_sample, info.sample_rate, info.channels, encoder)
+
+    except Exception as exc:
+        print(f'warn: failed to get transcode cache key: {input_path.name}: {exc}', file=stderr)
+
+    return None
+
+def _fetch_cached(key: str, output_path: Path) -> bool:
+    '''
+    Fetch a transcoded file from the transcode cache.
+
+    Arguments:
+        key         - the cache key (can be None)
+        output_path - path of the output file
+
+    Returns True if the output file was created from the cache.
+    '''
+
+    if key is None:
+        return False
+
+    try:
+        return TranscodeCache().fetch(key, output_path)
+
+    except Exception as exc:
+        print(f'warn: failed to fetch from transcode cache: {output_path.name}: {exc}', file=stderr)
+
+        output_path.unlink(missing_ok=True)
+
+    return False
+
+def _store_cached(key: str, output_path: Path) -> None:
+    '''
+    Store a transcoded file in the transcode cache.
+
+    Arguments:
+        key         - the cache key (can be None)
+        output_path - path of the output file
+    '''
+
+    if key is None:
+        return
+
+    try:
+        TranscodeCache().store(key, output_path)
+
+    except Exception as exc:
+        print(f'warn: failed to store in transcode cache: {output_path.name}: {exc}', file=stderr)
+
+def _copy_tags(input_path: Path, output_path: Path) -> None:
+    '''
+    Replace the tags of a transcoded file with the tags of the input file.
 
     Arguments:
         input_path  - path of the input file
         output_path - path of the output file
     '''
 
-    print(f'info: processing: {input_path.name}', file=stdout)
+    src = FLAC(input_path.as_posix())
+    dst = AudioFile(output_path.as_posix())
+
+    if dst.tags is None:
+        dst.add_tags()
+    else:
+        dst.tags.clear()
+
+    if src.tags:
+        dst.tags += src.tags
+
+    dst.save()
+
+def _encode(input_path: Path, output_path: Path, tmp_path: Path, strict: bool, use_cache: bool) -> None:
+    '''
+    Internal helper that transcodes a file, or takes it from the transcode cache.
+
+    Arguments:
+        input_path  - path of the input file
+        output_path - path of the output file
+        tmp_path    - path where the output is created (moved to the output path when complete)
+        strict      - raise RuntimeError if transcoding fails (instead of a warning)
+        use_cache   - use the transcode cache?
+    '''
+
+    cache_key = _get_cache_key(input_path, _encoder_settings, use_cache)
+
+    if _fetch_cached(cache_key, tmp_path):
+        try:
+            _copy_tags(input_path, tmp_path)
+
+        except Exception as exc:
+            print(f'warn: transfer of tags failed, transcoding again: {input_path.name}: {exc}', file=stderr)
+
+            tmp_path.unlink(missing_ok=True)
+
+        else:
+            tmp_path.replace(output_path)
+
+            return
 
     p_args = (
         'oggenc',
         '--quiet',
         f'--quality={_quality}',
-        f'--output={output_path.as_posix()}',
+        f'--output={tmp_path.as_posix()}',
         input_path.as_posix()
     )
 
     try:
-        p = prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+        prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
 
     except CalledProcessError as err:
+        if strict:
+            tmp_path.unlink(missing_ok=True)
+
+            raise RuntimeError(f'transcoding failed: {input_path.name}: {err}') from err
+
         print(f'warn: transcoding failed: {input_path.name}: {err}')
         print(err.stdout)
 
-def _mk_output_directory(base_path: Path, album_path: Path) -> Path:
+        return
+
+    _store_cached(cache_key, tmp_path)
+
+    tmp_path.replace(output_path)
+
+def _transcode(input_path: Path, output_path: Path, use_cache: bool, threads: int = 1) -> None:
     '''
-    Make and create output directory.
+    Internal transcode helper.
+
+    Arguments:
+        input_path  - path of the input file
+        output_path - path of the output file
+        use_cache   - use the transcode cache?
+        threads     - number of threads (unused, oggenc is single-threaded)
+    '''
+
+    print(f'info: processing: {input_path.name}', file=stdout)
+
+    _encode(input_path, output_path, output_path, False, use_cache)
+
+def _mirror_transcode(input_path: Path, output_path: Path, use_cache: bool, threads: int = 1) -> None:
+    '''
+    Internal transcode helper for the mirror mode.
+
+    Arguments:
+        input_path  - path of the input file
+        output_path - path of the output file
+        use_cache   - use the transcode cache?
+        threads     - number of threads (unused, oggenc is single-threaded)
+
+    The output is replaced atomically, so that an interrupted sync never leaves
+    a truncated file in the mirror. Raises RuntimeError if transcoding fails.
+    '''
+
+    print(f'info: processing: {input_path.name}', file=stdout)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = output_path.with_name(f'.{output_path.name}.tmp')
+
+    _encode(input_path, output_path, tmp_path, True, use_cache)
+
+def _fan_out(input_path: Path, tmp_paths: list[tuple[str, Path]]) -> set[int]:
+    '''
+    Decode an input file once, and feed the samples to the encoders of several targets.
+
+    Arguments:
+        input_path - path of the input file
+        tmp_paths  - list of (target name, output path) tuples
+
+    Returns the set of the indices of the targets that failed.
+    '''
+
+    decoder_args = ('flac', '--decode', '--silent', '--stdout', input_path.as_posix())
+
+    decoder = spawn_decoder(decoder_args)
+    encoders = []
+
+    finished = False
+    failed = set()
+
+    try:
+        for name, tmp_path in tmp_paths:
+            p_args = _targets[name].encoder_args(tmp_path)
+
+            encoders.append(Popen(p_args, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL))
+
+        for chunk in decoder_chunks(decoder):
+            for i, encoder in enumerate(encoders):
+                if i in failed:
+                    continue
+
+                try:
+                    encoder.stdin.write(chunk)
+
+                except BrokenPipeError:
+                    failed.add(i)
+
+            if len(failed) == len(encoders):
+                break
+
+        else:
+            finished = True
+
+    finally:
+        if not finished and decoder.poll() is None:
+            decoder.kill()
+
+        decoder.stdout.close()
+        decoder.wait()
+
+        for i, encoder in enumerate(encoders):
+            try:
+                encoder.stdin.close()
+
+            except BrokenPipeError:
+                failed.add(i)
+
+            if not finished:
+                encoder.kill()
+
+            encoder.wait()
+
+    if decoder.returncode != 0:
+        failed.update(range(len(tmp_paths)))
+
+    for i, encoder in enumerate(encoders):
+        if encoder.returncode != 0:
+            failed.add(i)
+
+    return failed
+
+def _multi_transcode(input_path: Path, output_paths: tuple[tuple[str, Path], ...], use_cache: bool, threads: int = 1) -> None:
+    '''
+    Internal transcode helper for the multi-target mode.
+
+    Arguments:
+        input_path   - path of the input file
+        output_paths - tuple of (target name, output path) tuples
+        use_cache    - use the transcode cache?
+        threads      - number of threads (unused, the encoders run in parallel anyway)
+
+    Targets found in the transcode cache are taken from there. For the others, the
+    input is decoded a single time, and the samples are fed to the encoders of all
+    of them through pipes. The tags are copied to each output afterwards.
+    Raises RuntimeError if transcoding fails for any of the targets.
+    '''
+
+    print(f'info: processing: {input_path.name}', file=stdout)
+
+    tmp_paths = [p.with_name(f'.{p.name}.tmp') for _, p in output_paths]
+    cache_keys = [_get_cache_key(input_path, _targets[name].settings, use_cache) for name, _ in output_paths]
+
+    cached = {i for i, (key, p) in enumerate(zip(cache_keys, tmp_paths)) if _fetch_cached(key, p)}
+    pending = [i for i in range(len(output_paths)) if not i in cached]
+
+    failed = set()
+
+    if pending:
+        pending_failed = _fan_out(input_path, [(output_paths[i][0], tmp_paths[i]) for i in pending])
+
+        failed.update(pending[i] for i in pending_failed)
+
+    for i, ((name, output_path), tmp_path) in enumerate(zip(output_paths, tmp_paths)):
+        if i in failed:
+            tmp_path.unlink(missing_ok=True)
+
+            continue
+
+        if not i in cached:
+            _store_cached(cache_keys[i], tmp_path)
+
+        try:
+            _copy_tags(input_path, tmp_path)
+
+        except Exception as exc:
+            print(f'warn: transfer of tags failed: {input_path.name}: {name}: {exc}', file=stderr)
+
+            tmp_path.unlink(missing_ok=True)
+            failed.add(i)
+
+            continue
+
+        tmp_path.replace(output_path)
+
+    if failed:
+        names = ', '.join(output_paths[i][0] for i in sorted(failed))
+
+        raise RuntimeError(f'transcoding failed: {input_path.name}: {names}')
+
+def _mk_output_name(album_path: Path, label: str = '(Vorbis)') -> str:
+    '''
+    Make the name of the output directory of an album.
 
     Arguments:
-        base_path  - base path where directories are created
         album_path - path of the album
+        label      - label of the target that replaces "(FLAC)"
     '''
 
     name_sanitized = sanitize_vfat(album_path.name)
 
-    output_dir = base_path / Path(name_sanitized.replace('(FLAC)', '(Vorbis)'))
+    return name_sanitized.replace('(FLAC)', label)
+
+def _mk_output_directory(base_path: Path, album_path: Path, label: str = '(Vorbis)') -> Path:
+    '''
+    Make and create output directory.
+
+    Arguments:
+        base_path  - base path where directories are created
+        album_path - path of the album
+        label      - label of the target that replaces "(FLAC)"
+    '''
+
+    output_dir = base_path / Path(_mk_output_name(album_path, label))
 
     output_dir.mkdir(parents=True)
 
     return output_dir
 
-def _mk_output_path(base_path: Path, entry_path: Path) -> Path:
+def _mk_output_path(base_path: Path, entry_path: Path, suffix: str = '.ogg') -> Path:
     '''
     Make output path for an album file.
 
     Arguments:
         base_path  - base path where files are created
         name   - name of the album file
+        suffix - suffix of the output file
     '''
 
     entry_stem = entry_path.stem
 
-    return base_path / Path(f'{sanitize_vfat(entry_stem)}.ogg')
+    return base_path / Path(f'{sanitize_vfat(entry_stem)}{suffix}')
+
+def _get_jobs(tmpfs: bool, album_path: Path, use_cache: bool) -> list[PoolJob]:
+    '''
+    Get the transcoding jobs for an album, and create its output directory.
+
+    Arguments:
+        tmpfs      - use tmpfs as output
+        album_path - path of the album
+        use_cache  - use the transcode cache?
+    '''
+
+    if not album_path.is_dir():
+        raise RuntimeError('album path is not a directory')
+
+    mime = Magic(mime=True)
+
+    output_dir = _mk_output_directory(Path('/tmp') if tmpfs else _default_output, album_path)
+
+    print(f'info: transcoding album: {album_path} -> {output_dir}', file=stdout)
+
+    return [PoolJob((x, _mk_output_path(output_dir, x), use_cache), x.stat().st_size) for x in path_walk(album_path) if is_flac(mime, x)]
+
+def _get_multi_jobs(tmpfs: bool, album_path: Path, targets: list[str], use_cache: bool) -> list[PoolJob]:
+    '''
+    Get the multi-target transcoding jobs for an album, and create its output directories.
+
+    Arguments:
+        tmpfs      - use tmpfs as output
+        album_path - path of the album
+        targets    - list of the target names
+        use_cache  - use the transcode cache?
+    '''
+
+    if not album_path.is_dir():
+        raise RuntimeError('album path is not a directory')
+
+    mime = Magic(mime=True)
+
+    output_dirs = []
+
+    for name in targets:
+        target = _targets[name]
+
+        base_path = Path('/tmp') / name if tmpfs else target.output
+        output_dir = _mk_output_directory(base_path, album_path, target.label)
+
+        print(f'info: transcoding album: {album_path} -> {output_dir}', file=stdout)
+
+        output_dirs.append((name, output_dir, target.suffix))
+
+    jobs = []
+
+    for x in path_walk(album_path):
+        if not is_flac(mime, x):
+            continue
+
+        output_paths = tuple((n, _mk_output_path(d, x, s)) for n, d, s in output_dirs)
+
+        jobs.append(PoolJob((x, output_paths, use_cache), x.stat().st_size))
+
+    return jobs
+
+def _load_mirror_state(path: Path) -> dict[str, _MirrorEntry]:
+    '''
+    Load the mirror state.
+
+    Arguments:
+        path - path of the state file
+
+    Returns a dictionary of the mirrored files, keyed by their path relative to
+    the output directory. Files transcoded with other encoder settings are dropped,
+    i.e. they are treated like orphans.
+    '''
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = jload(f)
+
+    except FileNotFoundError:
+        return {}
+
+    entries = {k: _MirrorEntry(**v) for k, v in state['entries'].items()}
+
+    if state['settings'] != _encoder_settings:
+        print('info: encoder settings changed, transcoding all files again', file=stdout)
+
+        return {k: _MirrorEntry(v.source, -1, -1, '0') for k, v in entries.items()}
+
+    return entries
+
+def _store_mirror_state(path: Path, entries: dict[str, _MirrorEntry]) -> None:
+    '''
+    Store the mirror state.
+
+    Arguments:
+        path    - path of the state file
+        entries - dictionary of the mirrored files
+
+    The state file is replaced atomically.
+    '''
+
+    state = {
+        'settings': _encoder_settings,
+        'entries': {k: asdict(v) for k, v in sorted(entries.items())},
+    }
+
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        jdump(state, fp=f, indent=4)
+
+    tmp_path.replace(path)
+
+def _get_mirror_entry(path: Path, known: _MirrorEntry) -> _MirrorEntry:
+    '''
+    Get the mirror entry of a source file.
+
+    Arguments:
+        path  - path of the source file
+        known - the entry from the mirror state (None if there is none)
+
+    The MD5 signature is only read if the source changed.
+    '''
+
+    st = path.stat()
+
+    if known is not None and (known.source, known.size, known.mtime_ns) == (path.as_posix(), st.st_size, st.st_mtime_ns):
+        return known
+
+    md5 = FLAC(path.as_posix()).info.md5_signature
+
+    return _MirrorEntry(path.as_posix(), st.st_size, st.st_mtime_ns, f'{md5:032x}')
+
+def _remove_output(base_path: Path, rel_path: str) -> None:
+    '''
+    Remove a mirrored file, and its directory if that becomes empty.
+
+    Arguments:
+        base_path - path of the output directory
+        rel_path  - path of the file relative to the output directory
+    '''
+
+    output_path = base_path / rel_path
+
+    output_path.unlink(missing_ok=True)
+
+    try:
+        output_path.parent.rmdir()
+
+    except OSError:
+        pass
 
 
 ##########################################################################################
 # Functions
 ##########################################################################################
 
-def album_transcode(tmpfs: bool, album_path: Path) -> None:
+def prune_cache(max_size: int) -> None:
+    '''
+    Prune the transcode cache.
+
+    Arguments:
+        max_size - the size limit in bytes
+
+    The least recently used entries are removed first. Errors only cause a warning.
+    '''
+
+    try:
+        num_removed = TranscodeCache().prune(max_size)
+
+    except Exception as exc:
+        print(f'warn: failed to prune transcode cache: {exc}', file=stderr)
+
+        return
+
+    if num_removed != 0:
+        print(f'info: removed {num_removed} entries from transcode cache', file=stdout)
+
+def album_transcode(tmpfs: bool, album_path: Path, use_cache: bool = True) -> None:
     '''
     Transcode FLAC album to Ogg Vorbis.
 
     Arguments:
         tmpfs      - use tmpfs as output
         album_path - path of the album
+        use_cache  - use the transcode cache?
     '''
 
-    if not album_path.is_dir():
-        raise RuntimeError('album path is not a directory')
+    JobPool().run(_transcode, _get_jobs(tmpfs, album_path, use_cache))
+
+def album_mirror(tmpfs: bool, roots: list[Path], use_cache: bool = True) -> int:
+    '''
+    Keep a mirror of FLAC albums in Ogg Vorbis in sync.
+
+    Arguments:
+        tmpfs     - use tmpfs as output
+        roots     - list of library roots (each subdirectory is an album)
+        use_cache - use the transcode cache?
+
+    Returns the number of files that failed to transcode (including sources that
+    could not be read).
+
+    The mirror state (in the output directory) records the source of each mirrored
+    file. Only new or changed sources are transcoded, mirrored files of renamed
+    sources are renamed, and mirrored files without source are removed. Files in
+    the output directory that are not in the mirror state are left alone.
+
+    Only mirrored files whose source was below one of the given roots can become
+    orphans, so syncing a subset of the roots leaves the others alone. A root
+    without any album (e.g. an unmounted library) is refused.
+    '''
+
+    base_path = Path('/tmp') if tmpfs else _default_output
+    base_path.mkdir(parents=True, exist_ok=True)
+
+    state_path = base_path / _mirror_state_name
+
+    entries = _load_mirror_state(state_path)
 
     mime = Magic(mime=True)
 
-    output_dir = _mk_output_directory(Path('/tmp') if tmpfs else _default_output, album_path)
+    '''
+    The files that should be in the mirror, keyed by their path relative to the output directory.
+    '''
+    wanted = {}
 
-    print(f'info: transcoding album: {album_path} -> {output_dir}', file=stdout)
+    '''
+    Sources that could not be read. Their mirrored files are kept as they are.
+    '''
+    skipped = set()
+
+    for root in roots:
+        if not root.is_dir():
+            raise RuntimeError(f'library root is not a directory: {root}')
+
+        album_paths = sorted(p for p in root.iterdir() if p.is_dir())
+        if not album_paths:
+            raise RuntimeError(f'library root has no albums (not mounted?): {root}')
+
+        for album_path in album_paths:
+            album_name = _mk_output_name(album_path)
+
+            for x in sorted(path_walk(album_path)):
+                if not is_flac(mime, x):
+                    continue
+
+                rel_path = _mk_output_path(Path(album_name), x).as_posix()
+
+                if rel_path in wanted:
+                    print(f'warn: skipping source with conflicting output: {x}', file=stderr)
+
+                    continue
+
+                try:
+                    wanted[rel_path] = _get_mirror_entry(x, entries.get(rel_path))
+
+                except Exception as exc:
+                    print(f'warn: skipping unreadable source: {x}: {exc}', file=stderr)
+
+                    skipped.add(rel_path)
+
+    pending = {k: v for k, v in wanted.items() if entries.get(k) != v or not (base_path / k).is_file()}
+    scanned_roots = [r.resolve() for r in roots]
+
+    def _is_scanned(entry: _MirrorEntry) -> bool:
+        source = Path(entry.source).resolve()
+
+        return any(source.is_relative_to(r) for r in scanned_roots)
+
+    orphans = {k: v for k, v in entries.items() if not k in wanted and not k in skipped and _is_scanned(v)}
+
+    num_renamed = 0
+
+    renamed_sources = {v.rename_key(): k for k, v in orphans.items() if v.rename_key() is not None}
+
+    for rel_path, entry in list(pending.items()):
+        old_rel_path = renamed_sources.pop(entry.rename_key(), None)
+        if old_rel_path is None or not (base_path / old_rel_path).is_file():
+            continue
 
-    pool_args = [(x, _mk_output_path(output_dir, x)) for x in path_walk(album_path) if is_flac(mime, x)]
+        output_path = base_path / rel_path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with Pool() as pool:
-        pool.starmap(_transcode, pool_args)
-        pool.close()
-        pool.join()
+        (base_path / old_rel_path).replace(output_path)
+        _remove_output(base_path, old_rel_path)
+
+        del orphans[old_rel_path]
+        del entries[old_rel_path]
+        del pending[rel_path]
+
+        entries[rel_path] = entry
+        num_renamed += 1
+
+    for rel_path in orphans:
+        print(f'info: removing orphan: {rel_path}', file=stdout)
+
+        _remove_output(base_path, rel_path)
+
+        del entries[rel_path]
+
+    _store_mirror_state(state_path, entries)
+
+    jobs = [PoolJob((Path(v.source), base_path / k, use_cache), v.size) for k, v in pending.items()]
+
+    results = JobPool().run(_mirror_transcode, jobs, return_exceptions=True)
+
+    num_failed = 0
+
+    for (rel_path, entry), result in zip(pending.items(), results):
+        if isinstance(result, BaseException):
+            print(f'warn: {result}', file=stderr)
+
+            num_failed += 1
+        else:
+            entries[rel_path] = entry
+
+    _store_mirror_state(state_path, entries)
+
+    num_unchanged = len(wanted) - len(pending) - num_renamed
+
+    print(f'info: {len(jobs) - num_failed} transcoded, {num_renamed} renamed, {len(orphans)} removed, {num_unchanged} unchanged, {len(skipped)} unreadable', file=stdout)
+
+    return num_failed + len(skipped)
 
 
 ##########################################################################################
@@ -152,30 +880,117 @@ def main(args: list[str]) -> int:
         return 0
 
     use_tmpfs = False
+    use_mirror = False
+    use_cache = True
+    cache_size = _cache_max_size
+    targets = None
+
+    albums = args[1:]
+
+    while albums and albums[0].startswith('--'):
+        if albums[0] == '--tmpfs':
+            use_tmpfs = True
+        elif albums[0] == '--mirror':
+            use_mirror = True
+        elif albums[0].startswith('--targets='):
+            targets = albums[0][len('--targets='):].split(',')
+        elif albums[0] == '--no-cache':
+            use_cache = False
+        elif albums[0].startswith('--cache-size='):
+            try:
+                cache_size = int(float(albums[0][len('--cache-size='):]) * (1 << 30))
+
+            except ValueError:
+                cache_size = -1
+
+            if cache_size < 0:
+                print(f'error: invalid cache size: {albums[0]}', file=stderr)
 
-    if args[1] == '--tmpfs':
-        if len(args) < 3:
+                return 2
+        elif albums[0] == '--':
+            albums = albums[1:]
+
+            break
+        else:
+            print(f'error: unknown option: {albums[0]}', file=stderr)
             _usage(args[0])
 
-            return 0
+            return 2
 
-        use_tmpfs = True
-        albums = args[2:]
-    else:
-        albums = args[1:]
+        albums = albums[1:]
+
+    if not albums:
+        _usage(args[0])
+
+        return 0
+
+    if targets is not None:
+        for name in targets:
+            if not name in _targets:
+                print(f'error: unknown target: {name}', file=stderr)
+
+                return 2
+
+        if len(set(targets)) != len(targets):
+            print('error: duplicate targets', file=stderr)
+
+            return 2
+
+        if use_mirror:
+            print('error: mirror mode only supports the default target', file=stderr)
+
+            return 2
+
+    if use_mirror:
+        with StandardOutputProtector():
+            try:
+                num_failed = album_mirror(use_tmpfs, [Path(a) for a in albums], use_cache)
+
+            except Exception as exc:
+                print(f'error: mirror sync failed: {exc}', file=stderr)
+
+                return 2
+
+            if use_cache:
+                prune_cache(cache_size)
+
+        return 1 if num_failed != 0 else 0
 
     transcode_error = False
 
+    '''
+    Collect the jobs of all albums first, and run them in a single pool, so that
+    the pool does not drain at the boundaries between the albums.
+    '''
+    groups = []
+
     with StandardOutputProtector():
         for album in albums:
             try:
-                album_transcode(use_tmpfs, Path(album))
+                if targets is None:
+                    groups.append((album, _get_jobs(use_tmpfs, Path(album), use_cache)))
+                else:
+                    groups.append((album, _get_multi_jobs(use_tmpfs, Path(album), targets, use_cache)))
 
             except Exception as exc:
                 print(f'warn: error occured while transcoding: {album}: {exc}', file=stderr)
 
                 transcode_error = True
 
+        if targets is None:
+            pool, transcode_func = JobPool(), _transcode
+        else:
+            pool, transcode_func = JobPool(max_threads=len(targets)), _multi_transcode
+
+        for (album, _), errors in zip(groups, pool.run_groups(transcode_func, [g for _, g in groups])):
+            for exc in errors:
+                print(f'warn: error occured while transcoding: {album}: {exc}', file=stderr)
+
+                transcode_error = True
+
+        if use_cache:
+            prune_cache(cache_size)
+
         if transcode_error:
             return 1
 
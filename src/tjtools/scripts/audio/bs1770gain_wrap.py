@@ -19,6 +19,7 @@ from xml.dom.minidom import Element as XMLElement, parseString as xml_parse
 from magic import Magic
 
 from ...id3_addtag import is_mp3, id3_addtag
+from ...jobserver import get_jobserver
 from ...mp4_addtag import mp4_addtag
 from ...vc_addtag import TagEntry, vc_addtag
 
@@ -96,7 +97,8 @@ def bs1770gain(path: Path) -> None:
     p_args = _bs1770_template + (path.as_posix(),)
 
     try:
-        p = prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+        with get_jobserver().tokens(1):
+            p = prun(p_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
 
     except CalledProcessError as err:
         raise RuntimeError(f'bs1770gain CLI failed: {err}') from err
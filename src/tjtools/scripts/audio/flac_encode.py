@@ -6,17 +6,17 @@
 # Imports
 ##########################################################################################
 
-from multiprocessing import Pool
+from functools import cache
 from pathlib import Path
-from shutil import move
 from subprocess import DEVNULL, run as prun
 from sys import stderr, stdout
-from tempfile import TemporaryDirectory
 
 from magic import Magic
+from mutagen.wave import WAVE
 
-from ...audio_compare import audio_compare
+from ...audio_compare import reference_compare
 from ...common_util import StandardOutputProtector, path_walk
+from ...job_pool import JobPool, PoolJob
 
 
 ##########################################################################################
@@ -28,6 +28,32 @@ Distance (in seconds) between seekpoints that are placed in newly encoded FLAC f
 '''
 _seekpoint_distance = 25
 
+'''
+Size (in bytes) of a single seekpoint, and of a metadata block header.
+'''
+_seekpoint_size = 18
+_block_header_size = 4
+
+'''
+Padding (in bytes) reserved for tags, in addition to the space for the seektable.
+'''
+_tag_padding = 8192
+
+'''
+Maximum number of threads used by a single encoder instance.
+'''
+_max_encoder_threads = 8
+
+'''
+Identification of the encoder profiles: the reference encoder if more than one thread
+is granted (and it supports multithreading), and flake otherwise. These need to be changed together with the encoder
+arguments, so that reflac picks up files encoded with the previous settings.
+'''
+_flake_settings = f'flake -12 seekpoints={_seekpoint_distance}s'
+_flac_mt_settings = f'flac -8 seekpoints={_seekpoint_distance}s'
+
+_encoder_settings = (_flake_settings, _flac_mt_settings)
+
 
 ##########################################################################################
 # Internal functions
@@ -36,13 +62,66 @@ _seekpoint_distance = 25
 def _usage(app: str) -> None:
     print(f'Usage: {app} <file or directory item> [<another item>...]', file=stdout)
 
-def _encode(path: Path, verbose: bool) -> None:
+def _get_padding(path: Path) -> int:
+    '''
+    Get the padding needed for adding the seektable (and tags) after encoding.
+
+    Arguments:
+        path - path to the input WAV file
+
+    metaflac places new metadata blocks into the padding, as long as it is large enough.
+    This avoids rewriting the whole file when adding the seektable.
+    '''
+
+    length = WAVE(path.as_posix()).info.length
+
+    num_seekpoints = int(length // _seekpoint_distance) + 1
+
+    return _block_header_size + num_seekpoints * _seekpoint_size + _tag_padding
+
+def _get_length(path: Path) -> float:
+    '''
+    Get the duration (in seconds) of a WAV file, for scheduling the encoding.
+
+    Arguments:
+        path - path to the WAV file
+    '''
+
+    try:
+        return WAVE(path.as_posix()).info.length
+
+    except Exception:
+        return 0.0
+
+@cache
+def _has_threaded_flac() -> bool:
+    '''
+    Check if the reference encoder supports multithreaded encoding.
+    '''
+
+    try:
+        p = prun(('flac', '--help'), stdin=DEVNULL, capture_output=True, encoding='utf-8')
+
+    except OSError:
+        return False
+
+    return '--threads' in p.stdout
+
+def _encode(path: Path, verbose: bool, threads: int = 1) -> str:
     '''
     Internal encoding helper.
 
     Arguments:
         path    - path to input file
         verbose - enable verbose output?
+        threads - number of encoder threads
+
+    Returns the identification of the encoder settings used.
+
+    The multithreaded reference encoder is only used if more than one thread is
+    granted, and flake otherwise. flake -12 compresses slightly better than flac -8,
+    so single-threaded encodes keep the smaller output, while the reference encoder
+    trades some size for the speedup on long files.
     '''
 
     path_stem = path.stem
@@ -54,28 +133,77 @@ def _encode(path: Path, verbose: bool) -> None:
     if verbose:
         print(f'info: processing: {path.name}', file=stdout)
 
-    with TemporaryDirectory() as tmp:
-        tmp_path = Path(tmp)
+    '''
+    Encode next to the final output, so that moving the result in place is a rename.
+    '''
+    encoding_output = output_path.with_name(f'.{output_path.name}.tmp')
+
+    use_flake = threads <= 1 or not _has_threaded_flac()
+
+    try:
+        if use_flake:
+            encoder_args = ('flake', '-q', '-12', '-p', str(_get_padding(path)), path.as_posix(), '-o', encoding_output.as_posix())
+        else:
+            encoder_args = (
+                'flac',
+                '--silent',
+                '-8',
+                f'--threads={threads}',
+                f'--seekpoint={_seekpoint_distance}s',
+                f'--padding={_tag_padding}',
+                f'--output-name={encoding_output.as_posix()}',
+                path.as_posix(),
+            )
+
+        prun(encoder_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+
+        if not reference_compare(path, encoding_output):
+            raise RuntimeError('mismatch between original source and reference decoding')
 
-        encoding_output = tmp_path / Path('output.flac')
-        reference_output = tmp_path / Path('reference.wav')
+        if use_flake:
+            '''
+            flake doesn't add a seektable by default, so add one here. The seektable fits
+            into the padding, so only the metadata is rewritten.
+            '''
+            seekpoint_args = ('metaflac', f'--add-seekpoint={_seekpoint_distance}s', encoding_output.as_posix())
+            prun(seekpoint_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
 
-        flake_args = ('flake', '-q', '-12', path.as_posix(), '-o', encoding_output.as_posix())
-        prun(flake_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+        encoding_output.replace(output_path)
 
-        decode_args = ('flac', '--decode', '--silent', f'--output-name={reference_output.as_posix()}', encoding_output.as_posix())
-        prun(decode_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+    except Exception:
+        encoding_output.unlink(missing_ok=True)
 
-        if not audio_compare(path, reference_output):
-            raise RuntimeError('mismatch between original source and reference decoding')
+        raise
+
+    return _flake_settings if use_flake else _flac_mt_settings
+
+def _get_jobs(path: Path, verbose: bool) -> list[PoolJob]:
+    '''
+    Get the encoding jobs for a file or directory item.
+
+    Arguments:
+        path    - path of the item
+        verbose - enable verbose output?
+    '''
+
+    mime = Magic(mime=True)
+
+    if path.is_dir():
+        if verbose:
+            print(f'info: encoding directory: {path}', file=stdout)
+
+        return [PoolJob((x, True), _get_length(x)) for x in path_walk(path) if is_wav(mime, x)]
+
+    if path.is_file():
+        if not is_wav(mime, path):
+            raise RuntimeError('invalid file content (expected WAV)')
+
+        if verbose:
+            print(f'info: encoding file: {path}', file=stdout)
 
-        '''
-        flake doesn't add a seektable by default, so add one here.
-        '''
-        seekpoint_args = ('metaflac', f'--add-seekpoint={_seekpoint_distance}s', encoding_output.as_posix())
-        prun(seekpoint_args, check=True, stdin=DEVNULL, capture_output=True, encoding='utf-8')
+        return [PoolJob((path, False), _get_length(path))]
 
-        move(encoding_output.as_posix(), output_path.as_posix())
+    raise RuntimeError(f'invalid argument type: {path.stat().st_mode}')
 
 
 ##########################################################################################
@@ -116,15 +244,35 @@ def is_flac(m: Magic, path: Path) -> bool:
 
     return True
 
-def flac_encode(path: Path, verbose: bool) -> None:
+def encoder_settings() -> tuple[str, ...]:
+    '''
+    Get the identifications of the current encoder settings.
+
+    Files encoded with any of these settings do not need to be encoded again.
+    '''
+
+    return _encoder_settings
+
+def encoder_threads() -> int:
+    '''
+    Get the maximum number of threads that a single encoding can use.
+    '''
+
+    return _max_encoder_threads if _has_threaded_flac() else 1
+
+def flac_encode(path: Path, verbose: bool, threads: int = 1) -> str:
     '''
     Encode a single WAV file to FLAC.
 
     Arguments:
         path    - path to file which we want to encode
         verbose - enable verbose output?
+        threads - number of encoder threads
+
+    Returns the identification of the encoder settings used.
 
-    Encoding is done using the flake encoder. After encoding the resulting file is decoded
+    Encoding is done using the multithreaded reference encoder if more than one
+    thread is granted (and it is available), and the flake encoder otherwise. After encoding the resulting file is decoded
     with the reference decoder and compared against the original file.
     '''
 
@@ -138,7 +286,7 @@ def flac_encode(path: Path, verbose: bool) -> None:
     if verbose:
         print(f'info: encoding file: {path}', file=stdout)
 
-    _encode(path, False)
+    return _encode(path, False, threads)
 
 def flac_encode_dir(path: Path, verbose: bool) -> None:
     '''
@@ -147,22 +295,15 @@ def flac_encode_dir(path: Path, verbose: bool) -> None:
     Arguments:
         path    - path of directory which we want to encode
         verbose - enable verbose output?
+
+    The number of encoder threads per file is adapted to the number and duration
+    of the files, so that a few long files also use all cores.
     '''
 
     if not path.is_dir():
         raise RuntimeError(f'path is not a directory: {path}')
 
-    mime = Magic(mime=True)
-
-    if verbose:
-        print(f'info: encoding directory: {path}', file=stdout)
-
-    pool_args = [(x, True) for x in path_walk(path) if is_wav(mime, x)]
-
-    with Pool() as pool:
-        pool.starmap(_encode, pool_args)
-        pool.close()
-        pool.join()
+    JobPool(max_threads=encoder_threads()).run(_encode, _get_jobs(path, verbose))
 
 
 ##########################################################################################
@@ -184,6 +325,12 @@ def main(args: list[str]) -> int:
 
     encoding_error = False
 
+    '''
+    Collect the jobs of all items first, and run them in a single pool, so that
+    the pool does not drain at the boundaries between the items.
+    '''
+    groups = []
+
     with StandardOutputProtector():
         for arg in args[1:]:
             path = Path(arg)
@@ -194,18 +341,21 @@ def main(args: list[str]) -> int:
                 continue
 
             try:
-                if path.is_dir():
-                    flac_encode_dir(path, True)
-                elif path.is_file():
-                    flac_encode(path, True)
-                else:
-                    raise RuntimeError(f'invalid argument type: {path.stat().st_mode}')
+                groups.append((path, _get_jobs(path, True)))
 
             except Exception as exc:
                 print(f'warn: error occured while encoding: {path}: {exc}', file=stderr)
 
                 encoding_error = True
 
+        pool = JobPool(max_threads=encoder_threads())
+
+        for (path, _), errors in zip(groups, pool.run_groups(_encode, [g for _, g in groups])):
+            for exc in errors:
+                print(f'warn: error occured while encoding: {path}: {exc}', file=stderr)
+
+                encoding_error = True
+
     if encoding_error:
         return 1
     
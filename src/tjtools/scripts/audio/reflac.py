@@ -6,7 +6,7 @@
 # Imports
 ##########################################################################################
 
-from multiprocessing import Pool
+from argparse import ArgumentParser
 from pathlib import Path
 from shutil import move
 from subprocess import DEVNULL, CalledProcessError, run as prun
@@ -14,20 +14,100 @@ from sys import stderr, stdout
 from tempfile import TemporaryDirectory
 
 from magic import Magic
+from mutagen.flac import FLAC
 
 from ...common_util import StandardOutputProtector, path_walk
-from ...audio_compare import audio_compare
+from ...audio_compare import audio_compare, carry_fingerprint
 from ...flac_md5 import flac_md5
-from .flac_encode import flac_encode, is_flac
+from ...hash_cache import StatKey
+from ...job_pool import JobPool, PoolJob
+from ...jobserver import get_jobserver
+from .flac_encode import encoder_settings, encoder_threads, flac_encode, is_flac
 from .vc_copytags import vc_copytags
 
 
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Tag that records the encoder settings of re-encoded files.
+'''
+_marker_tag = 'TJTOOLS_ENCODER'
+
+
 ##########################################################################################
 # Internal functions
 ##########################################################################################
 
-def _usage(app: str) -> None:
-    print(f'Usage: {app} <file or directory item> [<another item>...]', file=stdout)
+def _get_marker(settings: str, vendor: str) -> str:
+    '''
+    Get the value of the marker tag for a re-encoded file.
+
+    Arguments:
+        settings - identification of the encoder settings
+        vendor   - vendor string of the file
+
+    The vendor string is part of the marker, so that files that were re-encoded by
+    some other tool afterwards (keeping the tags) are not mistaken as up-to-date.
+    '''
+
+    return f'{settings} ({vendor})'
+
+def _set_marker(path: Path, settings: str) -> None:
+    '''
+    Record the encoder settings in a re-encoded file.
+
+    Arguments:
+        path     - path to the re-encoded file
+        settings - identification of the encoder settings
+    '''
+
+    flac = FLAC(path.as_posix())
+
+    if flac.tags is None:
+        flac.add_tags()
+
+    flac[_marker_tag] = _get_marker(settings, flac.tags.vendor)
+    flac.save()
+
+def _get_length(path: Path) -> float:
+    '''
+    Get the duration (in seconds) of a FLAC file, for scheduling the re-encoding.
+
+    Arguments:
+        path - path to the FLAC file
+    '''
+
+    try:
+        return FLAC(path.as_posix()).info.length
+
+    except Exception:
+        return 0.0
+
+def _is_up_to_date(path: Path) -> bool:
+    '''
+    Check if a FLAC file is already encoded with the current settings.
+
+    Arguments:
+        path - path to the FLAC file
+
+    This only reads the metadata of the file, i.e. it is cheap compared to
+    re-encoding the file.
+    '''
+
+    try:
+        flac = FLAC(path.as_posix())
+
+    except Exception:
+        return False
+
+    if flac.tags is None or flac.seektable is None or not flac.seektable.seekpoints:
+        return False
+
+    markers = [[_get_marker(s, flac.tags.vendor)] for s in encoder_settings()]
+
+    return flac.get(_marker_tag) in markers
 
 def _decode_verify(input: Path, output: Path) -> None:
     '''
@@ -73,17 +153,24 @@ def _decode_verify(input: Path, output: Path) -> None:
 
         raise RuntimeError(f'decoding failed: {input}: {err_msg}')
 
-def _re_encode(path: Path, verbose: bool) -> None:
+def _re_encode(path: Path, verbose: bool, threads: int = 1) -> None:
     '''
     Internal recoding helper.
 
     Arguments:
-        path - path to input file
+        path    - path to input file
+        verbose - enable verbose output?
+        threads - number of encoder threads
+
+    The re-encoded file has the same audio content as the input, so a cached
+    fingerprint of the input is carried over to it.
     '''
 
     if verbose:
         print(f'info: processing: {path.name}', file=stdout)
 
+    key = StatKey.from_stat(path.stat())
+
     with TemporaryDirectory() as tmp:
         tmp_path = Path(tmp)
 
@@ -92,26 +179,67 @@ def _re_encode(path: Path, verbose: bool) -> None:
 
         try:
             _decode_verify(path, decoding_output)
-            flac_encode(decoding_output, False)
+            settings = flac_encode(decoding_output, False, threads)
             vc_copytags(path, encoding_output)
+            _set_marker(encoding_output, settings)
 
         except Exception as exc:
             raise RuntimeError(f're-encode failed: {path}: {exc}') from exc
 
         move(encoding_output.as_posix(), path.as_posix())
 
+    carry_fingerprint(key, path)
+
+def _get_jobs(path: Path, verbose: bool, force: bool) -> list[PoolJob]:
+    '''
+    Get the recoding jobs for a file or directory item.
+
+    Arguments:
+        path    - path of the item
+        verbose - enable verbose output?
+        force   - re-encode even files that are up-to-date?
+
+    Files that are up-to-date are skipped without decoding them.
+    '''
+
+    mime = Magic(mime=True)
+
+    if path.is_dir():
+        if verbose:
+            print(f'info: re-encoding directory: {path}', file=stdout)
+
+        flac_files = [x for x in path_walk(path) if is_flac(mime, x)]
+    elif path.is_file():
+        if not is_flac(mime, path):
+            raise RuntimeError('invalid file content (expected FLAC)')
+
+        if verbose:
+            print(f'info: recoding file: {path}', file=stdout)
+
+        flac_files = [path]
+    else:
+        raise RuntimeError(f'invalid argument type: {path.stat().st_mode}')
+
+    jobs = [PoolJob((x, True), _get_length(x)) for x in flac_files if force or not _is_up_to_date(x)]
+
+    if verbose and len(jobs) != len(flac_files):
+        print(f'info: skipping {len(flac_files) - len(jobs)} up-to-date files', file=stdout)
+
+    return jobs
+
 
 ##########################################################################################
 # Functions
 ##########################################################################################
 
-def reflac(path: Path, verbose: bool) -> None:
+def reflac(path: Path, verbose: bool, force: bool = False) -> None:
     '''
     Recode a single FLAC file.
 
     Arguments:
         path    - path to file which we want to re-encode
         verbose - enable verbose output?
+        force   - re-encode even if the file is up-to-date?
     '''
 
     if not path.is_file():
@@ -121,34 +249,35 @@ def reflac(path: Path, verbose: bool) -> None:
     if not is_flac(mime, path):
         raise RuntimeError('invalid file content (expected FLAC)')
 
+    if not force and _is_up_to_date(path):
+        if verbose:
+            print(f'info: skipping up-to-date file: {path}', file=stdout)
+
+        return
+
     if verbose:
         print(f'info: recoding file: {path}', file=stdout)
 
-    _re_encode(path, verbose=True)
+    with get_jobserver().tokens(encoder_threads()) as tokens:
+        _re_encode(path, True, len(tokens))
 
-def reflac_dir(path: Path, verbose: bool) -> None:
+def reflac_dir(path: Path, verbose: bool, force: bool = False) -> None:
     '''
     Recode all FLAC files in a directory.
 
     Arguments:
         path    - path to directory which we want to re-encode
         verbose - enable verbose output?
+        force   - re-encode even files that are up-to-date?
+
+    Files that are up-to-date are skipped without decoding them. The number of
+    encoder threads per file is adapted to the number and duration of the files.
     '''
 
     if not path.is_dir():
         raise RuntimeError(f'path is not a directory: {path}')
 
-    mime = Magic(mime=True)
-
-    if verbose:
-        print(f'info: re-encoding directory: {path}', file=stdout)
-
-    pool_args = [(x, True) for x in path_walk(path) if is_flac(mime, x)]
-
-    with Pool() as pool:
-        pool.starmap(_re_encode, pool_args)
-        pool.close()
-        pool.join()
+    JobPool(max_threads=encoder_threads()).run(_re_encode, _get_jobs(path, verbose, force))
 
 
 ##########################################################################################
@@ -163,15 +292,23 @@ def main(args: list[str]) -> int:
         args - list of string arguments from the CLI
     '''
 
-    if len(args) < 2:
-        _usage(args[0])
+    parser = ArgumentParser(description='Re-encode FLAC files with verification.')
 
-        return 0
+    parser.add_argument('items', nargs='+', help='File or directory items to re-encode')
+    parser.add_argument('-f', '--force', action='store_true', help='Re-encode files that are already up-to-date')
+
+    parsed_args = parser.parse_args(args[1:])
 
     recoding_error = False
 
+    '''
+    Collect the jobs of all items first, and run them in a single pool, so that
+    the pool does not drain at the boundaries between the items.
+    '''
+    groups = []
+
     with StandardOutputProtector():
-        for arg in args[1:]:
+        for arg in parsed_args.items:
             path = Path(arg)
 
             if not path.exists():
@@ -180,18 +317,21 @@ def main(args: list[str]) -> int:
                 continue
 
             try:
-                if path.is_dir():
-                    reflac_dir(path, verbose=True)
-                elif path.is_file():
-                    reflac(path, verbose=True)
-                else:
-                    raise RuntimeError(f'invalid argument type: {path.stat().st_mode}')
+                groups.append((path, _get_jobs(path, True, parsed_args.force)))
 
             except Exception as exc:
                 print(f'warn: error occured while recoding: {path}: {exc}', file=stderr)
 
                 recoding_error = True
 
+        pool = JobPool(max_threads=encoder_threads())
+
+        for (path, _), errors in zip(groups, pool.run_groups(_re_encode, [g for _, g in groups])):
+            for exc in errors:
+                print(f'warn: error occured while recoding: {path}: {exc}', file=stderr)
+
+                recoding_error = True
+
     if recoding_error:
         return 1
 
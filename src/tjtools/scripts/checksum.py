@@ -2,20 +2,144 @@
 # SPDX-License-Identifier: GPL-2.0
 
 
+from __future__ import annotations
+
+
 ##########################################################################################
 # Imports
 ##########################################################################################
 
-from dataclasses import dataclass
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from enum import Enum, auto
+from errno import EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
+from functools import cache, partial
+from itertools import islice
 from getopt import getopt, GetoptError
-from hashlib import file_digest
-from multiprocessing import Pool
+from hashlib import md5, sha256
+from json import dumps as jdumps
+from mmap import PAGESIZE
 from os.path import basename, dirname, exists, isdir, isfile, realpath, splitext, join as pjoin
-from os import listdir, rename, remove
+from os import copy_file_range, cpu_count, fstat, fsync, listdir, major, minor, mkdir, rename, remove, stat, walk
+from pathlib import Path
+from posixpath import basename as tar_basename, dirname as tar_dirname
 from re import compile as rcompile
-from subprocess import DEVNULL, CalledProcessError, run as prun
+from shutil import copy2, copystat, rmtree
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, run as prun
 from sys import stderr, stdout
+from tarfile import open as tar_open
 from tempfile import NamedTemporaryFile
+from threading import Event, Lock, Thread, current_thread
+from time import monotonic, perf_counter
+from typing import Any, Callable, Generator
+from zlib import crc32
+
+from ..binary_manifest import BinaryManifest, is_binary_data, is_binary_manifest, write_binary_manifest
+from ..file_reader import FileReader, IOMode, ReadStats, calibrate, get_io_profile
+from ..hash_cache import HashCache, StatKey
+from ..sysfs_helper import get_backing_devices, get_block_device, read_sysfs
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Number of concurrent read streams per rotational disk backing a filesystem.
+'''
+_rotational_streams = 2
+
+'''
+Number of concurrent read streams for filesystems on solid state storage.
+'''
+_solid_state_streams = cpu_count() or 1
+
+'''
+Number of concurrent read streams for filesystems whose storage could not
+be determined (e.g. network filesystems).
+'''
+_fallback_streams = 4
+
+'''
+Algorithm name used for entries in the hash cache.
+'''
+_cache_algorithm = 'sha256'
+
+'''
+Header line of version 2 (chunked) SHA checksum files, followed by the chunk size.
+'''
+_sha_v2_header = '#tjtools-sha v2 chunk-size='
+
+'''
+Chunk size (in bytes) used when writing version 2 SHA checksum files.
+'''
+_default_chunk_size = 1 << 26
+
+'''
+Names of the I/O modes that can be selected from the CLI.
+'''
+_io_modes = {
+    'buffered': IOMode.Buffered,
+    'nocache': IOMode.NoCache,
+    'direct': IOMode.Direct,
+}
+
+'''
+Read statistics accumulated over all files hashed by this process.
+'''
+_read_stats = ReadStats()
+
+'''
+Interval (in seconds) between two updates of the live progress.
+'''
+_progress_interval = 1.0
+
+'''
+Number of entries of a checksum file that are verified in one batch. This bounds
+the memory use when checking huge binary checksum files.
+'''
+_verify_batch_size = 4096
+
+'''
+Report formats that can be selected from the CLI.
+'''
+_report_formats = ('text', 'json')
+
+
+##########################################################################################
+# Enumerator definitions
+##########################################################################################
+
+class CacheMode(Enum):
+    '''
+    Modes for using the persistent hash cache.
+
+    Update - hash all files and record the results in the cache
+    Trust  - skip hashing of files whose stat key matches a cache entry
+    Scrub  - ignore the cache completely
+    '''
+
+    Update = auto()
+    Trust  = auto()
+    Scrub  = auto()
+
+class _CheckStatus(Enum):
+    '''
+    Verification status of a single file.
+
+    Ok       - checksum matches
+    Mismatch - checksum does not match
+    Missing  - file is listed in the checksum file, but does not exist
+    Extra    - file exists, but is not listed in the checksum file
+    Unknown  - checksum of the file is not in the checksum file (under any filename)
+    '''
+
+    Ok       = auto()
+    Mismatch = auto()
+    Missing  = auto()
+    Extra    = auto()
+    Unknown  = auto()
 
 
 ##########################################################################################
@@ -23,10 +147,266 @@ from tempfile import NamedTemporaryFile
 ##########################################################################################
 
 @dataclass(frozen=True)
-class _SHATuple:
+class SHATuple:
+    '''
+    Dataclass encoding an entry of a SHA checksum file.
+
+    filesize   - filesize in bytes
+    hash       - SHA-256 of the file (the root hash for chunked entries)
+    filename   - name of the file
+    chunks     - SHA-256 of each chunk (None for unchunked entries)
+    chunk_size - size of the chunks (0 for unchunked entries)
+    '''
+
     filesize: int
     hash: bytes
     filename: str
+    chunks: tuple[bytes] = None
+    chunk_size: int = 0
+
+@dataclass(frozen=True)
+class _HashResult:
+    sha: SHATuple
+    key: StatKey
+    crc32: int = None
+    md5: bytes = None
+
+@dataclass(frozen=True)
+class _CheckResult:
+    filename: str
+    status: _CheckStatus
+
+@dataclass(frozen=True)
+class _CheckJob:
+    index: int
+    base_dir: str
+    ref: SHATuple
+    chunk: int = None
+
+@dataclass
+class _ChunkState:
+    remaining: int
+    keys: set[StatKey] = field(default_factory=set)
+    failed: bool = False
+    unreadable: bool = False
+
+@dataclass
+class _ArchiveDirectory:
+    refs: dict[str, SHATuple] = None
+    pending: dict[str, tuple[int, dict[int, bytes]]] = field(default_factory=dict)
+    members: set[str] = field(default_factory=set)
+    num_files: int = 0
+    num_bytes: int = 0
+    errors: list[str] = field(default_factory=list)
+
+@dataclass
+class _ManifestResult:
+    path: str
+    num_files: int = 0
+    num_bytes: int = 0
+    num_cached: int = 0
+    errors: list[str] = field(default_factory=list)
+
+
+@dataclass
+class _IOMetrics:
+    '''
+    Throughput metrics of a device or worker.
+
+    num_bytes   - number of bytes hashed
+    num_files   - number of files hashed
+    read_time   - time (in seconds) spent waiting for data
+    digest_time - time (in seconds) spent hashing
+    '''
+
+    num_bytes: int = 0
+    num_files: int = 0
+    read_time: float = 0.0
+    digest_time: float = 0.0
+
+    def as_dict(self, elapsed: float) -> dict[str, Any]:
+        '''
+        Get the metrics as dictionary, including derived rates.
+
+        Arguments:
+            elapsed - the elapsed wall-clock time of the run
+        '''
+
+        busy_time = self.read_time + self.digest_time
+
+        return {
+            'bytes': self.num_bytes,
+            'files': self.num_files,
+            'read_time': self.read_time,
+            'digest_time': self.digest_time,
+            'throughput': self.num_bytes / busy_time if busy_time > 0.0 else 0.0,
+            'files_per_second': self.num_files / elapsed if elapsed > 0.0 else 0.0,
+        }
+
+
+class _Metrics:
+    '''
+    Per-device and per-worker metrics of a run (thread-safe).
+    '''
+
+    def __init__(self):
+        self.start = monotonic()
+        self.devices = dict()
+        self.workers = dict()
+        self.total = _IOMetrics()
+
+        self._lock = Lock()
+
+    def add(self, dev: int, num_bytes: int, num_files: int, read_time: float, digest_time: float) -> None:
+        '''
+        Account hashed data of the current worker.
+
+        Arguments:
+            dev         - the device ID of the filesystem
+            num_bytes   - number of bytes hashed
+            num_files   - number of files hashed
+            read_time   - time spent waiting for data
+            digest_time - time spent hashing
+        '''
+
+        with self._lock:
+            device = self.devices.setdefault(dev, _IOMetrics())
+            worker = self.workers.setdefault(current_thread().name, _IOMetrics())
+
+            for m in (device, worker, self.total):
+                m.num_bytes += num_bytes
+                m.num_files += num_files
+                m.read_time += read_time
+                m.digest_time += digest_time
+
+    def report(self) -> dict[str, Any]:
+        '''
+        Get a report of all metrics.
+        '''
+
+        elapsed = monotonic() - self.start
+
+        with self._lock:
+            devices = []
+
+            for dev, m in sorted(self.devices.items()):
+                block_device = get_block_device(dev)
+
+                entry = {
+                    'device': f'{major(dev)}:{minor(dev)}',
+                    'name': None if block_device is None else block_device.name,
+                }
+                entry.update(m.as_dict(elapsed))
+
+                devices.append(entry)
+
+            workers = []
+
+            for name, m in sorted(self.workers.items()):
+                entry = {'worker': name}
+                entry.update(m.as_dict(elapsed))
+
+                workers.append(entry)
+
+            total = self.total.as_dict(elapsed)
+
+        return {
+            'elapsed': elapsed,
+            'bytes_disk': _read_stats.bytes_disk,
+            'bytes_cache': _read_stats.bytes_cache,
+            'total': total,
+            'devices': devices,
+            'workers': workers,
+        }
+
+
+class _Progress:
+    '''
+    Live progress output on stderr.
+
+    The progress is only shown if stderr is a terminal.
+    '''
+
+    def __init__(self):
+        self._stop = Event()
+        self._thread = None
+
+    def __enter__(self) -> _Progress:
+        if stderr.isatty():
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+
+            print('\r\033[K', end='', file=stderr, flush=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(_progress_interval):
+            total = _metrics.total
+            elapsed = monotonic() - _metrics.start
+
+            rate = total.num_bytes / elapsed / (1 << 20)
+            msg = f'progress: {total.num_files} files, {total.num_bytes >> 20} MiB, {rate:.1f} MiB/s'
+
+            print(f'\r\033[K{msg}', end='', file=stderr, flush=True)
+
+
+class _CRC32:
+    '''
+    Minimal hash object wrapper around zlib.crc32().
+    '''
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = crc32(data, self.value)
+
+class _ChunkedSHA256:
+    '''
+    Hash object computing the root hash of a chunked SHA tuple.
+    '''
+
+    def __init__(self, chunk_size: int):
+        self._chunk_size = chunk_size
+        self._chunks = []
+        self._hash = sha256()
+        self._length = 0
+
+    def update(self, data: bytes) -> None:
+        view = memoryview(data)
+
+        while view:
+            length = min(len(view), self._chunk_size - self._length)
+
+            self._hash.update(view[:length])
+            self._length += length
+
+            view = view[length:]
+
+            if self._length == self._chunk_size:
+                self._chunks.append(self._hash.digest())
+                self._hash = sha256()
+                self._length = 0
+
+    def digest(self) -> bytes:
+        chunks = self._chunks
+
+        if self._length != 0:
+            chunks = chunks + [self._hash.digest()]
+
+        return _chunk_root(chunks)
+
+
+'''
+Metrics accumulated over all files hashed by this process.
+'''
+_metrics = _Metrics()
 
 
 ##########################################################################################
@@ -34,18 +414,38 @@ class _SHATuple:
 ##########################################################################################
 
 def _usage(app: str):
-    print(f'Usage: {app} --sha-scan|--sha-check|--sfv-check|--sfv-migrate', file=stdout)
+    print(f'Usage: {app} --sha-scan|--sha-check|--sha-check-tree|--sha-pack|--sha-unpack|--archive-check|--copy-verify|--sfv-check|--sfv-migrate|--calibrate', file=stdout)
 
     msg = '''
 \t --sha-scan <directory>
 \t --sha-check <SHA checksum file>
+\t --sha-check-tree <root directory>
+\t --sha-pack <SHA checksum file> [convert to a binary (.shb) checksum file with a lookup index]
+\t --sha-unpack <binary SHA checksum file> [convert back to a text (.sha) checksum file]
+\t --archive-check <tar.zst archive> [verify the SHA checksum files inside an archive, without extracting it]
+\t --copy-verify <source directory> <destination> [copy a directory, verifying the copy against its SHA checksum]
 \t --sfv-check <SFV checksum file>
-\t --sfv-migrate <SFV checksum file>'''
+\t --sfv-migrate <SFV checksum file>
+\t --md5-check <MD5 checksum file>
+\t --calibrate <sample file> [benchmark and store the I/O profile for the filesystem of the sample]
+
+\t --chunked [write a chunked (version 2) SHA checksum file, allowing parallel hashing of big files]
+\t --trust-cache [skip re-hashing of files that are unchanged according to the hash cache]
+\t --scrub [ignore the hash cache and re-hash all files]
+\t --external [use cksfv and md5deep for SFV and MD5 checks]
+\t --io-mode=buffered|nocache|direct [keep the page cache intact with nocache or direct]
+\t --report=text|json [print per-device and per-worker throughput metrics, JSON is printed as the last line]'''
 
     print(msg, file=stdout)
 
 def _filter(arg: str) -> bool:
-    filters = ('.m3u', '.sha', '.sfv', '.md5')
+    filters = ('.m3u', '.sha', '.shb', '.sfv', '.md5')
+
+    '''
+    Temporary file of an interrupted write of a binary checksum file.
+    '''
+    if arg.startswith('.') and arg.endswith('.shb.tmp'):
+        return True
 
     split_arg = splitext(arg)
 
@@ -109,208 +509,1864 @@ def _parse_sfv(arg) -> list:
         if len(arg) != 0 and not comment_re.match(arg):
             res = checksum_re.findall(arg)
 
-            if len(res) == 1:
-                return res[0]
+            if len(res) == 1:
+                return res[0]
+
+    crc_re = rcompile('[0-9a-fA-F]{1,8}')
+
+    with open(arg, encoding='utf-8') as f:
+        sfv = [i for i in map(match_sfv, f.read().splitlines()) if i is not None]
+
+    for name, crc in sfv:
+        if not crc_re.fullmatch(crc):
+            raise RuntimeError(f'invalid CRC32 value: {name}: {crc}')
+
+    return sfv
+
+def _parse_md5(arg) -> list:
+    checksum_re = rcompile(r'\s*([0-9a-fA-F]{32})\s+\*?(.+\S)')
+
+    def match_md5(arg):
+        res = checksum_re.fullmatch(arg)
+
+        if res is not None:
+            return (res.group(2), res.group(1))
+
+    with open(arg, encoding='utf-8') as f:
+        md5_list = [i for i in map(match_md5, f.read().splitlines()) if i is not None]
+
+    return md5_list
+
+def _parse_sha_line(arg: str) -> SHATuple:
+    tmp = arg.strip().split(' ', maxsplit=1)
+
+    if not tmp[0].isdigit():
+        raise RuntimeError(f'malformed SHA line: {tmp[0]}')
+
+    filesize = int(tmp[0])
+
+    tmp = tmp[1].strip().split(' ', maxsplit=1)
+
+    try:
+        hash_bytes = bytes.fromhex(tmp[0])
+
+    except Exception as exc:
+        raise RuntimeError(f'malformed SHA line: {tmp[0]}: {exc}') from exc
+
+    filename = tmp[1].strip()
+
+    return SHATuple(filesize, hash_bytes, filename)
+
+def _format_sha_line(t: SHATuple) -> str:
+    '''
+    Format a SHA tuple as a line of a SHA checksum file.
+
+    Arguments:
+        t - the SHA tuple to format
+
+    The format matches the output of sha256deep in bare mode with filesizes
+    enabled (-b -z), i.e. a right-aligned size, the hex digest and the filename.
+    '''
+
+    return f'{t.filesize:10d}  {t.hash.hex()}  {t.filename}\n'
+
+def _format_sha_entry(t: SHATuple) -> str:
+    '''
+    Format a SHA tuple as an entry of a SHA checksum file.
+
+    Arguments:
+        t - the SHA tuple to format
+
+    For chunked tuples, the line is followed by one line per chunk hash.
+    '''
+
+    entry = _format_sha_line(t)
+
+    if t.chunks is not None:
+        entry += ''.join(f'+{c.hex()}\n' for c in t.chunks)
+
+    return entry
+
+def _num_chunks(filesize: int, chunk_size: int) -> int:
+    return (filesize + chunk_size - 1) // chunk_size
+
+def _chunk_root(chunks: list[bytes]) -> bytes:
+    '''
+    Compute the root hash of a file from its chunk hashes.
+
+    Arguments:
+        chunks - list of chunk hashes
+
+    The root hash of an empty file is the SHA-256 of no data, same as in
+    the unchunked format.
+    '''
+
+    return sha256(b''.join(chunks)).digest()
+
+def _parse_sha_v2(raw_lines: list[str]) -> list[SHATuple]:
+    '''
+    Parse the lines of a version 2 (chunked) SHA checksum file.
+
+    Arguments:
+        raw_lines - the lines of the file, including the header
+
+    Each entry has the same format as in version 1, with the root hash in
+    place of the file hash. The entry is followed by the chunk hashes, one
+    per line and prefixed with '+'.
+    '''
+
+    header = raw_lines[0]
+
+    try:
+        chunk_size = int(header[len(_sha_v2_header):])
+
+    except ValueError as exc:
+        raise RuntimeError(f'malformed SHA header: {header}') from exc
+
+    if chunk_size <= 0 or chunk_size % PAGESIZE != 0:
+        raise RuntimeError(f'invalid chunk size: {chunk_size}')
+
+    entries = []
+
+    for line in raw_lines[1:]:
+        if not line.startswith('+'):
+            entries.append((_parse_sha_line(line), []))
+
+            continue
+
+        if not entries:
+            raise RuntimeError(f'chunk hash without entry: {line}')
+
+        try:
+            entries[-1][1].append(bytes.fromhex(line[1:]))
+
+        except ValueError as exc:
+            raise RuntimeError(f'malformed chunk hash: {line}: {exc}') from exc
+
+    sha_tuples = []
+
+    for t, chunks in entries:
+        if len(chunks) != _num_chunks(t.filesize, chunk_size) or _chunk_root(chunks) != t.hash:
+            raise RuntimeError(f'inconsistent chunk hashes for: {t.filename}')
+
+        sha_tuples.append(SHATuple(t.filesize, t.hash, t.filename, tuple(chunks), chunk_size))
+
+    return sha_tuples
+
+def _parse_sha_lines(raw_lines: list[str]) -> list[SHATuple]:
+    if raw_lines and raw_lines[0].startswith(_sha_v2_header):
+        return _parse_sha_v2(raw_lines)
+
+    return [_parse_sha_line(line) for line in raw_lines]
+
+def _iter_sha(arg: str) -> Generator[SHATuple, None, None]:
+    '''
+    Iterate over the entries of a SHA checksum file.
+
+    Arguments:
+        arg - path of the checksum file
+
+    Binary checksum files are read lazily, one entry at a time. Text checksum
+    files are parsed completely first, since their entries need to be validated.
+    '''
+
+    if is_binary_manifest(arg):
+        with BinaryManifest(arg) as manifest:
+            for entry in manifest:
+                yield SHATuple(*entry)
+
+        return
+
+    with open(arg, encoding='utf-8') as f:
+        raw_lines = f.read().splitlines()
+
+    yield from _parse_sha_lines(raw_lines)
+
+def _find_sha_manifest(arg: str) -> str:
+    '''
+    Find the SHA checksum file of a directory.
+
+    Arguments:
+        arg - the directory
+
+    Returns None if the directory has no, or more than one, checksum file.
+    '''
+
+    manifests = [m for m in find_manifests(arg) if dirname(m) == arg]
+
+    if len(manifests) != 1:
+        return None
+
+    return manifests[0]
+
+def _find_unlisted(base_dir: str, manifest: str, sha_tuples: list[SHATuple]) -> list[str]:
+    '''
+    Find files in a directory without a (unique) SHA checksum.
+
+    Arguments:
+        base_dir   - the directory to check
+        manifest   - path of the SHA checksum file
+        sha_tuples - the SHA tuples of the checksum file (not needed for binary checksum files)
+
+    Binary checksum files are queried through their index, which
+    guarantees unique entries.
+    '''
+
+    if is_binary_manifest(manifest):
+        with BinaryManifest(manifest) as listed:
+            return [f for f in listdir(base_dir) if not _filter(f) and not f in listed]
+
+    counts = Counter(arg.filename for arg in sha_tuples)
+
+    return [f for f in listdir(base_dir) if not _filter(f) and counts[f] != 1]
+
+def _try_singlefile(arg):
+    filters = ('.sfv', '.md5')
+
+    working = dirname(arg)
+
+    split_base = splitext(basename(arg))
+    if len(split_base) != 2:
+        return None
+
+    sfv = _parse_sfv(arg)
+    if len(sfv) != 1:
+        print('error: singlefile check failed: multiple entries in SFV', file=stderr)
+
+        return None
+
+    ref_split = splitext(sfv[0][0])
+    if ref_split[0] != split_base[0]:
+        print('error: singlefile check failed: filename mismatch', file=stderr)
+
+        return None
+
+    ref_found = False
+    filelist = []
+
+    for f in listdir(working):
+        split_f = splitext(f)
+
+        if len(split_f) != 2 or split_f[0] != split_base[0]:
+            continue
+
+        if split_f[1] in filters:
+            filelist.append(f)
+        elif f == sfv[0][0]:
+            ref_found = True
+            filelist.append(f)
+
+    if not ref_found:
+        return None
+
+    return filelist
+
+def _open_cache(mode: CacheMode) -> HashCache:
+    '''
+    Open the hash cache for a given cache mode.
+
+    Arguments:
+        mode - the cache mode
+
+    Returns None if the cache should be ignored or is not available.
+    '''
+
+    if mode == CacheMode.Scrub:
+        return None
+
+    try:
+        cache = HashCache()
+
+    except Exception as exc:
+        print(f'warn: hash cache not available: {exc}', file=stderr)
+
+        return None
+
+    return cache
+
+def _get_cache_algorithm(t: SHATuple) -> str:
+    '''
+    Get the algorithm name used in the hash cache for a SHA tuple.
+
+    Arguments:
+        t - the SHA tuple
+
+    Root hashes of chunked tuples depend on the chunk size, so they
+    are stored separately.
+    '''
+
+    if t.chunks is None:
+        return _cache_algorithm
+
+    return f'{_cache_algorithm}-chunked-{t.chunk_size}'
+
+def _is_cached(cache: HashCache, base_dir: str, t: SHATuple) -> bool:
+    '''
+    Check if the hash cache has a valid entry matching a SHA tuple.
+
+    Arguments:
+        cache    - the hash cache
+        base_dir - the directory containing the file
+        t        - the SHA tuple to check
+    '''
+
+    try:
+        key = StatKey.from_stat(stat(pjoin(base_dir, t.filename)))
+
+    except OSError:
+        return False
+
+    if key.size != t.filesize:
+        return False
+
+    return cache.lookup(key, _get_cache_algorithm(t)) == t.hash
+
+def _cache_results(cache: HashCache, results: list[_HashResult]) -> None:
+    '''
+    Record hash results in the hash cache.
+
+    Arguments:
+        cache   - the hash cache
+        results - list of hash results
+    '''
+
+    for r in results:
+        if r.key is not None:
+            cache.store(r.key, _get_cache_algorithm(r.sha), r.sha.hash)
+
+@cache
+def _resolve_device(dev: int) -> tuple[Path, ...] | int:
+    '''
+    Resolve the device ID of a filesystem to the physical disks backing it.
+
+    Arguments:
+        dev - the device ID of the filesystem
+
+    Returns the sysfs paths of the disks, or the device ID if the disks could
+    not be resolved (e.g. for network filesystems).
+    '''
+
+    block_device = get_block_device(dev)
+    if block_device is None:
+        return dev
+
+    return tuple(sorted(set(get_backing_devices(block_device))))
+
+@cache
+def _device_streams(device: tuple[Path, ...] | int) -> int:
+    '''
+    Get the number of concurrent read streams for a device.
+
+    Arguments:
+        device - the device, as returned by _get_device()
+    '''
+
+    if isinstance(device, int):
+        return _fallback_streams
+
+    num_rotational = sum(1 for d in device if read_sysfs(d / 'queue' / 'rotational') == '1')
+
+    if num_rotational != 0:
+        return min(num_rotational * _rotational_streams, _solid_state_streams)
+
+    return _solid_state_streams
+
+def _get_device(base_dir: str, filename: str) -> tuple[Path, ...] | int:
+    '''
+    Get the device a file is read from.
+
+    Arguments:
+        base_dir - the directory containing the file
+        filename - name of the file
+
+    The device is identified by the physical disks backing the filesystem, so that
+    files on different partitions (or mounts) of the same disk share one device.
+    If the disks could not be resolved, the device ID of the filesystem is used.
+
+    Falls back to the base directory if the file does not exist.
+    Returns -1 if the device could not be determined.
+    '''
+
+    for path in (pjoin(base_dir, filename), base_dir):
+        try:
+            dev = stat(path).st_dev
+
+        except OSError:
+            continue
+
+        return _resolve_device(dev)
+
+    return -1
+
+def _device_name(device: tuple[Path, ...] | int) -> str:
+    '''
+    Get a short name of a device, e.g. for naming worker threads.
+
+    Arguments:
+        device - the device, as returned by _get_device()
+    '''
+
+    if not isinstance(device, int):
+        return '+'.join(d.name for d in device)
+
+    if device < 0:
+        return 'unknown'
+
+    return f'dev{major(device)}:{minor(device)}'
+
+def _device_map(func: Callable, jobs: list, devices: list) -> Generator[Any, None, None]:
+    '''
+    Apply a function to a list of jobs, with a separate worker set per device.
+
+    Arguments:
+        func    - the function to apply
+        jobs    - list of jobs
+        devices - list of devices (one for each job, as returned by _get_device())
+
+    Yields the results in order of completion. Jobs of the same device are
+    started in list order.
+
+    Each device gets its own thread pool, sized by the type of the storage
+    backing the device. This avoids sending too many concurrent readers to a
+    single rotational disk, while still saturating solid state storage.
+    '''
+
+    device_jobs = dict()
+    for job, dev in zip(jobs, devices):
+        device_jobs.setdefault(dev, []).append(job)
+
+    executors = []
+    futures = []
+
+    try:
+        for dev, dev_jobs in device_jobs.items():
+            executor = ThreadPoolExecutor(max_workers=_device_streams(dev), thread_name_prefix=_device_name(dev))
+            executors.append(executor)
+
+            futures.extend(executor.submit(func, job) for job in dev_jobs)
+
+        for future in as_completed(futures):
+            yield future.result()
+
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def _feed_blocks(reader: FileReader, hashes: list, dst=None) -> int:
+    '''
+    Feed all blocks of a reader to a list of hash objects.
+
+    Arguments:
+        reader - the file reader
+        hashes - list of hash objects
+        dst    - file object where the blocks are written to (optional)
+
+    Returns the number of bytes read. The time spent waiting for data and
+    the time spent hashing (and writing) is accounted in the metrics.
+    '''
+
+    dev = fstat(reader.fileno()).st_dev
+    num_read = 0
+
+    blocks = reader.blocks()
+
+    while True:
+        t_start = perf_counter()
+
+        block = next(blocks, None)
+        if block is None:
+            break
+
+        t_read = perf_counter()
+
+        for h in hashes:
+            h.update(block)
+
+        if dst is not None:
+            dst.write(block)
+
+        num_read += len(block)
+
+        _metrics.add(dev, len(block), 0, t_read - t_start, perf_counter() - t_read)
+
+    return num_read
+
+def _digest_file(path: str, hashes: list, io_mode: IOMode, offset: int = 0, length: int = None) -> tuple[int, StatKey]:
+    '''
+    Feed the content of a file to a list of hash objects.
+
+    Arguments:
+        path    - path of the file
+        hashes  - list of hash objects
+        io_mode - I/O mode used for reading
+        offset  - start offset of the range to read (page aligned)
+        length  - length of the range to read (None for the rest of the file)
+
+    Returns a tuple of the number of bytes read and the stat key of the file.
+    The stat key is None if the file was modified while reading.
+
+    Reads the file with large blocks (tuned for the filesystem holding the file), so
+    that hashlib can process the data without holding the GIL. This makes the function
+    suitable for thread pools.
+    '''
+
+    with FileReader(path, io_mode, get_io_profile(path), offset, length) as reader:
+        key = StatKey.from_stat(fstat(reader.fileno()))
+
+        filesize = _feed_blocks(reader, hashes)
+
+        '''
+        Chunks of a file only count as file, if they start at the beginning.
+        '''
+        if offset == 0:
+            _metrics.add(key.dev, 0, 1, 0.0, 0.0)
+
+        if key != StatKey.from_stat(fstat(reader.fileno())):
+            key = None
+        elif length is None and key.size != filesize:
+            key = None
+
+    _read_stats.add(reader.stats)
+
+    return (filesize, key)
+
+def _sha_scan_internal(base_dir: str, filename: str, io_mode: IOMode = IOMode.Buffered) -> _HashResult:
+    '''
+    Compute the SHA-256 of a file.
+
+    Arguments:
+        base_dir - the directory containing the file
+        filename - name of the file
+        io_mode  - I/O mode used for reading
+    '''
+
+    h = sha256()
+
+    filesize, key = _digest_file(pjoin(base_dir, filename), [h], io_mode)
+
+    return _HashResult(SHATuple(filesize, h.digest(), filename), key)
+
+def _chunk_scan_internal(base_dir: str, filename: str, chunk_size: int, index: int, io_mode: IOMode = IOMode.Buffered) -> _HashResult:
+    '''
+    Compute the SHA-256 of a single chunk of a file.
+
+    Arguments:
+        base_dir   - the directory containing the file
+        filename   - name of the file
+        chunk_size - size of the chunks
+        index      - index of the chunk
+        io_mode    - I/O mode used for reading
+
+    The filesize of the result is the length of the chunk.
+    '''
+
+    h = sha256()
+
+    length, key = _digest_file(pjoin(base_dir, filename), [h], io_mode, index * chunk_size, chunk_size)
+
+    return _HashResult(SHATuple(length, h.digest(), filename), key)
+
+def _chunked_scan(base_dir: str, filelist: list[str], chunk_size: int, io_mode: IOMode) -> list[_HashResult]:
+    '''
+    Compute the chunked SHA-256 of a list of files.
+
+    Arguments:
+        base_dir   - the directory containing the files
+        filelist   - list of filenames
+        chunk_size - size of the chunks
+        io_mode    - I/O mode used for reading
+
+    All chunks are hashed independently, so that even a single big file
+    is spread over all workers of its device.
+    '''
+
+    sizes = {f: stat(pjoin(base_dir, f)).st_size for f in filelist}
+
+    jobs = [(f, i) for f in filelist for i in range(_num_chunks(sizes[f], chunk_size))]
+    jobs.sort(key=lambda j: min(chunk_size, sizes[j[0]] - j[1] * chunk_size), reverse=True)
+
+    devices = [_get_device(base_dir, f) for f, _ in jobs]
+
+    def scan_func(job: tuple[str, int]) -> tuple[tuple[str, int], _HashResult]:
+        return (job, _chunk_scan_internal(base_dir, job[0], chunk_size, job[1], io_mode))
+
+    chunks = {f: [None] * _num_chunks(sizes[f], chunk_size) for f in filelist}
+    keys = {f: set() for f in filelist}
+
+    for (f, i), result in _device_map(scan_func, jobs, devices):
+        if result.sha.filesize != min(chunk_size, sizes[f] - i * chunk_size):
+            raise RuntimeError(f'file modified while hashing: {f}')
+
+        chunks[f][i] = result.sha.hash
+        keys[f].add(result.key)
+
+    results = []
+
+    for f in filelist:
+        key = keys[f].pop() if len(keys[f]) == 1 else None
+
+        if key is not None and key.size != sizes[f]:
+            key = None
+
+        t = SHATuple(sizes[f], _chunk_root(chunks[f]), f, tuple(chunks[f]), chunk_size)
+        results.append(_HashResult(t, key))
+
+    return results
+
+def _multi_scan_internal(base_dir: str, filename: str, io_mode: IOMode = IOMode.Buffered) -> _HashResult:
+    '''
+    Compute CRC32, MD5 and SHA-256 of a file in a single pass.
+
+    Arguments:
+        base_dir - the directory containing the file
+        filename - name of the file
+        io_mode  - I/O mode used for reading
+    '''
+
+    h_crc32 = _CRC32()
+    h_md5 = md5()
+    h_sha256 = sha256()
+
+    filesize, key = _digest_file(pjoin(base_dir, filename), [h_crc32, h_md5, h_sha256], io_mode)
+
+    return _HashResult(SHATuple(filesize, h_sha256.digest(), filename), key, h_crc32.value, h_md5.digest())
+
+def _sfv_verify_internal(base_dir: str, entry: tuple[str, str], io_mode: IOMode = IOMode.Buffered) -> _CheckResult:
+    '''
+    Verify a single file against its SFV (CRC32) entry.
+
+    Arguments:
+        base_dir - the directory containing the file
+        entry    - tuple of filename and CRC32 (as hex string)
+        io_mode  - I/O mode used for reading
+    '''
+
+    filename, digest = entry
+
+    h = _CRC32()
+
+    try:
+        _digest_file(pjoin(base_dir, filename), [h], io_mode)
+
+    except FileNotFoundError:
+        return _CheckResult(filename, _CheckStatus.Missing)
+
+    if h.value != int(digest, 16):
+        return _CheckResult(filename, _CheckStatus.Mismatch)
+
+    return _CheckResult(filename, _CheckStatus.Ok)
+
+def _md5_scan_internal(base_dir: str, filename: str, io_mode: IOMode = IOMode.Buffered) -> tuple[str, bytes]:
+    '''
+    Compute the MD5 of a file.
+
+    Arguments:
+        base_dir - the directory containing the file
+        filename - name of the file
+        io_mode  - I/O mode used for reading
+
+    Returns a tuple of filename and MD5.
+    '''
+
+    h = md5()
+
+    _digest_file(pjoin(base_dir, filename), [h], io_mode)
+
+    return (filename, h.digest())
+
+def _md5_known_results(base_dir: str, entries: list[tuple[str, str]], digests: dict[str, bytes]) -> list[_CheckResult]:
+    '''
+    Check the MD5 of files against the known set of a MD5 checksum file.
+
+    Arguments:
+        base_dir - the directory containing the checksum file
+        entries  - list of tuples of filename and MD5 (as hex string) from the checksum file
+        digests  - dictionary of the MD5 of the checked files, keyed by filename
+
+    Like md5deep -x, a file passes if its MD5 is listed in the checksum file, under
+    any filename. Listed files that do not exist are reported as missing.
+
+    Returns the per-file results, sorted by filename.
+    '''
+
+    known = set(bytes.fromhex(digest) for _, digest in entries)
+
+    results = [_CheckResult(f, _CheckStatus.Ok if d in known else _CheckStatus.Unknown) for f, d in digests.items()]
+
+    for name, _ in entries:
+        if not name in digests and not isfile(pjoin(base_dir, name)):
+            results.append(_CheckResult(name, _CheckStatus.Missing))
+
+    results.sort(key=lambda r: r.filename)
+
+    return results
+
+def _verify_listing(base_dir: str, entries: list[tuple[str, str]], verify_func: Callable) -> list[_CheckResult]:
+    '''
+    Verify the entries of a legacy (SFV or MD5) checksum file.
+
+    Arguments:
+        base_dir    - the directory containing the checksum file
+        entries     - list of tuples of filename and checksum
+        verify_func - function to verify a single entry
+
+    Returns the per-file results, including the files of the directory that are
+    not listed in the checksum file, sorted by filename.
+    '''
+
+    devices = [_get_device(base_dir, name) for name, _ in entries]
+
+    results = list(_device_map(partial(verify_func, base_dir), entries, devices))
+
+    listed = set(name for name, _ in entries)
+
+    for f in listdir(base_dir):
+        if not _filter(f) and not f in listed:
+            results.append(_CheckResult(f, _CheckStatus.Extra))
+
+    results.sort(key=lambda r: r.filename)
+
+    return results
+
+def _report_results(prefix: str, results: list[_CheckResult], fatal: tuple[_CheckStatus]) -> int:
+    '''
+    Report the results of a legacy checksum verification.
+
+    Arguments:
+        prefix  - prefix for the messages
+        results - the per-file results
+        fatal   - status values that are considered a failure
+
+    Returns the number of failed files.
+    '''
+
+    num_failed = 0
+
+    for r in results:
+        if r.status == _CheckStatus.Ok:
+            continue
+
+        if r.status in fatal:
+            num_failed += 1
+
+            print(f'error: {prefix}: {r.status.name.lower()}: {r.filename}', file=stderr)
+        else:
+            print(f'warn: {prefix}: {r.status.name.lower()}: {r.filename}', file=stderr)
+
+    return num_failed
+
+def _sfv_check_external(filebase: str, working: str) -> int:
+    p_args = ('cksfv', '-q', '-f', filebase)
+
+    try:
+        prun(p_args, cwd=working, check=True, stdin=DEVNULL)
+
+    except CalledProcessError as err:
+        print(f'error: sfv_check: cksfv returned with error: {err.returncode}', file=stderr)
+
+        return 2
+
+    return 0
+
+def _md5_check_external(filebase: str, working: str) -> int:
+    filelist = list()
+    for f in listdir(working):
+        if not _filter(f):
+            filelist.append(f)
+
+    if not filelist:
+        print('error: md5_check: no files found to check', file=stderr)
+
+        return 2
+
+    filelist.sort()
+
+    device_files = dict()
+    for f in filelist:
+        device_files.setdefault(_get_device(working, f), []).append(f)
+
+    processes = []
+
+    try:
+        for dev, files in device_files.items():
+            p_args = ['md5deep', '-s', f'-j{_device_streams(dev)}', '-x', filebase] + files
+            processes.append(Popen(p_args, cwd=working, stdin=DEVNULL))
+
+    except BaseException:
+        for p in processes:
+            p.kill()
+            p.wait()
+
+        raise
+
+    '''
+    Wait for all processes, so that none is left running when one of them fails.
+    '''
+    ret = 0
+
+    for p in processes:
+        if p.wait() != 0:
+            print(f'error: md5_check: process returned with error: {p.returncode}', file=stderr)
+
+            ret = 3
+
+    return ret
+
+def _sha_compare(ref: SHATuple, t: SHATuple) -> None:
+    '''
+    Compare a computed SHA tuple against a reference.
+
+    Arguments:
+        ref - the reference SHA tuple (from the checksum file)
+        t   - the computed SHA tuple
+    '''
+
+    if t.hash != ref.hash:
+        raise RuntimeError(f'hash mismatch for: {ref.filename}')
+
+    if t.filesize != ref.filesize:
+        raise RuntimeError(f'filesize mismatch for: {ref.filename}')
+
+def _chunk_compare(job: _CheckJob, result: _HashResult) -> None:
+    '''
+    Compare a computed chunk hash against the reference of a check job.
+
+    Arguments:
+        job    - the check job of the chunk
+        result - hash result of the chunk
+    '''
+
+    ref = job.ref
+    offset = job.chunk * ref.chunk_size
+
+    if result.sha.hash != ref.chunks[job.chunk]:
+        raise RuntimeError(f'hash mismatch for: {ref.filename} (chunk {job.chunk}, offset {offset})')
+
+    if result.sha.filesize != min(ref.chunk_size, ref.filesize - offset):
+        raise RuntimeError(f'filesize mismatch for: {ref.filename}')
+
+    if result.key is not None and result.key.size != ref.filesize:
+        raise RuntimeError(f'filesize mismatch for: {ref.filename}')
+
+def _make_jobs(index: int, base_dir: str, t: SHATuple) -> list[_CheckJob]:
+    '''
+    Create the check jobs for a SHA tuple.
+
+    Arguments:
+        index    - index of the checksum file
+        base_dir - the directory containing the file
+        t        - the SHA tuple
+
+    Chunked tuples get one job per chunk. Empty files have no chunks, and
+    are checked as a whole.
+    '''
+
+    if not t.chunks:
+        return [_CheckJob(index, base_dir, t)]
+
+    return [_CheckJob(index, base_dir, t, i) for i in range(len(t.chunks))]
+
+def _job_size(job: _CheckJob) -> int:
+    if job.chunk is None:
+        return job.ref.filesize
+
+    return min(job.ref.chunk_size, job.ref.filesize - job.chunk * job.ref.chunk_size)
+
+def _clone_file(src_path: str, dst_path: str) -> bool:
+    '''
+    Copy a file in the kernel, using copy_file_range().
+
+    Arguments:
+        src_path - path of the source file
+        dst_path - path of the destination file
+
+    Returns False if the filesystem does not support the copy, in which
+    case nothing was copied.
+
+    Depending on the filesystem, the copy is done server-side or as a
+    reflink, so that no data is transferred at all.
+    '''
+
+    with open(src_path, mode='rb') as src, open(dst_path, mode='wb') as dst:
+        num_copied = 0
+
+        while True:
+            try:
+                num_bytes = copy_file_range(src.fileno(), dst.fileno(), 1 << 30)
+
+            except OSError as err:
+                if num_copied != 0 or not err.errno in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+                    raise
+
+                return False
+
+            if num_bytes == 0:
+                break
+
+            num_copied += num_bytes
+
+        fsync(dst.fileno())
+
+    return True
+
+def _stream_file(src_path: str, dst_path: str, hashes: list, io_mode: IOMode) -> int:
+    '''
+    Copy a file, feeding the copied data to a list of hash objects.
+
+    Arguments:
+        src_path - path of the source file
+        dst_path - path of the destination file
+        hashes   - list of hash objects
+        io_mode  - I/O mode used for reading
+
+    Returns the number of bytes copied. The destination is synced to disk.
+    '''
+
+    with FileReader(src_path, io_mode, get_io_profile(src_path)) as reader, open(dst_path, mode='wb') as dst:
+        num_copied = _feed_blocks(reader, hashes, dst)
+
+        _metrics.add(fstat(reader.fileno()).st_dev, 0, 1, 0.0, 0.0)
+
+        dst.flush()
+        fsync(dst.fileno())
+
+    _read_stats.add(reader.stats)
+
+    return num_copied
+
+def _copy_internal(dst_dir: str, ref: SHATuple, src_dir: str, io_mode: IOMode) -> tuple[SHATuple, str]:
+    '''
+    Copy a single file, verifying the source data against its reference SHA tuple.
+
+    Arguments:
+        dst_dir - the destination directory
+        ref     - the reference SHA tuple
+        src_dir - the source directory
+        io_mode - I/O mode used for reading
+
+    Returns a tuple of the reference and an error message (None on success).
+
+    Within a filesystem, the data is copied without passing through userspace.
+    It is then only verified when re-reading the destination.
+    '''
+
+    src_path = pjoin(src_dir, ref.filename)
+    dst_path = pjoin(dst_dir, ref.filename)
+
+    try:
+        if stat(src_path).st_dev != stat(dst_dir).st_dev or not _clone_file(src_path, dst_path):
+            h = sha256() if ref.chunks is None else _ChunkedSHA256(ref.chunk_size)
+
+            filesize = _stream_file(src_path, dst_path, [h], io_mode)
+            _sha_compare(ref, SHATuple(filesize, h.digest(), ref.filename))
+
+        copystat(src_path, dst_path)
+
+    except Exception as exc:
+        return (ref, f'source: {exc}')
+
+    return (ref, None)
+
+def _copy_verify_internal(src_directory: str, dst_directory: str, sha_tuples: list[SHATuple], cache_mode: CacheMode, io_mode: IOMode) -> int:
+    '''
+    Internal helper for copy_verify.
+
+    Arguments:
+        src_directory - the source directory
+        dst_directory - the (existing) destination directory
+        sha_tuples    - list of SHA tuples of the source
+        cache_mode    - the cache mode
+        io_mode       - I/O mode used for reading the source
+
+    Returns the exit code of copy_verify.
+    '''
+
+    '''
+    Copy the listed files first, and hash them while streaming. The sorting
+    by size keeps all workers busy, same as for checks.
+    '''
+    ordered_tuples = sorted(sha_tuples, key=lambda t: t.filesize, reverse=True)
+    devices = [_get_device(src_directory, t.filename) for t in ordered_tuples]
+
+    copy_func = partial(_copy_internal, dst_directory, src_dir=src_directory, io_mode=io_mode)
+
+    num_failed = 0
+
+    for ref, error in _device_map(copy_func, ordered_tuples, devices):
+        if error is not None:
+            print(f'error: copy_verify: {ref.filename}: {error}', file=stderr)
+
+            num_failed += 1
+
+    if num_failed != 0:
+        return 5
+
+    '''
+    Re-read the destination, bypassing the page cache, so that the data
+    is verified as it was written to the destination storage.
+    '''
+    jobs = []
+    for arg in sha_tuples:
+        jobs.extend(_make_jobs(0, dst_directory, arg))
+
+    cache = _open_cache(cache_mode)
+
+    try:
+        for job, error in _sha_verify(jobs, cache, IOMode.Direct):
+            if error is not None:
+                print(f'error: copy_verify: destination: {error}', file=stderr)
+
+                num_failed += 1
+
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if num_failed != 0:
+        return 6
+
+    '''
+    The checksum file (and other auxiliary files) are copied last, so that
+    only verified copies carry a checksum file.
+    '''
+    try:
+        for f in sorted(listdir(src_directory)):
+            if _filter(f):
+                copy2(pjoin(src_directory, f), pjoin(dst_directory, f))
+
+    except OSError as err:
+        print(f'error: copy_verify: failed to copy auxiliary file: {err}', file=stderr)
+
+        return 7
+
+    return 0
+
+def _remove_incomplete(directory: str) -> None:
+    '''
+    Remove the destination directory of a failed copy.
+
+    Arguments:
+        directory - the destination directory
+
+    Reports the directory if it could not be removed.
+    '''
+
+    try:
+        rmtree(directory)
+
+    except OSError as err:
+        print(f'error: copy_verify: failed to remove incomplete copy: {err}', file=stderr)
+        print(f'warn: copy_verify: incomplete copy left behind: {directory}', file=stderr)
+
+def _archive_compare(directory: _ArchiveDirectory, filename: str, filesize: int, digests: dict[int, bytes]) -> None:
+    '''
+    Compare the digests of an archive member against the checksum file of its directory.
+
+    Arguments:
+        directory - the archive directory of the member
+        filename  - name of the member (within the directory)
+        filesize  - size of the member
+        digests   - dictionary of digests, keyed by chunk size (0 for unchunked)
+    '''
+
+    ref = directory.refs.get(filename)
+
+    if ref is None:
+        directory.errors.append(f'file without checksum: {filename}')
+
+        return
+
+    digest = digests.get(ref.chunk_size)
+
+    try:
+        if digest is None:
+            raise RuntimeError(f'unsupported chunk size {ref.chunk_size} for: {filename}')
+
+        _sha_compare(ref, SHATuple(filesize, digest, filename))
+
+    except RuntimeError as exc:
+        directory.errors.append(str(exc))
+
+def _archive_member(directory: _ArchiveDirectory, filename: str, member_file) -> None:
+    '''
+    Hash an archive member and verify it, if possible.
+
+    Arguments:
+        directory   - the archive directory of the member
+        filename    - name of the member (within the directory)
+        member_file - file object of the member data
+
+    If the checksum file of the directory was not seen yet, the digests are kept
+    until it is. In that case both the plain and the chunked (with the default
+    chunk size) digests are computed, since the format is not known yet.
+    '''
+
+    if directory.refs is not None:
+        ref = directory.refs.get(filename)
+
+        if ref is None or ref.chunks is None:
+            hashes = {0: sha256()}
+        else:
+            hashes = {ref.chunk_size: _ChunkedSHA256(ref.chunk_size)}
+    else:
+        hashes = {0: sha256(), _default_chunk_size: _ChunkedSHA256(_default_chunk_size)}
+
+    filesize = 0
+
+    while True:
+        block = member_file.read(1 << 20)
+        if not block:
+            break
+
+        for h in hashes.values():
+            h.update(block)
+
+        filesize += len(block)
+
+    digests = {k: h.digest() for k, h in hashes.items()}
+
+    directory.num_files += 1
+    directory.num_bytes += filesize
+
+    if directory.refs is None:
+        directory.pending[filename] = (filesize, digests)
+    else:
+        _archive_compare(directory, filename, filesize, digests)
+
+def _archive_manifest(directory: _ArchiveDirectory, filename: str, member_file) -> None:
+    '''
+    Load the checksum file of an archive directory, and verify the pending members.
+
+    Arguments:
+        directory   - the archive directory of the checksum file
+        filename    - name of the checksum file
+        member_file - file object of the checksum file data
+
+    Binary checksum files are recognized by their magic. Since they are memory-mapped
+    for reading, they are spooled to a temporary file first.
+    '''
+
+    if directory.refs is not None:
+        directory.errors.append(f'multiple checksum files: {filename}')
+
+        return
+
+    try:
+        data = member_file.read()
+
+        if is_binary_data(data):
+            with NamedTemporaryFile(prefix='tjtools-', suffix='.shb') as f:
+                f.write(data)
+                f.flush()
+
+                with BinaryManifest(f.name) as manifest:
+                    sha_tuples = [SHATuple(*entry) for entry in manifest]
+        else:
+            sha_tuples = _parse_sha_lines(data.decode('utf-8').splitlines())
+
+    except Exception as exc:
+        directory.errors.append(f'checksum parsing failed: {filename}: {exc}')
+
+        return
+
+    directory.refs = {t.filename: t for t in sha_tuples}
+
+    for name, (filesize, digests) in directory.pending.items():
+        _archive_compare(directory, name, filesize, digests)
+
+    directory.pending.clear()
+
+def _sha_verify_internal(job: _CheckJob, io_mode: IOMode) -> tuple[_CheckJob, _HashResult, str]:
+    '''
+    Verify a single file (or chunk of a file) against its reference SHA tuple.
+
+    Arguments:
+        job     - the check job
+        io_mode - I/O mode used for reading
+
+    Returns a tuple of the job, the hash result and an error message. The hash
+    result is None if the file could not be read, and the error message is None
+    if the verification was successful.
+    '''
+
+    result = None
+
+    try:
+        if job.chunk is None:
+            result = _sha_scan_internal(job.base_dir, job.ref.filename, io_mode)
+            _sha_compare(job.ref, result.sha)
+        else:
+            result = _chunk_scan_internal(job.base_dir, job.ref.filename, job.ref.chunk_size, job.chunk, io_mode)
+            _chunk_compare(job, result)
+
+    except Exception as exc:
+        return (job, result, str(exc))
+
+    return (job, result, None)
+
+def _sha_verify(jobs: list[_CheckJob], cache: HashCache, io_mode: IOMode) -> Generator[tuple[_CheckJob, str], None, None]:
+    '''
+    Verify a list of check jobs.
+
+    Arguments:
+        jobs    - the check jobs
+        cache   - the hash cache where results are recorded (optional)
+        io_mode - I/O mode used for reading
+
+    Yields a tuple of job and error message (None on success) for each job,
+    in order of completion. For files that can not be read, only the error of
+    the first chunk is yielded.
+
+    Jobs are handed to the workers largest file first, and one at a time, so that
+    a few big files are started early and all workers stay busy until the end.
+    '''
+
+    ordered_jobs = sorted(jobs, key=_job_size, reverse=True)
+    devices = [_get_device(j.base_dir, j.ref.filename) for j in ordered_jobs]
+
+    chunk_states = dict()
+    for job in ordered_jobs:
+        if job.chunk is not None:
+            state = chunk_states.setdefault((job.index, job.base_dir, job.ref), _ChunkState(0))
+            state.remaining += 1
+
+    verify_func = partial(_sha_verify_internal, io_mode=io_mode)
+
+    for job, result, error in _device_map(verify_func, ordered_jobs, devices):
+        if job.chunk is None:
+            if cache is None or result is None:
+                pass
+            elif job.ref.chunks is None:
+                _cache_results(cache, [result])
+            elif error is None:
+                '''
+                Empty files of chunked checksum files are cached with the root hash.
+                '''
+                _cache_results(cache, [_HashResult(job.ref, result.key)])
+
+            yield (job, error)
+
+            continue
+
+        state = chunk_states[(job.index, job.base_dir, job.ref)]
+
+        state.remaining -= 1
+        state.failed |= error is not None
+        state.keys.add(None if result is None else result.key)
+
+        '''
+        The root hash is only cached if all chunks were read from the same,
+        unmodified file.
+        '''
+        if state.remaining == 0 and not state.failed and cache is not None and len(state.keys) == 1:
+            _cache_results(cache, [_HashResult(job.ref, state.keys.pop())])
+
+        if result is None:
+            if state.unreadable:
+                continue
+
+            state.unreadable = True
+
+        yield (job, error)
+
+
+def _print_report(report: dict[str, Any]) -> None:
+    '''
+    Print a metrics report in human readable form.
+
+    Arguments:
+        report - the metrics report
+    '''
+
+    def format_metrics(m: dict[str, Any]) -> str:
+        return f'{m["bytes"]} bytes, {m["files"]} files ({m["files_per_second"]:.1f}/s), ' \
+            f'{m["throughput"] / (1 << 20):.1f} MiB/s, read {m["read_time"]:.2f} s, digest {m["digest_time"]:.2f} s'
+
+    print(f'info: total: {format_metrics(report["total"])}, elapsed {report["elapsed"]:.2f} s', file=stdout)
+
+    for d in report['devices']:
+        name = d['device'] if d['name'] is None else f'{d["device"]} ({d["name"]})'
+
+        print(f'info: device {name}: {format_metrics(d)}', file=stdout)
+
+    for w in report['workers']:
+        print(f'info: worker {w["worker"]}: {format_metrics(w)}', file=stdout)
+
+def _dispatch(checksum_mode: str, oargs: list[str], cache_mode: CacheMode, io_mode: IOMode, external: bool, chunk_size: int) -> int:
+    '''
+    Run the selected checksum mode.
+
+    Arguments:
+        checksum_mode - the checksum mode
+        oargs         - list of non-option arguments
+        cache_mode    - the cache mode
+        io_mode       - the I/O mode
+        external      - use external tools for SFV and MD5 checks
+        chunk_size    - chunk size for scans (0 for unchunked)
+    '''
+
+    if checksum_mode == 'scan':
+        retval = sha_scan(oargs[0], None, None, cache_mode, io_mode, chunk_size)
+    elif checksum_mode == 'check':
+        retval = sha_check(oargs[0], cache_mode, io_mode)
+    elif checksum_mode == 'tree':
+        retval = sha_check_tree(oargs[0], cache_mode, io_mode)
+    elif checksum_mode == 'archive':
+        retval = archive_check(oargs[0])
+    elif checksum_mode == 'copy':
+        retval = copy_verify(oargs[0], oargs[1], cache_mode, io_mode)
+    elif checksum_mode == 'pack':
+        retval = sha_pack(oargs[0])
+    elif checksum_mode == 'unpack':
+        retval = sha_unpack(oargs[0])
+    elif checksum_mode == 'sfv':
+        retval = sfv_check(oargs[0], external, io_mode)
+    elif checksum_mode == 'md5':
+        retval = md5_check(oargs[0], external, io_mode)
+    elif checksum_mode == 'migrate':
+        retval = sfv_migrate(oargs[0], cache_mode, io_mode)
+    elif checksum_mode == 'calibrate':
+        retval = io_calibrate(oargs[0])
+
+    return retval
+
+
+##########################################################################################
+# Functions
+##########################################################################################
+
+def find_manifests(root: str) -> list[str]:
+    '''
+    Find all SHA checksum files below a root directory.
+
+    Arguments:
+        root - the root directory
+
+    Text checksum files are skipped if they have been packed into
+    a binary checksum file.
+    '''
+
+    manifests = []
+
+    for dirpath, _, filenames in walk(root):
+        packed = set(splitext(f)[0] for f in filenames if splitext(f)[1] == '.shb')
+
+        for f in filenames:
+            split_f = splitext(f)
+
+            if split_f[1] == '.shb' or (split_f[1] == '.sha' and not split_f[0] in packed):
+                manifests.append(pjoin(dirpath, f))
+
+    manifests.sort()
+
+    return manifests
+
+def parse_sha(arg: str) -> list[SHATuple]:
+    '''
+    Parse a SHA checksum file (text or binary).
+
+    Arguments:
+        arg - path of the checksum file
+    '''
+
+    return list(_iter_sha(arg))
+
+def sha_scan(arg, out, external_list, cache_mode: CacheMode = CacheMode.Update, io_mode: IOMode = IOMode.Buffered, chunk_size: int = 0) -> int:
+    input_directory = arg.rstrip('/')
+
+    if not isdir(input_directory):
+        print(f'error: directory not found: {input_directory}', file=stderr)
+
+        return 1
+
+    input_path = realpath(input_directory)
+
+    if out is None:
+        filebase = _get_filebase(input_path)
+        sha = pjoin(input_path, filebase)
+
+        if exists(sha):
+            print(f'error: directory already has a checksum: {input_directory}', file=stderr)
+
+            return 2
+
+    filelist = []
+
+    if external_list != None:
+        dir_listing = external_list
+    else:
+        dir_listing = listdir(input_path)
+
+    for f in dir_listing:
+        if not _filter(f):
+            filelist.append(f)
+
+    if not filelist:
+        print('error: no files found to check', file=stderr)
+
+        return 3
+
+    filelist.sort()
+
+    devices = [_get_device(input_path, f) for f in filelist]
+
+    try:
+        if chunk_size != 0:
+            results = _chunked_scan(input_path, filelist, chunk_size, io_mode)
+        else:
+            scan_func = partial(_sha_scan_internal, input_path, io_mode=io_mode)
+            results = sorted(_device_map(scan_func, filelist, devices), key=lambda r: r.sha.filename)
+
+    except (OSError, RuntimeError) as err:
+        print(f'error: sha_scan: hashing failed: {err}', file=stderr)
+
+        return 4
+
+    cache = _open_cache(cache_mode)
+    if cache is not None:
+        with cache:
+            _cache_results(cache, results)
+
+    sha_tuples = [r.sha for r in results]
+
+    if out is None:
+        output = open(sha, mode='w', encoding='utf-8')
+    else:
+        output = out
+
+    try:
+        if chunk_size != 0:
+            output.write(f'{_sha_v2_header}{chunk_size}\n')
+
+        output.writelines(map(_format_sha_entry, sha_tuples))
+
+    finally:
+        if out is None:
+            output.close()
+
+    return 0
+
+def sha_check(arg, cache_mode: CacheMode = CacheMode.Update, io_mode: IOMode = IOMode.Buffered) -> int:
+    input_file = arg
+
+    if not isfile(input_file):
+        print(f'error: sha_check: checksum file not found: {input_file}', file=stderr)
+
+        return 1
+
+    '''
+    The entries are verified in batches, so that the entries of a binary checksum
+    file are never all in memory at the same time.
+    '''
+    sha_iter = _iter_sha(input_file)
+
+    try:
+        batch = list(islice(sha_iter, _verify_batch_size))
+
+    except Exception as exc:
+        print(f'error: sha_check: checksum parsing failed: {exc}', file=stderr)
+
+        return 2
+
+    base_directory = dirname(input_file)
+    if len(base_directory) == 0:
+        base_directory = '.'
+
+    '''
+    Text checksum files are completely in memory anyway, and their entries are
+    needed to find unlisted files.
+    '''
+    sha_tuples = None if is_binary_manifest(input_file) else []
+
+    num_files = 0
+    num_cached = 0
+    bytes_total = 0
+
+    cache = _open_cache(cache_mode)
+
+    try:
+        while batch:
+            if cache is not None and cache_mode == CacheMode.Trust:
+                pending = [arg for arg in batch if not _is_cached(cache, base_directory, arg)]
+            else:
+                pending = batch
+
+            jobs = []
+            for arg in pending:
+                jobs.extend(_make_jobs(0, base_directory, arg))
+
+            for _, error in _sha_verify(jobs, cache, io_mode):
+                if error is not None:
+                    raise RuntimeError(error)
+
+            num_files += len(batch)
+            num_cached += len(batch) - len(pending)
+            bytes_total += sum(arg.filesize for arg in batch)
+
+            if sha_tuples is not None:
+                sha_tuples.extend(batch)
+
+            batch = list(islice(sha_iter, _verify_batch_size))
+
+    except Exception as exc:
+        print(f'error: sha_check: check failure: {exc}', file=stderr)
+
+        return 3
+
+    finally:
+        sha_iter.close()
+
+        if cache is not None:
+            cache.close()
+
+    unlisted = _find_unlisted(base_directory, input_file, sha_tuples)
+    if unlisted:
+        print(f'error: sha_check: file without checksum: {unlisted[0]}', file=stderr)
+
+        return 4
+
+    print(f'info: successfully checked {num_files} files, {bytes_total} bytes total', file=stdout)
+
+    if num_cached != 0:
+        print(f'info: {num_cached} files unchanged according to hash cache', file=stdout)
+
+    return 0
+
+def sha_check_tree(arg, cache_mode: CacheMode = CacheMode.Update, io_mode: IOMode = IOMode.Buffered) -> int:
+    root_directory = arg
+
+    if not isdir(root_directory):
+        print(f'error: sha_check_tree: directory not found: {root_directory}', file=stderr)
+
+        return 1
+
+    manifests = find_manifests(root_directory)
+    if not manifests:
+        print(f'error: sha_check_tree: no checksum files found: {root_directory}', file=stderr)
+
+        return 2
+
+    results = []
+    jobs = []
+
+    for index, manifest in enumerate(manifests):
+        base_directory = dirname(manifest)
+        result = _ManifestResult(manifest)
+
+        results.append(result)
+
+        try:
+            sha_tuples = parse_sha(manifest)
+
+        except Exception as exc:
+            result.errors.append(f'checksum parsing failed: {exc}')
+
+            continue
+
+        result.num_files = len(sha_tuples)
+        result.num_bytes = sum(arg.filesize for arg in sha_tuples)
+
+        for f in _find_unlisted(base_directory, manifest, sha_tuples):
+            result.errors.append(f'file without checksum: {f}')
+
+        for arg in sha_tuples:
+            jobs.extend(_make_jobs(index, base_directory, arg))
+
+    cache = _open_cache(cache_mode)
+
+    if cache is not None and cache_mode == CacheMode.Trust:
+        pending = []
+        cached = dict()
+
+        for job in jobs:
+            key = (job.base_dir, job.ref)
+
+            if not key in cached:
+                cached[key] = _is_cached(cache, job.base_dir, job.ref)
+
+                if cached[key]:
+                    results[job.index].num_cached += 1
+
+            if not cached[key]:
+                pending.append(job)
+    else:
+        pending = jobs
+
+    try:
+        for job, error in _sha_verify(pending, cache, io_mode):
+            if error is not None:
+                results[job.index].errors.append(error)
+
+    finally:
+        if cache is not None:
+            cache.close()
+
+    num_failed = 0
+
+    for result in results:
+        if result.errors:
+            num_failed += 1
+
+            for error in result.errors:
+                print(f'error: sha_check_tree: {result.path}: {error}', file=stderr)
+        else:
+            print(f'info: {result.path}: checked {result.num_files} files, {result.num_bytes} bytes total', file=stdout)
+
+    num_cached = sum(result.num_cached for result in results)
+    if num_cached != 0:
+        print(f'info: {num_cached} files unchanged according to hash cache', file=stdout)
+
+    print(f'info: {len(results) - num_failed} of {len(results)} checksum files verified successfully', file=stdout)
+
+    if num_failed != 0:
+        return 3
+
+    return 0
 
-    with open(arg, encoding='utf-8') as f:
-        sfv = [i for i in map(match_sfv, f.read().splitlines()) if i is not None]
+def archive_check(arg) -> int:
+    input_file = arg
 
-    return sfv
+    if not isfile(input_file):
+        print(f'error: archive_check: archive not found: {input_file}', file=stderr)
 
-def _parse_sha_line(arg: str) -> _SHATuple:
-    tmp = arg.strip().split(' ', maxsplit=1)
+        return 1
 
-    if not tmp[0].isdigit():
-        raise RuntimeError(f'malformed SHA line: {tmp[0]}')
+    directories = dict()
 
-    filesize = int(tmp[0])
+    p_args = ('zstd', '--decompress', '--stdout', '--quiet', input_file)
 
-    tmp = tmp[1].strip().split(' ', maxsplit=1)
+    p = Popen(p_args, stdin=DEVNULL, stdout=PIPE)
 
     try:
-        hash_bytes = bytes.fromhex(tmp[0])
+        with tar_open(fileobj=p.stdout, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
 
-    except Exception as exc:
-        raise RuntimeError(f'malformed SHA line: {tmp[0]}: {exc}') from exc
-
-    filename = tmp[1].strip()
+                directory = directories.setdefault(tar_dirname(member.name), _ArchiveDirectory())
+                filename = tar_basename(member.name)
 
-    return _SHATuple(filesize, hash_bytes, filename)
+                directory.members.add(filename)
 
-def _parse_sha(arg: str) -> list[_SHATuple]:
-    with open(arg, encoding='utf-8') as f:
-        raw_lines = f.read().splitlines()
+                member_file = tar.extractfile(member)
 
-    return [_parse_sha_line(line) for line in raw_lines]
+                if splitext(filename)[1] in ('.sha', '.shb'):
+                    _archive_manifest(directory, filename, member_file)
+                elif not _filter(filename):
+                    _archive_member(directory, filename, member_file)
 
-def _try_singlefile(arg):
-    filters = ('.sfv', '.md5')
+        '''
+        Consume the padding after the end of the archive.
+        '''
+        while p.stdout.read(1 << 16):
+            pass
 
-    working = dirname(arg)
+    except Exception as exc:
+        p.kill()
 
-    split_base = splitext(basename(arg))
-    if len(split_base) != 2:
-        return None
+        print(f'error: archive_check: reading archive failed: {exc}', file=stderr)
 
-    sfv = _parse_sfv(arg)
-    if len(sfv) != 1:
-        print('error: singlefile check failed: multiple entries in SFV', file=stderr)
+        return 2
 
-        return None
+    finally:
+        p.stdout.close()
+        p.wait()
 
-    ref_split = splitext(sfv[0][0])
-    if ref_split[0] != split_base[0]:
-        print('error: singlefile check failed: filename mismatch', file=stderr)
+    if p.returncode != 0:
+        print(f'error: archive_check: zstd returned with error: {p.returncode}', file=stderr)
 
-        return None
+        return 2
 
-    ref_found = False
-    filelist = []
+    num_failed = 0
+    num_checked = 0
 
-    for f in listdir(working):
-        split_f = splitext(f)
+    for name, directory in sorted(directories.items()):
+        if directory.refs is None:
+            if directory.pending:
+                print(f'warn: archive_check: {name}: no checksum file, {len(directory.pending)} files unchecked', file=stderr)
 
-        if len(split_f) != 2 or split_f[0] != split_base[0]:
             continue
 
-        if split_f[1] in filters:
-            filelist.append(f)
-        elif f == sfv[0][0]:
-            ref_found = True
-            filelist.append(f)
+        num_checked += 1
 
-    if not ref_found:
-        return None
+        for f in sorted(set(directory.refs) - directory.members):
+            directory.errors.append(f'file missing: {f}')
 
-    return filelist
+        if directory.errors:
+            num_failed += 1
 
-def _sha_check_internal(base_dir: str, t: _SHATuple) -> None:
-    with open(pjoin(base_dir, t.filename), mode='rb') as f:
-        h = file_digest(f, 'sha256')
-        filesize = f.tell()
+            for error in directory.errors:
+                print(f'error: archive_check: {name}: {error}', file=stderr)
+        else:
+            print(f'info: {name}: checked {directory.num_files} files, {directory.num_bytes} bytes total', file=stdout)
 
-    if h.digest() != t.hash:
-        raise RuntimeError(f'hash mismatch for: {t.filename}')
+    if num_checked == 0:
+        print(f'error: archive_check: no checksum files found: {input_file}', file=stderr)
 
-    if filesize != t.filesize:
-        raise RuntimeError(f'filesize mismatch for: {t.filename}')
+        return 3
 
+    print(f'info: {num_checked - num_failed} of {num_checked} checksum files verified successfully', file=stdout)
 
-##########################################################################################
-# Functions
-##########################################################################################
+    if num_failed != 0:
+        return 4
 
-def sha_scan(arg, out, external_list) -> int:
-    input_directory = arg.rstrip('/')
+    return 0
 
-    if not isdir(input_directory):
-        print(f'error: directory not found: {input_directory}', file=stderr)
+def copy_verify(src, dst, cache_mode: CacheMode = CacheMode.Update, io_mode: IOMode = IOMode.Buffered) -> int:
+    src_directory = realpath(src)
+
+    if not isdir(src_directory):
+        print(f'error: copy_verify: directory not found: {src}', file=stderr)
 
         return 1
 
-    input_path = realpath(input_directory)
+    manifest = _find_sha_manifest(src_directory)
+    if manifest is None:
+        print(f'error: copy_verify: no unique checksum file found: {src}', file=stderr)
 
-    if out is None:
-        filebase = _get_filebase(input_path)
-        sha = pjoin(input_path, filebase)
+        return 1
 
-        if exists(sha):
-            print(f'error: directory already has a checksum: {input_directory}', file=stderr)
+    try:
+        sha_tuples = parse_sha(manifest)
 
-            return 2
+    except Exception as exc:
+        print(f'error: copy_verify: checksum parsing failed: {exc}', file=stderr)
 
-    filelist = []
+        return 2
 
-    if external_list != None:
-        dir_listing = external_list
+    unlisted = _find_unlisted(src_directory, manifest, sha_tuples)
+    if unlisted:
+        print(f'error: copy_verify: file without checksum: {unlisted[0]}', file=stderr)
+
+        return 3
+
+    if isdir(dst):
+        dst_directory = pjoin(realpath(dst), basename(src_directory))
     else:
-        dir_listing = listdir(input_path)
+        dst_directory = realpath(dst)
 
-    for f in dir_listing:
-        if not _filter(f):
-            filelist.append(f)
+    if exists(dst_directory):
+        print(f'error: copy_verify: destination already exists: {dst_directory}', file=stderr)
 
-    if not filelist:
-        print('error: no files found to check', file=stderr)
+        return 4
 
-        return 3
+    '''
+    Copy into a hidden temporary directory, which is only renamed to the destination
+    once everything is verified. A failed copy therefore never looks like a complete one,
+    and does not block a re-run.
+    '''
+    tmp_directory = pjoin(dirname(dst_directory), f'.{basename(dst_directory)}.tmp')
 
-    filelist.sort()
+    try:
+        mkdir(tmp_directory)
 
-    if out is None:
-        output = open(sha, mode='w', encoding='utf-8')
-    else:
-        output = out
+    except OSError as err:
+        print(f'error: copy_verify: failed to create destination: {err}', file=stderr)
+
+        return 4
 
-    p_args = ['sha256deep', '-b', '-z'] + filelist
+    retval = None
 
     try:
-        prun(p_args, cwd=input_path, check=True, stdin=DEVNULL, stdout=output)
+        retval = _copy_verify_internal(src_directory, tmp_directory, sha_tuples, cache_mode, io_mode)
 
-    except CalledProcessError as err:
-        print(f'error: sha256deep returned with error: {err.returncode}', file=stderr)
+        if retval == 0:
+            try:
+                rename(tmp_directory, dst_directory)
 
-        return 4
+            except OSError as err:
+                print(f'error: copy_verify: failed to move copy into place: {err}', file=stderr)
+
+                retval = 8
 
     finally:
-        if out is None:
-            output.close()
+        if retval != 0:
+            _remove_incomplete(tmp_directory)
+
+    if retval != 0:
+        return retval
+
+    bytes_total = sum(arg.filesize for arg in sha_tuples)
+
+    print(f'info: copied and verified {len(sha_tuples)} files, {bytes_total} bytes total: {dst_directory}', file=stdout)
 
     return 0
 
-def sha_check(arg) -> int:
+def sha_pack(arg) -> int:
     input_file = arg
 
     if not isfile(input_file):
-        print(f'error: sha_check: checksum file not found: {input_file}', file=stderr)
+        print(f'error: sha_pack: checksum file not found: {input_file}', file=stderr)
 
         return 1
 
+    output_file = splitext(input_file)[0] + '.shb'
+    if exists(output_file):
+        print(f'error: sha_pack: binary checksum file already exists: {output_file}', file=stderr)
+
+        return 2
+
     try:
-        sha_tuples = _parse_sha(input_file)
+        sha_tuples = parse_sha(input_file)
 
     except Exception as exc:
-        print(f'error: sha_check: checksum parsing failed: {exc}', file=stderr)
+        print(f'error: sha_pack: checksum parsing failed: {exc}', file=stderr)
 
-        return 2
+        return 3
 
-    base_directory = dirname(input_file)
-    if len(base_directory) == 0:
-        base_directory = '.'
+    if any(arg.chunks is not None for arg in sha_tuples):
+        print(f'error: sha_pack: chunked checksum files can not be packed: {input_file}', file=stderr)
 
-    internal_args = [(base_directory, arg) for arg in sha_tuples]
+        return 4
 
     try:
-        with Pool() as pool:
-            pool.starmap(_sha_check_internal, internal_args)
-            pool.close()
-            pool.join()
+        write_binary_manifest(output_file, [(arg.filesize, arg.hash, arg.filename) for arg in sha_tuples])
 
     except Exception as exc:
-        print(f'error: sha_check: check failure: {exc}', file=stderr)
+        print(f'error: sha_pack: failed to write binary checksum file: {output_file}: {exc}', file=stderr)
 
-        return 3
+        return 5
 
-    for f in listdir(base_directory):
-        if _filter(f):
-            continue
+    print(f'info: packed {len(sha_tuples)} entries: {output_file}', file=stdout)
 
-        filename_matches = [arg for arg in sha_tuples if arg.filename == f]
+    return 0
 
-        if len(filename_matches) != 1:
-            print(f'error: sha_check: file without checksum: {f}', file=stderr)
+def sha_unpack(arg) -> int:
+    input_file = arg
 
-            return 4
+    if not isfile(input_file) or not is_binary_manifest(input_file):
+        print(f'error: sha_unpack: binary checksum file not found: {input_file}', file=stderr)
 
-    bytes_total = 0
-    for arg in sha_tuples:
-        bytes_total += arg.filesize
+        return 1
+
+    output_file = splitext(input_file)[0] + '.sha'
+    if exists(output_file):
+        print(f'error: sha_unpack: checksum file already exists: {output_file}', file=stderr)
+
+        return 2
+
+    try:
+        sha_tuples = parse_sha(input_file)
+
+    except Exception as exc:
+        print(f'error: sha_unpack: checksum parsing failed: {exc}', file=stderr)
+
+        return 3
+
+    try:
+        with open(output_file, mode='w', encoding='utf-8') as output:
+            output.writelines(map(_format_sha_entry, sha_tuples))
+
+    except OSError as msg:
+        print(f'error: sha_unpack: failed to write checksum file: {output_file}: {msg}', file=stderr)
+
+        return 4
 
-    print(f'info: successfully checked {len(sha_tuples)} files, {bytes_total} bytes total', file=stdout)
+    print(f'info: unpacked {len(sha_tuples)} entries: {output_file}', file=stdout)
 
     return 0
 
-def sfv_check(arg) -> int:
+def sfv_check(arg, external: bool = False, io_mode: IOMode = IOMode.Buffered) -> int:
     input_file = arg
 
     if not isfile(input_file):
@@ -323,19 +2379,27 @@ def sfv_check(arg) -> int:
     filebase = basename(input_path)
     working = dirname(input_path)
 
-    p_args = ('cksfv', '-q', '-f', filebase)
+    if external:
+        return _sfv_check_external(filebase, working)
 
     try:
-        prun(p_args, cwd=working, check=True, stdin=DEVNULL)
+        verify_func = partial(_sfv_verify_internal, io_mode=io_mode)
+        results = _verify_listing(working, _parse_sfv(input_path), verify_func)
 
-    except CalledProcessError as err:
-        print(f'error: sfv_check: cksfv returned with error: {err.returncode}', file=stderr)
+    except Exception as exc:
+        print(f'error: sfv_check: check failure: {exc}', file=stderr)
+
+        return 2
 
+    '''
+    Like cksfv, only consider the files listed in the SFV.
+    '''
+    if _report_results('sfv_check', results, (_CheckStatus.Mismatch, _CheckStatus.Missing)) != 0:
         return 2
 
     return 0
 
-def md5_check(arg) -> int:
+def md5_check(arg, external: bool = False, io_mode: IOMode = IOMode.Buffered) -> int:
     input_file = arg
 
     if not isfile(input_file):
@@ -348,36 +2412,70 @@ def md5_check(arg) -> int:
     filebase = basename(input_path)
     working = dirname(input_path)
 
-    filelist = list()
-    for f in listdir(working):
-        if not _filter(f):
-            filelist.append(f)
+    if external:
+        return _md5_check_external(filebase, working)
 
-    if not filelist:
-        print('error: md5_check: no files found to check', file=stderr)
+    try:
+        md5_list = _parse_md5(input_path)
+
+    except Exception as exc:
+        print(f'error: md5_check: checksum parsing failed: {exc}', file=stderr)
 
         return 2
 
-    filelist.sort()
+    files = sorted(f for f in listdir(working) if not _filter(f))
+    if not files:
+        print('error: md5_check: no files found to check', file=stderr)
 
-    p_args = ['md5deep', '-s', '-x', filebase] + filelist
+        return 2
 
     try:
-        prun(p_args, cwd=working, check=True, stdin=DEVNULL)
+        devices = [_get_device(working, f) for f in files]
 
-    except CalledProcessError as err:
-        print(f'error: md5_check: process returned with error: {err.returncode}', file=stderr)
+        scan_func = partial(_md5_scan_internal, working, io_mode=io_mode)
+        results = _md5_known_results(working, md5_list, dict(_device_map(scan_func, files, devices)))
 
+    except Exception as exc:
+        print(f'error: md5_check: check failure: {exc}', file=stderr)
+
+        return 3
+
+    '''
+    Like md5deep -x, only fail for files whose checksum is not known.
+    '''
+    if _report_results('md5_check', results, (_CheckStatus.Unknown,)) != 0:
         return 3
 
     return 0
 
-def sfv_migrate(arg) -> int:
+def io_calibrate(arg) -> int:
     input_file = arg
 
-    retval = sfv_check(input_file)
-    if retval != 0:
-        print(f'error: sfv_migrate: initial check failed: {input_file}', file=stderr)
+    if not isfile(input_file):
+        print(f'error: io_calibrate: sample file not found: {input_file}', file=stderr)
+
+        return 1
+
+    try:
+        results = calibrate(input_file)
+
+    except Exception as exc:
+        print(f'error: io_calibrate: calibration failed: {exc}', file=stderr)
+
+        return 2
+
+    for profile, throughput in results:
+        print(f'info: {profile}: {throughput / (1 << 20):.1f} MiB/s', file=stdout)
+
+    print(f'info: stored profile: {results[0][0]}', file=stdout)
+
+    return 0
+
+def sfv_migrate(arg, cache_mode: CacheMode = CacheMode.Update, io_mode: IOMode = IOMode.Buffered) -> int:
+    input_file = arg
+
+    if not isfile(input_file):
+        print(f'error: sfv_migrate: checksum file not found: {input_file}', file=stderr)
 
         return 1
 
@@ -392,6 +2490,14 @@ def sfv_migrate(arg) -> int:
 
         return 2
 
+    try:
+        sfv = _parse_sfv(input_path)
+
+    except Exception as exc:
+        print(f'error: sfv_migrate: checksum parsing failed: {exc}', file=stderr)
+
+        return 1
+
     m3u_path = pjoin(working, fileprefix + '.m3u')
     if not isfile(m3u_path):
         filelist = _try_singlefile(input_path)
@@ -404,14 +2510,7 @@ def sfv_migrate(arg) -> int:
         filelist = None
 
     md5_path = pjoin(working, fileprefix + '.md5')
-    has_md5 = False
-    if isfile(md5_path):
-        has_md5 = True
-        retval = md5_check(md5_path)
-        if retval != 0:
-            print(f'error: sfv_migrate: MD5 check failed for: {md5_path}', file=stderr)
-
-            return 4
+    has_md5 = isfile(md5_path)
 
     sha_path = pjoin(working, fileprefix + '.sha')
     if exists(sha_path):
@@ -419,27 +2518,74 @@ def sfv_migrate(arg) -> int:
 
         return 5
 
-    sha_temp = NamedTemporaryFile(mode='w+', prefix='/tmp/', delete=True)
+    try:
+        md5_list = _parse_md5(md5_path) if has_md5 else []
 
-    retval = sha_scan(working, sha_temp, filelist)
-    if retval != 0:
-        print(f'error: aborting migration since SHA scan failed: {working}', file=stderr)
+    except Exception as exc:
+        print(f'error: sfv_migrate: checksum parsing failed: {exc}', file=stderr)
+
+        return 1
+
+    for name, _ in sfv:
+        if not isfile(pjoin(working, name)):
+            print(f'error: sfv_migrate: initial check failed: file missing: {name}', file=stderr)
+
+            return 1
+
+    if filelist is None:
+        filelist = listdir(working)
+
+    sha_files = sorted(f for f in filelist if not _filter(f))
+    if not sha_files:
+        print(f'error: aborting migration since no files found to scan: {working}', file=stderr)
+
+        return 6
+
+    '''
+    Read every file only once, computing all digests needed for the
+    verification of the old checksums and for the new SHA checksum.
+    '''
+    hash_files = sorted(set(sha_files) | set(name for name, _ in sfv))
+    devices = [_get_device(working, f) for f in hash_files]
+
+    try:
+        scan_func = partial(_multi_scan_internal, working, io_mode=io_mode)
+        results = {r.sha.filename: r for r in _device_map(scan_func, hash_files, devices)}
+
+    except OSError as err:
+        print(f'error: aborting migration since hashing failed: {working}: {err}', file=stderr)
 
         return 6
 
-    sha_temp.seek(0)
+    for name, crc in sfv:
+        if int(crc, 16) != results[name].crc32:
+            print(f'error: sfv_migrate: initial check failed: CRC32 mismatch for: {name}', file=stderr)
+
+            return 1
+
+    if has_md5:
+        md5_results = _md5_known_results(working, md5_list, {f: results[f].md5 for f in sha_files})
+
+        for r in md5_results:
+            if r.status == _CheckStatus.Unknown:
+                print(f'error: sfv_migrate: MD5 check failed for: {r.filename}', file=stderr)
+
+                return 4
+
+    cache = _open_cache(cache_mode)
+    if cache is not None:
+        with cache:
+            _cache_results(cache, results.values())
 
     try:
         with open(input_file, mode='w', encoding='utf-8') as output:
-            output.write(sha_temp.read())
+            output.writelines(_format_sha_line(results[f].sha) for f in sha_files)
 
     except OSError as msg:
         print(f'error: failed to write the SHA result: {input_file}: {msg}', file=stderr)
 
         return 7
 
-    sha_temp.close()
-
     try:
         rename(input_path, sha_path)
         if has_md5:
@@ -465,10 +2611,29 @@ def main(args: list[str]) -> int:
         args - list of string arguments from the CLI
     '''
 
-    getopt_largs = ('help', 'sha-scan', 'sha-check', 'sfv-migrate', 'sfv-check')
+    getopt_largs = (
+        'help',
+        'sha-scan',
+        'sha-check',
+        'sha-check-tree',
+        'sha-pack',
+        'sha-unpack',
+        'copy-verify',
+        'archive-check',
+        'sfv-migrate',
+        'sfv-check',
+        'md5-check',
+        'calibrate',
+        'trust-cache',
+        'scrub',
+        'external',
+        'io-mode=',
+        'chunked',
+        'report=',
+    )
 
     try:
-        opts, oargs = getopt(args[1:], 'hscmf', getopt_largs)
+        opts, oargs = getopt(args[1:], 'hsctmf', getopt_largs)
 
     except GetoptError as err:
         print(f'error: getopt parsing failed: {err}', file=stderr)
@@ -477,25 +2642,81 @@ def main(args: list[str]) -> int:
         return 1
 
     checksum_mode = None
+    cache_mode = CacheMode.Update
+    external = False
+    io_mode = IOMode.Buffered
+    chunk_size = 0
+    report_format = None
 
     for o, a in opts:
+        if o in ('-h', '--help'):
+            _usage(args[0])
+
+            return 0
+        elif o == '--trust-cache':
+            cache_mode = CacheMode.Trust
+
+            continue
+        elif o == '--scrub':
+            cache_mode = CacheMode.Scrub
+
+            continue
+        elif o == '--external':
+            external = True
+
+            continue
+        elif o == '--chunked':
+            chunk_size = _default_chunk_size
+
+            continue
+        elif o == '--report':
+            if not a in _report_formats:
+                print(f'error: invalid report format: {a}', file=stderr)
+                _usage(args[0])
+
+                return 1
+
+            report_format = a
+
+            continue
+        elif o == '--io-mode':
+            if not a in _io_modes:
+                print(f'error: invalid I/O mode: {a}', file=stderr)
+                _usage(args[0])
+
+                return 1
+
+            io_mode = _io_modes[a]
+
+            continue
+
         if checksum_mode != None:
             print('error: multiple modes selected', file=stderr)
 
             return 2
 
-        if o in ('-h', '--help'):
-            _usage(args[0])
-
-            return 0
-        elif o in ('-s', '--sha-scan'):
+        if o in ('-s', '--sha-scan'):
             checksum_mode = 'scan'
         elif o in ('-c', '--sha-check'):
             checksum_mode = 'check'
+        elif o in ('-t', '--sha-check-tree'):
+            checksum_mode = 'tree'
         elif o in ('-f', '--sfv-check'):
             checksum_mode = 'sfv'
         elif o in ('-m', '--sfv-migrate'):
             checksum_mode = 'migrate'
+        elif o == '--sha-pack':
+            checksum_mode = 'pack'
+        elif o == '--sha-unpack':
+            checksum_mode = 'unpack'
+        elif o == '--copy-verify':
+            checksum_mode = 'copy'
+        elif o == '--archive-check':
+            checksum_mode = 'archive'
+        elif o == '--md5-check':
+            checksum_mode = 'md5'
+        elif o == '--calibrate':
+            checksum_mode = 'calibrate'
         else:
             raise RuntimeError('unhandled option')
 
@@ -504,19 +2725,27 @@ def main(args: list[str]) -> int:
 
         return 3
 
-    if len(oargs) != 1:
+    num_args = 2 if checksum_mode == 'copy' else 1
+
+    if len(oargs) != num_args:
         print('error: checksum file / directory argument invalid or missing', file=stderr)
 
         return 4
 
-    if checksum_mode == 'scan':
-        retval = sha_scan(oargs[0], None, None)
-    elif checksum_mode == 'check':
-        retval = sha_check(oargs[0])
-    elif checksum_mode == 'sfv':
-        retval = sfv_check(oargs[0])
-    elif checksum_mode == 'migrate':
-        retval = sfv_migrate(oargs[0])
+    with _Progress():
+        retval = _dispatch(checksum_mode, oargs, cache_mode, io_mode, external, chunk_size)
+
+    bytes_read = _read_stats.bytes_disk + _read_stats.bytes_cache
+    if bytes_read != 0:
+        print(f'info: read {_read_stats.bytes_disk} bytes from disk, {_read_stats.bytes_cache} bytes from page cache', file=stdout)
+
+    if report_format == 'text':
+        _print_report(_metrics.report())
+    elif report_format == 'json':
+        report = _metrics.report()
+        report.update({'mode': checksum_mode, 'arguments': oargs, 'retval': retval})
+
+        print(jdumps(report), file=stdout)
 
     if retval != 0:
         print(f'error: checksum {checksum_mode} failed with return value {retval}', file=stderr)
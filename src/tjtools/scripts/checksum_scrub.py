@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from json import dump as jdump, load as jload
+from os import environ, getpid
+from os.path import dirname, realpath, join as pjoin
+from pathlib import Path
+from signal import SIGINT, SIGTERM, signal, strsignal
+from subprocess import DEVNULL, CalledProcessError, run as prun
+from sys import stderr, stdout
+from threading import Event
+from time import monotonic, time
+
+from systemd.daemon import notify as system_notify
+from systemd.journal import LOG_ERR, LOG_WARNING, send as journal_send
+
+from ..binary_manifest import BinaryManifest, is_binary_manifest
+from ..file_reader import FileReader, IOMode, get_io_profile
+from .checksum import SHATuple, find_manifests, parse_sha
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Default location of the scrub checkpoint.
+'''
+_default_state_path = Path(environ.get('XDG_STATE_HOME', Path.home() / '.local' / 'state')) / 'tjtools' / 'checksum_scrub.json'
+
+'''
+Default read bandwidth budget (in MiB/s).
+'''
+_default_bandwidth = 20.0
+
+'''
+Default pause (in hours) between two scrub passes.
+'''
+_default_interval = 24.0
+
+'''
+Maximum time (in seconds) the throttle can fall behind its budget. Any longer
+stall (e.g. a slow disk spin-up) is not made up for by reading in a burst.
+'''
+_max_throttle_credit = 1.0
+
+'''
+Event that is set when the scrubber should stop.
+'''
+_stop_event = Event()
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+@dataclass
+class _ScrubState:
+    '''
+    Checkpoint of the scrub progress.
+
+    manifest   - path of the checksum file currently scrubbed (None if no pass is running)
+    entry      - number of entries of the checksum file that are done
+    num_files  - number of files scrubbed in the current pass
+    num_bytes  - number of bytes scrubbed in the current pass
+    num_errors - number of files with errors in the current pass
+    next_pass  - time (in seconds since the epoch) when the next pass starts
+    '''
+
+    manifest: str = None
+    entry: int = 0
+    num_files: int = 0
+    num_bytes: int = 0
+    num_errors: int = 0
+    next_pass: float = 0.0
+
+
+class _Throttle:
+    '''
+    Limit the read bandwidth to a given budget.
+    '''
+
+    def __init__(self, rate: float):
+        self._rate = rate
+        self._start = monotonic()
+        self._bytes = 0
+
+    def consume(self, num_bytes: int) -> None:
+        '''
+        Account a number of read bytes, and sleep until they fit into the budget.
+
+        Arguments:
+            num_bytes - the number of bytes
+
+        Returns early when the scrubber is stopped.
+        '''
+
+        self._bytes += num_bytes
+
+        delay = self._bytes / self._rate - (monotonic() - self._start)
+
+        if delay > 0.0:
+            _stop_event.wait(delay)
+        elif delay < -_max_throttle_credit:
+            self._start = monotonic()
+            self._bytes = 0
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _signal_handler(signal_no, stack_frame):
+    print(f'info: received signal {strsignal(signal_no)}', file=stderr)
+
+    _stop_event.set()
+
+def _set_idle_priority() -> None:
+    '''
+    Switch the process to the idle I/O scheduling class.
+
+    Threads created afterwards inherit the I/O priority.
+    '''
+
+    p_args = ('ionice', '-c', '3', '-p', str(getpid()))
+
+    try:
+        prun(p_args, check=True, stdin=DEVNULL, stdout=DEVNULL)
+
+    except (OSError, CalledProcessError) as err:
+        print(f'warn: failed to set idle I/O priority: {err}', file=stderr)
+
+def _load_state(path: Path) -> _ScrubState:
+    '''
+    Load the scrub checkpoint.
+
+    Arguments:
+        path - path of the checkpoint
+
+    Returns an empty state if no valid checkpoint exists.
+    '''
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            return _ScrubState(**jload(f))
+
+    except FileNotFoundError:
+        pass
+
+    except Exception as exc:
+        print(f'warn: ignoring invalid checkpoint: {path}: {exc}', file=stderr)
+
+    return _ScrubState()
+
+def _store_state(path: Path, state: _ScrubState) -> None:
+    '''
+    Store the scrub checkpoint.
+
+    Arguments:
+        path  - path of the checkpoint
+        state - the state to store
+
+    The checkpoint is replaced atomically, so that it stays valid when the
+    process is killed while writing.
+    '''
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = path.with_suffix('.tmp')
+
+    with open(tmp_path, mode='w', encoding='utf-8') as f:
+        jdump(asdict(state), fp=f, indent=4)
+
+    tmp_path.replace(path)
+
+def _report(message: str, priority: int, manifest: str, filename: str = None) -> None:
+    '''
+    Report a scrub error to the journal.
+
+    Arguments:
+        message  - the error message
+        priority - syslog priority of the message
+        manifest - path of the checksum file
+        filename - name of the affected file (optional)
+    '''
+
+    fields = {
+        'PRIORITY': priority,
+        'SYSLOG_IDENTIFIER': 'checksum_scrub',
+        'CHECKSUM_MANIFEST': manifest,
+    }
+
+    if filename is not None:
+        fields['CHECKSUM_FILE'] = filename
+
+    journal_send(f'{manifest}: {message}', **fields)
+
+def _verify_entry(path: str, ref: SHATuple, throttle: _Throttle) -> list[str]:
+    '''
+    Verify a single file against its reference SHA tuple.
+
+    Arguments:
+        path     - path of the file
+        ref      - the reference SHA tuple
+        throttle - the bandwidth throttle
+
+    Returns a list of error messages, or None if the scrubber was stopped.
+
+    The file is read in cache-neutral mode, so that scrubbing does not evict
+    the working set of other applications from the page cache.
+    '''
+
+    h = sha256()
+    chunks = []
+    filesize = 0
+
+    with FileReader(path, IOMode.NoCache, get_io_profile(path)) as reader:
+        for block in reader.blocks():
+            num_read = len(block)
+
+            if ref.chunks is None:
+                h.update(block)
+                filesize += num_read
+            else:
+                while block:
+                    length = min(len(block), ref.chunk_size - filesize % ref.chunk_size)
+
+                    h.update(block[:length])
+                    filesize += length
+                    block = block[length:]
+
+                    if filesize % ref.chunk_size == 0:
+                        chunks.append(h.digest())
+                        h = sha256()
+
+            throttle.consume(num_read)
+
+            if _stop_event.is_set():
+                return None
+
+    errors = []
+
+    if ref.chunks is None:
+        if h.digest() != ref.hash:
+            errors.append(f'hash mismatch for: {ref.filename}')
+    else:
+        if filesize % ref.chunk_size != 0:
+            chunks.append(h.digest())
+
+        bad_chunks = [str(i) for i, (a, b) in enumerate(zip(chunks, ref.chunks)) if a != b]
+        if bad_chunks:
+            errors.append(f'hash mismatch for: {ref.filename} (chunks {", ".join(bad_chunks)})')
+
+    if filesize != ref.filesize:
+        errors.append(f'filesize mismatch for: {ref.filename}')
+
+    return errors
+
+def _scrub_pass(roots: list[str], state: _ScrubState, state_path: Path, throttle: _Throttle) -> bool:
+    '''
+    Run a single scrub pass over all checksum files.
+
+    Arguments:
+        roots      - list of root directories
+        state      - the scrub state (resumed from, and updated in place)
+        state_path - path of the checkpoint
+        throttle   - the bandwidth throttle
+
+    Returns True if the pass was completed, and False if it was stopped.
+
+    The checkpoint is updated after each file, so that at most the work on a
+    single file is lost when the scrubber is stopped.
+    '''
+
+    manifests = sorted(m for root in roots for m in find_manifests(root))
+
+    for manifest in manifests:
+        if state.manifest is not None and manifest < state.manifest:
+            continue
+
+        if manifest != state.manifest:
+            state.manifest = manifest
+            state.entry = 0
+
+        '''
+        Binary checksum files are accessed by index through the memory map,
+        instead of loading all entries.
+        '''
+        binary = False
+
+        try:
+            binary = is_binary_manifest(manifest)
+            entries = BinaryManifest(manifest) if binary else parse_sha(manifest)
+
+        except Exception as exc:
+            _report(f'checksum parsing failed: {exc}', LOG_WARNING, manifest)
+
+            continue
+
+        system_notify(f'STATUS=scrubbing {manifest}')
+
+        base_directory = dirname(manifest)
+
+        try:
+            for index in range(state.entry, len(entries)):
+                ref = SHATuple(*entries[index]) if binary else entries[index]
+
+                try:
+                    errors = _verify_entry(pjoin(base_directory, ref.filename), ref, throttle)
+
+                except FileNotFoundError:
+                    errors = [f'file missing: {ref.filename}']
+
+                except OSError as err:
+                    errors = [f'read error: {ref.filename}: {err}']
+
+                if errors is None:
+                    return False
+
+                for error in errors:
+                    _report(error, LOG_ERR, manifest, ref.filename)
+
+                state.entry = index + 1
+                state.num_files += 1
+                state.num_bytes += ref.filesize
+
+                if errors:
+                    state.num_errors += 1
+
+                _store_state(state_path, state)
+
+        finally:
+            if binary:
+                entries.close()
+
+    return True
+
+
+##########################################################################################
+# Main
+##########################################################################################
+
+def main(args: list[str]) -> int:
+    '''
+    Main function.
+
+    Arguments:
+        args - list of string arguments from the CLI
+    '''
+
+    parser = ArgumentParser(description='Continuously verify SHA checksum files in the background.')
+
+    parser.add_argument('roots', nargs='+', help='Root directories with checksum files')
+    parser.add_argument('-b', '--bandwidth', type=float, default=_default_bandwidth, help='Read bandwidth budget in MiB/s')
+    parser.add_argument('-i', '--interval', type=float, default=_default_interval, help='Pause in hours between two passes')
+    parser.add_argument('-s', '--state', type=Path, default=_default_state_path, help='Path of the checkpoint')
+    parser.add_argument('--once', action='store_true', help='Exit after a single pass')
+
+    parsed_args = parser.parse_args(args[1:])
+
+    if parsed_args.bandwidth <= 0.0:
+        print(f'error: invalid bandwidth: {parsed_args.bandwidth}', file=stderr)
+
+        return 1
+
+    roots = [realpath(r) for r in parsed_args.roots]
+    state_path = parsed_args.state
+
+    _set_idle_priority()
+
+    signal(SIGTERM, _signal_handler)
+    signal(SIGINT, _signal_handler)
+
+    state = _load_state(state_path)
+
+    system_notify('READY=1')
+
+    while not _stop_event.is_set():
+        if state.manifest is None:
+            delay = state.next_pass - time()
+
+            if delay > 0.0 and not parsed_args.once:
+                system_notify('STATUS=waiting for next pass')
+
+                if _stop_event.wait(delay):
+                    break
+
+        throttle = _Throttle(parsed_args.bandwidth * (1 << 20))
+
+        try:
+            completed = _scrub_pass(roots, state, state_path, throttle)
+
+        except Exception as exc:
+            print(f'error: scrub pass failed: {exc}', file=stderr)
+
+            return 2
+
+        if not completed:
+            break
+
+        print(f'info: scrubbed {state.num_files} files, {state.num_bytes} bytes total, {state.num_errors} with errors', file=stdout)
+
+        state = _ScrubState(next_pass=time() + parsed_args.interval * 3600.0)
+        _store_state(state_path, state)
+
+        if parsed_args.once:
+            break
+
+    system_notify('STOPPING=1')
+
+    return 0
@@ -6,6 +6,7 @@
 # Imports
 ##########################################################################################
 
+from os import major, minor, stat
 from pathlib import Path
 
 
@@ -27,6 +28,42 @@ def _is_parent_device(path: Path) -> bool:
 
     return True
 
+def _get_mount_source(dev: int) -> Path:
+    '''
+    Get the source block device of a mounted filesystem.
+
+    Arguments:
+        dev - the device ID of the filesystem
+
+    This is needed for filesystems that use anonymous device IDs (e.g. btrfs).
+    Returns None if the source is not a block device.
+    '''
+
+    dev_id = f'{major(dev)}:{minor(dev)}'
+
+    try:
+        mountinfo = Path('/proc/self/mountinfo').read_text(encoding='utf-8').splitlines()
+
+    except Exception:
+        return None
+
+    for line in mountinfo:
+        fields = line.split()
+        if len(fields) < 3 or fields[2] != dev_id or not '-' in fields:
+            continue
+
+        source = fields[fields.index('-') + 2]
+        if not source.startswith('/dev/'):
+            return None
+
+        try:
+            return get_block_device(stat(source).st_rdev)
+
+        except OSError:
+            return None
+
+    return None
+
 
 ##########################################################################################
 # Functions
@@ -56,6 +93,53 @@ def get_parent_device(path: Path) -> Path:
 
     return parent_device
 
+def get_block_device(dev: int) -> Path:
+    '''
+    Get the sysfs path of the block device holding a filesystem.
+
+    Arguments:
+        dev - the device ID (e.g. st_dev of a file)
+
+    Returns None if the device could not be resolved, e.g. for network filesystems.
+    '''
+
+    path = Path(f'/sys/dev/block/{major(dev)}:{minor(dev)}')
+    if path.exists():
+        return path.resolve()
+
+    if major(dev) == 0:
+        return _get_mount_source(dev)
+
+    return None
+
+def get_backing_devices(path: Path) -> list[Path]:
+    '''
+    Get the physical disks backing a block device.
+
+    Arguments:
+        path - sysfs path of the block device
+
+    Partitions are resolved to their parent disk, and stacked devices
+    (e.g. MD RAID, LVM or dm-crypt) are resolved to their slave devices.
+    '''
+
+    if (path / 'partition').is_file():
+        path = path.parent
+
+    slaves_path = path / 'slaves'
+    if slaves_path.is_dir():
+        slaves = sorted(slaves_path.iterdir())
+
+        if slaves:
+            backing_devices = []
+
+            for slave in slaves:
+                backing_devices.extend(get_backing_devices(slave.resolve()))
+
+            return backing_devices
+
+    return [path]
+
 def read_sysfs(path: Path) -> str:
     '''
     Read from a sysfs path.
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+from __future__ import annotations
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from fcntl import ioctl
+from hashlib import sha256
+from os import environ, getpid, utime
+from pathlib import Path
+from shutil import copyfileobj
+
+
+##########################################################################################
+# Constants
+##########################################################################################
+
+'''
+Default location of the transcode cache.
+'''
+_default_path = Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'tjtools' / 'transcode'
+
+'''
+The FICLONE ioctl (from linux/fs.h), which shares the extents of a file with another one.
+'''
+_ficlone = 0x40049409
+
+'''
+Buffer size (in bytes) when copying files, if they can not be cloned.
+'''
+_copy_buffer_size = 1 << 20
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+class TranscodeCache:
+    '''
+    Persistent on-disk cache of transcoded files.
+
+    Entries are addressed by the content of the source audio and the encoder
+    settings (see transcode_key), so a source that is only re-tagged, renamed or
+    moved still maps to the same entry.
+
+    Entries are cloned (reflinked) into place if the filesystem supports this,
+    and are copied otherwise. Hardlinks are not used, since the tags of the
+    outputs are rewritten afterwards, which would modify the entries.
+
+    The modification time of an entry is updated whenever it is used, so that
+    pruning removes the least recently used entries first.
+    '''
+
+    def __init__(self, path: Path = None):
+        if path is None:
+            path = _default_path
+
+        path.mkdir(parents=True, exist_ok=True)
+
+        self._path = path
+
+    def _entry_path(self, key: str) -> Path:
+        return self._path / key[:2] / key
+
+    def fetch(self, key: str, path: Path) -> bool:
+        '''
+        Fetch a transcoded file from the cache.
+
+        Arguments:
+            key  - key of the entry
+            path - path where the file is created
+
+        Returns True if the file was created, and False if the cache has no entry.
+        '''
+
+        entry_path = self._entry_path(key)
+        if not entry_path.is_file():
+            return False
+
+        _clone(entry_path, path)
+
+        try:
+            utime(entry_path)
+
+        except OSError:
+            pass
+
+        return True
+
+    def store(self, key: str, path: Path) -> None:
+        '''
+        Store a transcoded file in the cache.
+
+        Arguments:
+            key  - key of the entry
+            path - path of the transcoded file
+
+        The entry is replaced atomically, so concurrent processes never see a
+        partial entry.
+        '''
+
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(exist_ok=True)
+
+        tmp_path = entry_path.with_name(f'.{key}.{getpid()}.tmp')
+
+        try:
+            _clone(path, tmp_path)
+
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+
+            raise
+
+        tmp_path.replace(entry_path)
+
+    def prune(self, max_size: int) -> int:
+        '''
+        Prune the cache to a size limit.
+
+        Arguments:
+            max_size - the size limit in bytes
+
+        Returns the number of removed entries.
+
+        The least recently used entries are removed first.
+        '''
+
+        entries = []
+
+        for entry_path in self._path.glob('*/*'):
+            '''
+            Skip entries that are currently stored.
+            '''
+            if entry_path.name.startswith('.'):
+                continue
+
+            try:
+                st = entry_path.stat()
+
+            except FileNotFoundError:
+                continue
+
+            entries.append((st.st_mtime_ns, st.st_size, entry_path))
+
+        total_size = sum(size for _, size, _ in entries)
+        num_removed = 0
+
+        for _, size, entry_path in sorted(entries, key=lambda e: e[0]):
+            if total_size <= max_size:
+                break
+
+            entry_path.unlink(missing_ok=True)
+
+            total_size -= size
+            num_removed += 1
+
+        return num_removed
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _clone(src_path: Path, dst_path: Path) -> None:
+    '''
+    Clone a file, or copy it if the filesystem does not support cloning.
+
+    Arguments:
+        src_path - path of the source file
+        dst_path - path of the destination file
+    '''
+
+    with open(src_path, mode='rb') as src, open(dst_path, mode='wb') as dst:
+        try:
+            ioctl(dst.fileno(), _ficlone, src.fileno())
+
+            return
+
+        except OSError:
+            pass
+
+        copyfileobj(src, dst, _copy_buffer_size)
+
+
+##########################################################################################
+# Functions
+##########################################################################################
+
+def transcode_key(md5: bytes, bits_per_sample: int, sample_rate: int, channels: int, encoder: str) -> str:
+    '''
+    Get the cache key of a transcoded file.
+
+    Arguments:
+        md5             - MD5 of the raw PCM samples of the source
+        bits_per_sample - bits-per-sample of the source
+        sample_rate     - sample rate of the source in Hz
+        channels        - number of channels of the source
+        encoder         - identification of the encoder (name, version and settings)
+    '''
+
+    h = sha256()
+
+    h.update(md5)
+    h.update(f'{bits_per_sample}:{sample_rate}:{channels}:{encoder}'.encode('utf-8'))
+
+    return h.hexdigest()
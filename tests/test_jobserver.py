@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0
+
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from os import O_CLOEXEC, O_NONBLOCK, close, pipe2
+from threading import Thread
+from time import sleep
+from unittest import TestCase, main
+
+from tjtools.job_pool import JobPool, PoolJob
+from tjtools.jobserver import _MakeJobserver, _implicit_token
+
+
+##########################################################################################
+# Internal functions
+##########################################################################################
+
+def _job(value: int, threads: int) -> int:
+    return value
+
+
+##########################################################################################
+# Class definitions
+##########################################################################################
+
+class MakeJobserverTest(TestCase):
+    '''
+    Tests of the GNU make jobserver client, with an empty jobserver pipe (make -j1).
+    '''
+
+    def setUp(self):
+        self._read_fd, self._write_fd = pipe2(O_NONBLOCK | O_CLOEXEC)
+        self._jobserver = _MakeJobserver(self._read_fd, self._write_fd)
+
+    def tearDown(self):
+        close(self._read_fd)
+        close(self._write_fd)
+
+    def test_implicit_release_wakes_acquire(self):
+        tokens = self._jobserver.acquire(1)
+        self.assertEqual(tokens, [_implicit_token])
+
+        acquired = []
+
+        waiter = Thread(target=lambda: acquired.extend(self._jobserver.acquire(1)), daemon=True)
+        waiter.start()
+
+        '''
+        Give the waiter time to block in select().
+        '''
+        sleep(0.2)
+        self.assertEqual(acquired, [])
+
+        self._jobserver.release(tokens)
+
+        waiter.join(timeout=5.0)
+        self.assertFalse(waiter.is_alive(), 'acquire() was not woken by the implicit release')
+        self.assertEqual(acquired, [_implicit_token])
+
+    def test_job_pool_implicit_token_only(self):
+        pool = JobPool(slots=2, jobserver=self._jobserver)
+        results = []
+
+        runner = Thread(target=lambda: results.extend(pool.run(_job, [PoolJob((i,), 1.0) for i in range(3)])), daemon=True)
+        runner.start()
+
+        runner.join(timeout=30.0)
+        self.assertFalse(runner.is_alive(), 'job pool hangs on the implicit token')
+        self.assertEqual(results, [0, 1, 2])
+
+
+##########################################################################################
+# Main
+##########################################################################################
+
+if __name__ == '__main__':
+    main()